@@ -0,0 +1,365 @@
+"""Benchmarks for the sweep and capture hot paths, run against a simulated board.
+
+Results are written as JSON. Two result files can be compared to find regressions:
+
+    python benchmarks/run_benchmarks.py -o results.json
+    python benchmarks/run_benchmarks.py --compare baseline.json results.json
+"""
+import argparse
+from datetime import datetime
+import fnmatch
+import importlib.util
+import json
+import logging
+from pathlib import Path
+import pickle
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from oleas.backend import get_board_controller
+from oleas.columnar import load_output, save_output_columnar
+from oleas.events import wait_for_events
+from oleas.gate_pmt_sweep import GateDelayPmtDacSweep
+from oleas.helpers import (
+    correct_pedestals,
+    correct_pedestals_batch,
+    readout,
+    save_pickle,
+    setup_logger_output,
+)
+from oleas.nd_sweep import NdSweep
+from oleas.simulation import SimulatedBoard
+
+# =====================================================================
+#                             CONFIGURATION
+# =====================================================================
+# (delay points, dac points) of the sweep grids to benchmark
+GRID_SIZES = [(5, 5), (10, 10), (20, 20)]
+QUICK_GRID_SIZES = [(5, 5)]
+
+# number of captures per point
+NUM_CAPTURES = [1, 10, 50]
+QUICK_NUM_CAPTURES = [10]
+
+# read window of the simulated events
+READ_WINDOW = {
+    'windows': 8,
+    'lookback': 8,
+    'write_after_trig': 8,
+}
+
+# simulated board timing, in seconds
+TRIGGER_DELAY = 0.0002
+I2C_LATENCY = 0.0
+REGISTER_LATENCY = 0.0
+
+# number of trigger-to-event round trips to time
+NUM_LATENCY_TRIGGERS = 200
+
+# relative slowdown reported as a regression by --compare
+DEFAULT_THRESHOLD = 0.1
+# ==================================================================
+
+logger = logging.getLogger(__name__)
+BENCHMARKS = {}
+
+
+def benchmark(fn):
+    """Register a benchmark. The function yields ``(name, params, run)`` cases, where ``run``
+    performs the timed work and returns the number of items processed.
+    """
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.debug:
+        setup_logger_output()
+
+    if args.compare:
+        baseline, current = (_load_results(path) for path in args.compare)
+        regressions = compare(baseline, current, args.threshold)
+        sys.exit(1 if regressions else 0)
+
+    grid_sizes = QUICK_GRID_SIZES if args.quick else GRID_SIZES
+    num_captures = QUICK_NUM_CAPTURES if args.quick else NUM_CAPTURES
+    results = run_benchmarks(grid_sizes, num_captures, args.repeat, args.filter)
+    output = {
+        'metadata': {
+            'time': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'quick': args.quick,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+        print(f'Saved results to: {args.output}')
+
+
+def run_benchmarks(grid_sizes: list, num_captures: list, repeat: int, pattern: str = None) -> dict:
+    """Run all registered benchmarks whose case names match the pattern.
+
+    Returns:
+        dict: results by case name, with the best/median time in seconds and the throughput in items per second.
+    """
+    results = {}
+    for fn in BENCHMARKS.values():
+        for name, params, run in fn(grid_sizes, num_captures):
+            if pattern and not fnmatch.fnmatch(name, pattern):
+                continue
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                items = run()
+                times.append(time.perf_counter() - start)
+            best = min(times)
+            results[name] = {
+                'params': params,
+                'items': items,
+                'best': best,
+                'median': statistics.median(times),
+                'throughput': items / best if best > 0 else float('inf'),
+            }
+            print(f'{name:<60} {best * 1000:10.2f} ms {results[name]["throughput"]:12.1f} items/s')
+    return results
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    """Print the change of each benchmark between two result files.
+
+    Args:
+        baseline (dict): baseline results
+        current (dict): current results
+        threshold (float): relative increase in the best time reported as a regression
+
+    Returns:
+        list[str]: names of the regressed benchmarks
+    """
+    regressions = []
+    print(f'{"benchmark":<60} {"baseline":>12} {"current":>12} {"change":>9}')
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            print(f'{name:<60} {"-":>12} {result["best"] * 1000:9.2f} ms {"new":>9}')
+            continue
+        change = result['best'] / base['best'] - 1 if base['best'] > 0 else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<60} {base["best"] * 1000:9.2f} ms {result["best"] * 1000:9.2f} ms {change:+8.1%}{flag}')
+    missing = set(baseline['results']) - set(current['results'])
+    for name in sorted(missing):
+        print(f'{name:<60} missing from current results')
+    print(f'{len(regressions)} regression(s) above {threshold:.0%}')
+    return regressions
+
+
+# =====================================================================
+#                             BENCHMARKS
+# =====================================================================
+@benchmark
+def traversal(grid_sizes, num_captures):
+    """Sweep traversal overhead with a trivial point function"""
+    class _Sweep(NdSweep):
+        def _run_for_point(self):
+            return None
+
+    for size in grid_sizes:
+        for serpentine in (False, True):
+            sweep = _Sweep([np.arange(size[0]), np.arange(size[1])], axis_costs=[1, 10], serpentine=serpentine)
+            yield (
+                f'traversal[grid={size[0]}x{size[1]},serpentine={serpentine}]',
+                {'grid': size, 'serpentine': serpentine, 'unit': 'points'},
+                lambda sweep=sweep: _count_points(sweep),
+            )
+
+
+@benchmark
+def sweep_points(grid_sizes, num_captures):
+    """Full sweep on the simulated board, including triggering and readout"""
+    for size in grid_sizes:
+        for captures in num_captures:
+            def run(size=size, captures=captures):
+                board = _simulated_board()
+                sweep = GateDelayPmtDacSweep(board, np.linspace(0, 1000, size[0]), np.linspace(0, 1, size[1]), captures)
+                sweep.set_read_window(READ_WINDOW)
+                sweep.set_burst_mode(True)
+                sweep.run()
+                return size[0] * size[1] * captures
+            yield (
+                f'sweep_points[grid={size[0]}x{size[1]},captures={captures}]',
+                {'grid': size, 'num_captures': captures, 'unit': 'events'},
+                run,
+            )
+
+
+@benchmark
+def trigger_latency(grid_sizes, num_captures):
+    """Round trip from a trigger to the event being taken from the buffer"""
+    def run():
+        board = _simulated_board()
+        bc = get_board_controller(board)
+        with readout(board, READ_WINDOW) as daq:
+            for _ in range(NUM_LATENCY_TRIGGERS):
+                bc.toggle_trigger()
+                wait_for_events(daq.output_buffer, amount=1, timeout=1)
+                daq.output_buffer.popleft()
+        return NUM_LATENCY_TRIGGERS
+    yield (
+        f'trigger_latency[trigger_delay={TRIGGER_DELAY}]',
+        {'trigger_delay': TRIGGER_DELAY, 'unit': 'events'},
+        run,
+    )
+
+
+@benchmark
+def pedestals_correction(grid_sizes, num_captures):
+    """Pedestals correction of a whole sweep, per event and batched"""
+    for size in grid_sizes:
+        for captures in num_captures:
+            board, data = _sweep_data(size, captures)
+            pedestals = board.generate_pedestals()
+            num_events = size[0] * size[1] * captures
+            yield (
+                f'correct_pedestals[grid={size[0]}x{size[1]},captures={captures}]',
+                {'grid': size, 'num_captures': captures, 'unit': 'events'},
+                lambda data=data, pedestals=pedestals, board=board, n=num_events:
+                    (correct_pedestals(data, board.params, pedestals), n)[1],
+            )
+            yield (
+                f'correct_pedestals_batch[grid={size[0]}x{size[1]},captures={captures}]',
+                {'grid': size, 'num_captures': captures, 'unit': 'events'},
+                lambda data=data, pedestals=pedestals, n=num_events:
+                    (correct_pedestals_batch(data, pedestals), n)[1],
+            )
+
+
+@benchmark
+def save_load(grid_sizes, num_captures):
+    """Saving and loading a sweep output in the pickle and columnar formats"""
+    directory = Path(tempfile.mkdtemp(prefix='oleas-bench-'))
+    for size in grid_sizes:
+        for captures in num_captures:
+            _, data = _sweep_data(size, captures)
+            output = {'dac': np.linspace(0, 1, size[1]), 'delay': np.linspace(0, 1000, size[0]), 'data': data}
+            num_events = size[0] * size[1] * captures
+            suffix = f'[grid={size[0]}x{size[1]},captures={captures}]'
+            params = {'grid': size, 'num_captures': captures, 'unit': 'events'}
+            pickle_file = directory / f'{size[0]}x{size[1]}x{captures}.pkl'
+            columnar_file = pickle_file.with_suffix('.oleas')
+            save_pickle(pickle_file, output)
+            save_output_columnar(columnar_file, output)
+
+            yield 'save_pickle' + suffix, params, lambda f=pickle_file, o=output, n=num_events: (save_pickle(f, o), n)[1]
+            yield 'load_pickle' + suffix, params, lambda f=pickle_file, n=num_events: (_load_pickle(f), n)[1]
+            yield (
+                'save_columnar' + suffix, params,
+                lambda f=columnar_file, o=output, n=num_events: (save_output_columnar(f, o), n)[1],
+            )
+            yield (
+                'load_columnar' + suffix, params,
+                lambda f=columnar_file, n=num_events: (np.asarray(load_output(f)['data']).sum(), n)[1],
+            )
+
+
+@benchmark
+def plot_file(grid_sizes, num_captures):
+    """Plotting a capture output file with scripts/visualize.py"""
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        logger.warning('matplotlib is not installed, skipping plot_file')
+        return
+    visualize = _load_script('visualize')
+    directory = Path(tempfile.mkdtemp(prefix='oleas-bench-'))
+    for captures in num_captures:
+        board, data = _sweep_data((1, 5), captures)
+        pedestals = board.generate_pedestals()
+        output = {
+            'dac': [np.linspace(0, 1, 5)] * 2,
+            'delay': np.linspace(0, 20, 5),
+            'data': data[0],
+            'corrected_data': correct_pedestals_batch(data[0], pedestals)[0],
+        }
+        file = directory / f'capture-{captures}.oleas'
+        save_output_columnar(file, output)
+
+        def run(file=file):
+            fig = plt.figure(constrained_layout=True)
+            visualize.plot_file(fig, file)
+            plt.close(fig)
+            return 1
+        yield f'plot_file[captures={captures}]', {'num_captures': captures, 'unit': 'files'}, run
+
+
+# =====================================================================
+#                             HELPERS
+# =====================================================================
+def _simulated_board() -> SimulatedBoard:
+    return SimulatedBoard(
+        trigger_delay=TRIGGER_DELAY,
+        i2c_latency=I2C_LATENCY,
+        register_latency=REGISTER_LATENCY,
+        seed=0,
+    )
+
+
+def _sweep_data(size: tuple, captures: int) -> tuple[SimulatedBoard, list]:
+    """Generate sweep data shaped like ``[delay][dac][capture]`` without running a sweep"""
+    board = _simulated_board()
+    board.read_window = dict(READ_WINDOW)
+    data = [[[board.make_event() for _ in range(captures)] for _ in range(size[1])] for _ in range(size[0])]
+    return board, data
+
+
+def _count_points(sweep: NdSweep) -> int:
+    return sum(1 for _ in sweep.iter_points())
+
+
+def _load_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _load_script(name: str):
+    path = Path(__file__).resolve().parent.parent / 'scripts' / f'{name}.py'
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _load_results(path) -> dict:
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def parse_args(argv):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='Run oleas benchmarks against a simulated board')
+    parser.add_argument('--output', '-o', type=Path, default=None, help='Output JSON file for the results')
+    parser.add_argument('--compare', '-c', type=Path, nargs=2, metavar=('BASELINE', 'CURRENT'), default=None, help='Compare two result files instead of running the benchmarks')
+    parser.add_argument('--threshold', '-t', type=float, default=DEFAULT_THRESHOLD, help=f'Relative slowdown reported as a regression. Defaults to {DEFAULT_THRESHOLD}')
+    parser.add_argument('--repeat', '-r', type=int, default=3, help='Number of times to run each benchmark. The best time is reported. Defaults to 3')
+    parser.add_argument('--filter', '-k', type=str, default=None, help='Only run benchmarks whose name matches this glob pattern, e.g. "correct_*"')
+    parser.add_argument('--quick', '-q', action='store_true', help='Only run the smallest grid size and one number of captures')
+    parser.add_argument('--debug', '-d', action='store_true', help='Show debug messages')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main()
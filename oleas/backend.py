@@ -0,0 +1,127 @@
+"""Access to the board hardware for real or simulated boards.
+
+oleas reaches the board only through these functions, so a ``SimulatedBoard``
+(see ``oleas.simulation``) can stand in for a naludaq ``Board``.
+"""
+import threading
+import weakref
+
+from naludaq.board import startup_board
+from naludaq.communication import ControlRegisters
+from naludaq.controllers import (
+    get_board_controller as _get_board_controller,
+    get_readout_controller as _get_readout_controller,
+    get_gainstage_controller as _get_gainstage_controller,
+)
+from naludaq.daq import DebugDaq
+from naludaq.devices.i2c_device import I2CDevice
+
+from oleas.exceptions import SensorError
+import oleas.simulation as simulation
+
+
+_locks = weakref.WeakKeyDictionary()
+_locks_lock = threading.Lock()
+# boards whose readout is running, see set_readout_active()
+_active_readouts = weakref.WeakSet()
+
+
+
+def is_simulated(board) -> bool:
+    return isinstance(board, simulation.SimulatedBoard)
+
+
+def get_board_controller(board):
+    if is_simulated(board):
+        return simulation.SimulatedBoardController(board)
+    return _get_board_controller(board)
+
+
+def get_readout_controller(board):
+    if is_simulated(board):
+        return simulation.SimulatedReadoutController(board)
+    return _get_readout_controller(board)
+
+
+def get_gainstage_controller(board, chip_number: int):
+    if is_simulated(board):
+        return simulation.SimulatedGainstageController(board, chip_number)
+    return _get_gainstage_controller(board, chip_number=chip_number)
+
+
+def get_control_registers(board):
+    if is_simulated(board):
+        return simulation.SimulatedControlRegisters(board)
+    return ControlRegisters(board)
+
+
+def get_i2c_device(board, address: int):
+    if is_simulated(board):
+        return simulation.SimulatedI2CDevice(board, address)
+    return I2CDevice(board, address)
+
+
+def has_sensors(board) -> bool:
+    """Whether ``read_sensors()`` can read the sensors of the board"""
+    return is_simulated(board)
+
+
+def read_sensors(board) -> dict:
+    """Read the board sensors.
+
+    Raises:
+        SensorError: if there is no sensor backend for the board (see ``has_sensors()``)
+    """
+    if is_simulated(board):
+        return board.read_sensors()
+    raise SensorError('No sensor backend for this board')
+
+
+def get_daq(board):
+    """Create a daq for the board (a ``DebugDaq`` for real boards)"""
+    if is_simulated(board):
+        return simulation.SimulatedDaq(board)
+    return DebugDaq(board)
+
+
+def get_board_lock(board) -> threading.RLock:
+    """Get the lock guarding the connection to the board, creating it if necessary.
+
+    Hold it while sending a sequence of commands to the board from a thread which
+    shares the board with others (e.g. ``oleas.telemetry.TelemetrySampler``).
+    """
+    with _locks_lock:
+        lock = _locks.get(board)
+        if lock is None:
+            lock = threading.RLock()
+            _locks[board] = lock
+        return lock
+
+
+def set_readout_active(board, active: bool):
+    """Record whether the readout of the board is running.
+
+    While it runs, the daq reads from the board on its own thread without taking
+    the board lock, so other threads must not send commands that expect a reply
+    (e.g. sensor reads). Call this while holding the board lock, right after
+    starting or stopping the readout.
+    """
+    if active:
+        _active_readouts.add(board)
+    else:
+        _active_readouts.discard(board)
+
+
+def is_readout_active(board) -> bool:
+    """Check whether the readout of the board is running, see ``set_readout_active()``.
+    Hold the board lock so the readout cannot start until you are done with the board.
+    """
+    return board in _active_readouts
+
+
+def startup(board):
+    """Start up the board"""
+    if is_simulated(board):
+        board.startup()
+    else:
+        startup_board(board)
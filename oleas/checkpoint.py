@@ -0,0 +1,129 @@
+import logging
+import os
+from pathlib import Path
+import pickle
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class SweepJournal:
+    """Append-only journal of completed sweep points.
+
+    The journal is a stream of pickled records. The first record is a header
+    describing the sweep, and each following record is an ``(index, point, result, annotations)``
+    tuple written as soon as the point completes. A record left incomplete by
+    a crash is discarded when the journal is loaded.
+
+    The journal is kept after the sweep completes, so the results can still be
+    recovered if saving them fails. Delete it once they are saved.
+    """
+
+    def __init__(self, path, shape: tuple, axis_values: list = None):
+        """Constructor.
+
+        Args:
+            path (Path | str): path to the journal file
+            shape (tuple): number of values along each axis of the sweep
+            axis_values (list): optional values of each axis of the sweep. When given,
+                a journal can only be resumed by a sweep over the same values.
+        """
+        self._path = Path(path)
+        self._shape = tuple(shape)
+        self._axis_values = None
+        if axis_values is not None:
+            self._axis_values = [np.asarray(values).tolist() for values in axis_values]
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def start(self, resume: bool = False) -> dict:
+        """Open the journal for a sweep.
+
+        Args:
+            resume (bool): if True, keep the points already in the journal.
+                Otherwise any existing journal is discarded.
+
+        Returns:
+            dict: mapping of point index to ``(point, result, annotations)`` for the
+                completed points.
+
+        Raises:
+            ValueError: if the existing journal belongs to a sweep with a different
+                shape or different axis values.
+        """
+        completed = None
+        if resume and self._path.exists():
+            completed = self._load()
+        if completed is None:
+            with open(self._path, 'wb') as f:
+                pickle.dump({'shape': self._shape, 'axis_values': self._axis_values}, f)
+                self._sync(f)
+            return {}
+        logger.info('Resuming from %s with %s completed points', self._path, len(completed))
+        return completed
+
+    def append(self, index: tuple, point: tuple, result: object, annotations: object = None):
+        """Record a completed point.
+
+        Args:
+            index (tuple): index of the point
+            point (tuple): coordinates of the point
+            result (object): result of the point
+            annotations (object): any extra information recorded for the point
+        """
+        with open(self._path, 'ab') as f:
+            pickle.dump((tuple(index), tuple(point), result, annotations), f)
+            self._sync(f)
+
+    def _load(self) -> 'dict | None':
+        """Load the completed points, or return None if the journal has no header"""
+        completed = {}
+        with open(self._path, 'rb+') as f:
+            try:
+                header = pickle.load(f)
+            except EOFError:
+                # the sweep was interrupted before the header was written
+                logger.warning('Journal %s is empty, starting a new sweep', self._path)
+                return None
+            if tuple(header['shape']) != self._shape:
+                raise ValueError(
+                    f'Journal {self._path} is for a sweep of shape {tuple(header["shape"])}, '
+                    f'not {self._shape}'
+                )
+            journal_values = header.get('axis_values')
+            if not self._same_axis_values(journal_values):
+                raise ValueError(f'Journal {self._path} is for a sweep over different axis values')
+            good_offset = f.tell()
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, TypeError):
+                    logger.warning('Discarding incomplete record at end of %s', self._path)
+                    break
+                # records written before annotations were journaled have three entries
+                index, point, result = record[:3]
+                annotations = record[3] if len(record) > 3 else None
+                completed[index] = (point, result, annotations)
+                good_offset = f.tell()
+            f.truncate(good_offset)
+        return completed
+
+    def _same_axis_values(self, journal_values: 'list | None') -> bool:
+        if self._axis_values is None or journal_values is None:
+            return True
+        return all(
+            np.array_equal(ours, theirs)
+            for ours, theirs in zip(self._axis_values, journal_values)
+        )
+
+    @staticmethod
+    def _sync(f):
+        f.flush()
+        os.fsync(f.fileno())
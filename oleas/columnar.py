@@ -0,0 +1,259 @@
+"""Columnar, memory-mappable storage for sweep and capture outputs.
+
+A columnar file holds one or more contiguous typed arrays and a small JSON
+header. The layout is:
+
+- the magic bytes ``OLEASCOL``
+- the header length as a little-endian 32-bit unsigned integer
+- the JSON header, describing the dtype, shape and offset of each array,
+  along with any metadata (dac/delay values, timestamps, etc.)
+- the raw array data, each array aligned to ``ALIGNMENT`` bytes
+
+Event data is stored as an array shaped like ``(delay, dac, capture, channel, sample)``
+for sweeps or ``(dac_delay_index, capture, channel, sample)`` for capture iterations,
+so that loading a single channel or point does not require reading the whole file.
+"""
+from datetime import datetime
+import json
+from pathlib import Path
+import pickle
+import struct
+
+import numpy as np
+
+from oleas.event_block import EventBlock
+
+
+MAGIC = b'OLEASCOL'
+ALIGNMENT = 64
+SUFFIX = '.oleas'
+EVENT_KEYS = ('data', 'corrected_data')
+ARRAY_KEYS = (
+    'features', 'feature_counts', 'window_labels', 'counts',
+    'stats_count', 'stats_mean', 'stats_variance', 'stats_min', 'stats_max',
+)
+
+
+
+def events_to_array(data: list, key: str = 'data', dtype=None) -> tuple[np.ndarray, np.ndarray]:
+    """Convert nested lists of events to a single contiguous array.
+
+    Missing captures, channels and samples are filled with zeros.
+
+    Args:
+        data (list): nested lists of event dicts, e.g. ``list[list[list[dict]]]``. The innermost
+            lists may also be ``EventBlock``s, which are copied without going through dicts.
+        key (str): the event key to convert, e.g. ``'data'`` or ``'window_labels'``.
+        dtype: dtype of the output array. Defaults to the dtype of the event data.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: the array shaped like ``(*outer, capture, channel, sample)``
+            and an array shaped like ``outer`` holding the number of captures at each point.
+    """
+    depth = _event_depth(data)
+    outer_shape = _outer_shape(data, depth)
+    events = list(_iter_event_lists(data, depth))
+    counts = np.array([len(x) for x in events], dtype=np.int32).reshape(outer_shape)
+
+    blocks = {i: x.array(key) for i, x in enumerate(events) if isinstance(x, EventBlock)}
+    channels = [
+        [np.asarray(chan) for chan in event[key]]
+        for i, capture in enumerate(events) if i not in blocks
+        for event in capture
+    ]
+    num_captures = max([len(x) for x in events], default=0)
+    num_channels = max([len(x) for x in channels] + [x.shape[1] for x in blocks.values()], default=0)
+    num_samples = max([len(chan) for event in channels for chan in event] + [x.shape[2] for x in blocks.values()], default=0)
+    if dtype is None:
+        dtypes = {chan.dtype for event in channels for chan in event} | {x.dtype for x in blocks.values()}
+        dtype = np.result_type(*dtypes) if dtypes else np.float64
+
+    output = np.zeros((len(events), num_captures, num_channels, num_samples), dtype=dtype)
+    flat_events = iter(channels)
+    for i, capture in enumerate(events):
+        if i in blocks:
+            block = blocks[i]
+            output[i, :block.shape[0], :block.shape[1], :block.shape[2]] = block
+            continue
+        for j in range(len(capture)):
+            for k, chan in enumerate(next(flat_events)):
+                output[i, j, k, :len(chan)] = chan
+    return output.reshape(outer_shape + output.shape[1:]), counts
+
+
+def save_columnar(path, arrays: dict[str, np.ndarray], metadata: dict = None):
+    """Save arrays and metadata to a columnar file.
+
+    Args:
+        path (Path | str): output file
+        arrays (dict[str, np.ndarray]): arrays to save, by name
+        metadata (dict): JSON-serializable metadata. Numpy arrays and datetimes
+            are converted automatically.
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    data_start = 0
+    while True:
+        offset = data_start
+        entries = {}
+        for name, array in arrays.items():
+            entries[name] = {
+                'descr': np.lib.format.dtype_to_descr(array.dtype),
+                'shape': list(array.shape),
+                'offset': offset,
+            }
+            offset = _align(offset + array.nbytes)
+        header = json.dumps(
+            {'version': 1, 'arrays': entries, 'metadata': metadata or {}},
+            default=_encode_json,
+        ).encode()
+        required_start = _align(len(MAGIC) + 4 + len(header))
+        if required_start <= data_start:
+            break
+        data_start = required_start
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(entries[name]['offset'])
+            array.tofile(f)
+
+
+def load_columnar(path) -> dict:
+    """Load a columnar file.
+
+    The arrays are memory-mapped, so slicing them only reads the part of
+    the file that is needed.
+
+    Args:
+        path (Path | str): path to the file
+
+    Returns:
+        dict: the metadata, along with each array under its name.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'Not a columnar file: {path}')
+        header_length, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_length), object_hook=_decode_json)
+
+    output = dict(header['metadata'])
+    for name, entry in header['arrays'].items():
+        dtype = np.lib.format.descr_to_dtype(_to_descr(entry['descr']))
+        shape = tuple(entry['shape'])
+        if 0 in shape:
+            output[name] = np.zeros(shape, dtype=dtype)
+        else:
+            output[name] = np.memmap(path, dtype=dtype, mode='r', offset=entry['offset'], shape=shape)
+    return output
+
+
+def save_output_columnar(path, output: dict):
+    """Save a sweep or capture output dict to a columnar file.
+
+    The event lists under ``EVENT_KEYS`` are converted to arrays (entries which are
+    already arrays are stored as-is), along with the
+    window labels of the raw events and the number of captures at each point
+    (``'counts'``). The entries under ``ARRAY_KEYS`` are stored as arrays too.
+    All other entries are stored as metadata.
+
+    Args:
+        path (Path | str): output file
+        output (dict): the output dict
+    """
+    arrays = {}
+    metadata = {}
+    for key, value in output.items():
+        if key in EVENT_KEYS:
+            if len(value) == 0:
+                continue
+            if isinstance(value, np.ndarray):
+                arrays[key] = value
+                continue
+            arrays[key], arrays['counts'] = events_to_array(value)
+            if key == 'data':
+                arrays['window_labels'], _ = events_to_array(value, key='window_labels')
+        elif key in ARRAY_KEYS:
+            arrays[key] = np.asarray(value)
+        else:
+            metadata[key] = value
+    save_columnar(path, arrays, metadata)
+
+
+def is_columnar_file(path) -> bool:
+    """Check whether the file is a columnar file"""
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_output(path) -> dict:
+    """Load a sweep or capture output saved either as a pickle or a columnar file.
+
+    Args:
+        path (Path | str): path to the file
+
+    Returns:
+        dict: the output dict
+    """
+    if is_columnar_file(path):
+        return load_columnar(path)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _event_depth(data: list) -> int:
+    """Find the nesting depth of the lists containing the events"""
+    depth = 1
+    while isinstance(data, list) and len(data) > 0 and isinstance(data[0], (list, EventBlock)):
+        data = data[0]
+        depth += 1
+    return depth
+
+
+def _outer_shape(data: list, depth: int) -> tuple:
+    shape = []
+    for _ in range(depth - 1):
+        shape.append(len(data))
+        data = data[0] if len(data) > 0 else []
+    return tuple(shape)
+
+
+def _iter_event_lists(data: list, depth: int):
+    if depth == 1:
+        yield data
+    else:
+        for x in data:
+            yield from _iter_event_lists(x, depth - 1)
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _to_descr(descr):
+    """Convert a dtype descr loaded from JSON back to the form numpy expects"""
+    if isinstance(descr, str):
+        return descr
+    fields = []
+    for name, field_descr, *shape in descr:
+        fields.append((name, _to_descr(field_descr), *(tuple(x) for x in shape)))
+    return fields
+
+
+def _encode_json(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, datetime):
+        return {'__datetime__': obj.isoformat()}
+    if isinstance(obj, Path):
+        return str(obj)
+    raise TypeError(f'Cannot store {type(obj).__name__} in columnar metadata')
+
+
+def _decode_json(obj: dict):
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    return obj
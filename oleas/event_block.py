@@ -0,0 +1,199 @@
+"""Compact storage for the events captured at a point.
+
+A naludaq event is a dict holding a separate array for every channel, plus its
+metadata. For large sweeps this per-event overhead dominates the memory use.
+An ``EventBlock`` instead copies the samples and window labels of each event into
+preallocated arrays shaped like ``(capture, channel, sample)`` as the event is read
+out, using the narrowest integer dtype which holds the values.
+
+Iterating over a block (or calling ``to_dicts()``) gives back event dicts for code
+which expects them.
+"""
+import numpy as np
+
+
+# per-channel entries of an event, which are not kept as metadata
+_CHANNEL_KEYS = ('data', 'window_labels', 'sample_offset')
+
+
+
+def narrowest_dtype(bits: int, signed: bool = False) -> np.dtype:
+    """Get the narrowest integer dtype holding values of a given number of bits
+
+    Args:
+        bits (int): number of bits of the values, e.g. the ADC resolution
+        signed (bool): whether the values can be negative
+
+    Returns:
+        np.dtype: the dtype
+    """
+    for dtype in ((np.int8, np.int16, np.int32, np.int64) if signed else (np.uint8, np.uint16, np.uint32, np.uint64)):
+        if np.iinfo(dtype).bits >= bits + signed:
+            return np.dtype(dtype)
+    raise ValueError(f'No integer dtype holds {bits} bits')
+
+
+class EventBlock:
+    """Compact container for the events captured at a single point.
+
+    The arrays are allocated when the first event is added, and grow if a later
+    event has more channels, samples or windows, or values which do not fit the dtype.
+    Only scalar metadata is kept. Other per-channel entries of the events (e.g. raw data)
+    are dropped.
+    """
+    __slots__ = (
+        '_count',
+        '_data',
+        '_window_labels',
+        '_lengths',
+        '_window_counts',
+        '_sample_offset',
+        '_metadata',
+    )
+
+    def __init__(self, capacity: int, dtype=np.uint16):
+        """Constructor.
+
+        Args:
+            capacity (int): expected number of events, e.g. the number of captures
+            dtype: integer dtype to store the samples with. Use ``narrowest_dtype()``
+                with the ADC resolution of the board.
+        """
+        self._count = 0
+        self._data = np.zeros((capacity, 0, 0), dtype=dtype)
+        self._window_labels = np.zeros((capacity, 0, 0), dtype=np.uint16)
+        self._lengths = np.zeros((capacity, 0), dtype=np.int32)
+        self._window_counts = np.zeros((capacity, 0), dtype=np.int32)
+        self._sample_offset: np.ndarray = None
+        self._metadata: list[dict] = []
+
+    @classmethod
+    def from_events(cls, events: list[dict], dtype=np.uint16) -> 'EventBlock':
+        """Create a block holding a list of events"""
+        block = cls(len(events), dtype)
+        block.extend(events)
+        return block
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self[i]
+
+    def __getitem__(self, index: int) -> dict:
+        """Get an event as a dict. The arrays are views into the block."""
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('Event index out of range')
+        event = dict(self._metadata[index])
+        lengths = self._lengths[index]
+        window_counts = self._window_counts[index]
+        event['data'] = [self._data[index, i, :n] for i, n in enumerate(lengths)]
+        event['window_labels'] = [self._window_labels[index, i, :n] for i, n in enumerate(window_counts)]
+        if self._sample_offset is not None:
+            event['sample_offset'] = self._sample_offset[index].tolist()
+        return event
+
+    @property
+    def data(self) -> np.ndarray:
+        """Samples shaped like ``(capture, channel, sample)``. Missing samples are zero."""
+        return self._data[:self._count]
+
+    @property
+    def window_labels(self) -> np.ndarray:
+        """Window labels shaped like ``(capture, channel, window)``. Missing windows are zero."""
+        return self._window_labels[:self._count]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Number of samples of each capture and channel"""
+        return self._lengths[:self._count]
+
+    @property
+    def nbytes(self) -> int:
+        return self._data.nbytes + self._window_labels.nbytes + self._lengths.nbytes + self._window_counts.nbytes
+
+    def array(self, key: str) -> np.ndarray:
+        """Get the array for an event key (``'data'`` or ``'window_labels'``)"""
+        if key == 'data':
+            return self.data
+        if key == 'window_labels':
+            return self.window_labels
+        raise KeyError(key)
+
+    def append(self, event: dict):
+        """Copy an event into the block"""
+        data = [np.asarray(x) for x in event['data']]
+        window_labels = [np.asarray(x) for x in event['window_labels']]
+        num_channels = max(len(data), len(window_labels))
+        num_samples = max([len(x) for x in data], default=0)
+        num_windows = max([len(x) for x in window_labels], default=0)
+        self._reserve(self._count + 1, num_channels, num_samples, num_windows)
+        self._fit_dtype('_data', data)
+        self._fit_dtype('_window_labels', window_labels)
+
+        index = self._count
+        for i, samples in enumerate(data):
+            self._data[index, i, :len(samples)] = samples
+            self._lengths[index, i] = len(samples)
+        for i, labels in enumerate(window_labels):
+            self._window_labels[index, i, :len(labels)] = labels
+            self._window_counts[index, i] = len(labels)
+        if 'sample_offset' in event:
+            if self._sample_offset is None:
+                self._sample_offset = np.zeros(self._lengths.shape, dtype=np.int32)
+            self._sample_offset[index, :len(event['sample_offset'])] = event['sample_offset']
+        self._metadata.append({
+            key: value for key, value in event.items()
+            if key not in _CHANNEL_KEYS and not isinstance(value, (list, tuple, np.ndarray, bytes, bytearray))
+        })
+        self._count += 1
+
+    def extend(self, events: list[dict]):
+        for event in events:
+            self.append(event)
+
+    def to_dicts(self) -> list[dict]:
+        """Convert the block to a list of event dicts"""
+        return list(self)
+
+    def _reserve(self, count: int, num_channels: int, num_samples: int, num_windows: int):
+        """Grow the arrays to hold at least the given number of events, channels, samples and windows"""
+        capacity, channels, samples = self._data.shape
+        windows = self._window_labels.shape[2]
+        if count <= capacity and num_channels <= channels and num_samples <= samples and num_windows <= windows:
+            return
+        capacity = max(capacity, count) if count <= capacity else max(count, 2 * capacity)
+        channels = max(channels, num_channels)
+        samples = max(samples, num_samples)
+        windows = max(windows, num_windows)
+        self._data = _resized(self._data, (capacity, channels, samples))
+        self._window_labels = _resized(self._window_labels, (capacity, channels, windows))
+        self._lengths = _resized(self._lengths, (capacity, channels))
+        self._window_counts = _resized(self._window_counts, (capacity, channels))
+        if self._sample_offset is not None:
+            self._sample_offset = _resized(self._sample_offset, (capacity, channels))
+
+    def _fit_dtype(self, name: str, arrays: list[np.ndarray]):
+        """Promote the dtype of an array if the values do not fit in it"""
+        array = getattr(self, name)
+        arrays = [x for x in arrays if x.size > 0]
+        if len(arrays) == 0:
+            return
+        if any(x.dtype.kind == 'f' and not np.array_equal(x, np.round(x)) for x in arrays):
+            raise ValueError('EventBlock only holds integer values')
+        low = int(min(x.min() for x in arrays))
+        high = int(max(x.max() for x in arrays))
+        info = np.iinfo(array.dtype)
+        if info.min <= low and high <= info.max:
+            return
+        dtype = np.result_type(array.dtype, np.min_scalar_type(low), np.min_scalar_type(high))
+        setattr(self, name, array.astype(dtype))
+
+
+def _resized(array: np.ndarray, shape: tuple) -> np.ndarray:
+    output = np.zeros(shape, dtype=array.dtype)
+    output[tuple(slice(0, n) for n in array.shape)] = array
+    return output
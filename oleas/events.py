@@ -0,0 +1,186 @@
+"""Event-driven waiting on the daq output buffer.
+
+``DebugDaq`` appends parsed events to its ``output_buffer`` deque from a worker
+thread. Replacing the buffer with a ``NotifyingDeque`` lets consumers block
+until events arrive instead of polling the buffer.
+"""
+from collections import deque
+import logging
+import threading
+import time
+
+from oleas.timing import NULL_TIMER, SpanTimer
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class NotifyingDeque(deque):
+    """A deque which wakes up waiting consumers whenever items are appended.
+
+    The time between the most recent append and the wake-up of a waiting consumer
+    is recorded, which is useful for profiling the acquisition.
+    """
+
+    def __init__(self, iterable=(), maxlen=None):
+        super().__init__(iterable, maxlen)
+        self._condition = threading.Condition()
+        self._last_append_time = None
+        self._num_wakeups = 0
+        self._total_latency = 0.0
+        self._max_latency = 0.0
+
+    def append(self, item):
+        with self._condition:
+            super().append(item)
+            self._last_append_time = time.perf_counter()
+            self._condition.notify_all()
+
+    def extend(self, items):
+        with self._condition:
+            super().extend(items)
+            self._last_append_time = time.perf_counter()
+            self._condition.notify_all()
+
+    def wait_for(self, amount: int = 1, timeout: float = None) -> bool:
+        """Block until the deque holds at least ``amount`` items.
+
+        Args:
+            amount (int): number of items to wait for
+            timeout (float): maximum time to wait in seconds, or None to wait forever.
+
+        Returns:
+            bool: True if the items are available, False if the timeout elapsed.
+        """
+        with self._condition:
+            if len(self) >= amount:
+                return True
+            available = self._condition.wait_for(lambda: len(self) >= amount, timeout)
+            if available:
+                self._record_wakeup(time.perf_counter() - self._last_append_time)
+            return available
+
+    @property
+    def latency_stats(self) -> dict:
+        """Wake-up latency statistics in seconds, as a dict with
+        ``'count'``, ``'mean'`` and ``'max'``.
+        """
+        count = self._num_wakeups
+        return {
+            'count': count,
+            'mean': self._total_latency / count if count else 0.0,
+            'max': self._max_latency,
+        }
+
+    def reset_latency_stats(self):
+        self._num_wakeups = 0
+        self._total_latency = 0.0
+        self._max_latency = 0.0
+
+    def _record_wakeup(self, latency: float):
+        self._num_wakeups += 1
+        self._total_latency += latency
+        self._max_latency = max(self._max_latency, latency)
+
+
+def notify_on_append(daq) -> deque:
+    """Replace the output buffer of the daq with a ``NotifyingDeque``.
+
+    Must be called before the daq starts capturing.
+
+    Args:
+        daq (DebugDaq): the daq
+
+    Returns:
+        deque: the new output buffer, or the original buffer if it could not be replaced.
+    """
+    buffer = daq.output_buffer
+    if isinstance(buffer, NotifyingDeque):
+        return buffer
+    try:
+        daq.output_buffer = NotifyingDeque(buffer, maxlen=buffer.maxlen)
+    except AttributeError:
+        logger.warning('Cannot replace the daq output buffer, falling back to polling')
+    return daq.output_buffer
+
+
+def wait_for_events(buffer: deque, amount: int = 1, timeout: float = 1, interval: float = 0.001):
+    """Wait until the buffer holds at least ``amount`` events.
+
+    Wakes up as soon as an event is appended if the buffer is a ``NotifyingDeque``,
+    otherwise the buffer is polled every ``interval`` seconds.
+
+    Args:
+        buffer (deque): the daq output buffer
+        amount (int): number of events to wait for
+        timeout (float): maximum time to wait in seconds
+        interval (float): polling interval in seconds, used only for plain deques.
+
+    Raises:
+        TimeoutError: if the events did not arrive in time.
+    """
+    if isinstance(buffer, NotifyingDeque):
+        available = buffer.wait_for(amount, timeout)
+    else:
+        deadline = time.perf_counter() + timeout
+        while len(buffer) < amount and time.perf_counter() < deadline:
+            time.sleep(interval)
+        available = len(buffer) >= amount
+    if not available:
+        raise TimeoutError(f'Timed out waiting for {amount} events')
+
+
+def read_burst(
+        buffer: deque,
+        amount: int,
+        trigger=None,
+        attempts: int = 5,
+        timeout: float = 0.5,
+        trigger_interval: float = 0,
+        timer: SpanTimer = NULL_TIMER,
+        output: list = None,
+    ) -> list:
+    """Read a burst of events: trigger ``amount`` events back-to-back, then drain them in bulk.
+
+    If some events are missing after waiting, only the missing events are
+    triggered again on the next attempt.
+
+    Args:
+        buffer (deque): the daq output buffer
+        amount (int): number of events to read
+        trigger (callable): function which issues a single trigger, or None if
+            the board is triggered some other way (e.g. the OLEAS trigger).
+        attempts (int): maximum number of attempts
+        timeout (float): time to wait per missing event in seconds
+        trigger_interval (float): time to wait between triggers in seconds.
+        timer (SpanTimer): records the ``'trigger'`` and ``'wait'`` spans and counts ``'retries'``.
+        output (list): empty container to append the events to as they are taken from the
+            buffer, e.g. an ``oleas.stats.StatsCollector``. Defaults to a new list.
+
+    Returns:
+        list: ``output`` holding the events read. Contains fewer than ``amount`` events if
+            the maximum number of attempts was reached.
+    """
+    output = [] if output is None else output
+    for attempt in range(attempts):
+        if attempt > 0:
+            timer.count('retries')
+        missing = amount - len(output)
+        if trigger is not None:
+            with timer.span('trigger'):
+                for _ in range(missing):
+                    trigger()
+                    if trigger_interval:
+                        time.sleep(trigger_interval)
+        try:
+            with timer.span('wait'):
+                wait_for_events(buffer, amount=missing, timeout=timeout * missing)
+        except TimeoutError:
+            pass
+        while len(buffer) > 0 and len(output) < amount:
+            output.append(buffer.popleft())
+        if len(output) >= amount:
+            break
+        logger.info('Got %s/%s events, trying again for the missing events...', len(output), amount)
+    return output
@@ -0,0 +1,96 @@
+"""Per-event pulse features.
+
+Calibration only needs a few numbers per event and channel, rather than the
+full waveforms. These are extracted for a whole batch of events at once into a
+structured array with one record per channel:
+
+- ``'baseline'``: the median of the samples
+- ``'amplitude'``: the peak height above the baseline
+- ``'peak_sample'``: the sample index of the peak
+- ``'integral'``: the sum of the samples above the baseline within the gate
+"""
+import numpy as np
+
+from oleas.columnar import events_to_array
+from oleas.helpers import correct_pedestals_array
+
+
+FEATURE_DTYPE = np.dtype([
+    ('baseline', np.float32),
+    ('amplitude', np.float32),
+    ('peak_sample', np.int32),
+    ('integral', np.float32),
+])
+
+
+
+def extract_features(samples: np.ndarray, gate: tuple = None) -> np.ndarray:
+    """Extract the pulse features of a batch of events.
+
+    Args:
+        samples (np.ndarray): samples shaped like ``(..., channel, sample)``
+        gate (tuple): ``(start, stop)`` sample range to integrate over.
+            Defaults to all samples.
+
+    Returns:
+        np.ndarray: array of ``FEATURE_DTYPE`` shaped like ``(..., channel)``
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    features = np.zeros(samples.shape[:-1], dtype=FEATURE_DTYPE)
+    if samples.shape[-1] == 0:
+        return features
+
+    baseline = np.median(samples, axis=-1)
+    peak_sample = np.argmax(samples, axis=-1)
+    peak = np.take_along_axis(samples, peak_sample[..., np.newaxis], axis=-1)[..., 0]
+    gated = samples if gate is None else samples[..., slice(*gate)]
+
+    features['baseline'] = baseline
+    features['amplitude'] = peak - baseline
+    features['peak_sample'] = peak_sample
+    features['integral'] = np.sum(gated, axis=-1) - baseline * gated.shape[-1]
+    return features
+
+
+def extract_event_features(events: list[dict], gate: tuple = None, pedestals: dict = None) -> np.ndarray:
+    """Extract the pulse features of a list of events.
+
+    Args:
+        events (list[dict]): the events
+        gate (tuple): ``(start, stop)`` sample range to integrate over.
+            Defaults to all samples.
+        pedestals (dict): if given, the events are pedestals corrected first.
+
+    Returns:
+        np.ndarray: array of ``FEATURE_DTYPE`` shaped like ``(capture, channel)``
+    """
+    if len(events) == 0:
+        return np.zeros((0, 0), dtype=FEATURE_DTYPE)
+    samples, _ = events_to_array(events)
+    if pedestals is not None:
+        window_labels, _ = events_to_array(events, key='window_labels')
+        samples = correct_pedestals_array(samples, window_labels, pedestals)
+    return extract_features(samples, gate)
+
+
+def stack_features(tables: list) -> tuple[np.ndarray, np.ndarray]:
+    """Stack per-point feature tables into a single array.
+
+    Missing captures and channels are zero-filled.
+
+    Args:
+        tables (list[np.ndarray]): feature tables shaped like ``(capture, channel)``.
+            Entries may be None for points without a table.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: the features shaped like ``(point, capture, channel)``
+            and the number of captures of each point.
+    """
+    tables = [np.zeros((0, 0), dtype=FEATURE_DTYPE) if x is None else x for x in tables]
+    num_captures = max([x.shape[0] for x in tables], default=0)
+    num_channels = max([x.shape[1] for x in tables], default=0)
+    output = np.zeros((len(tables), num_captures, num_channels), dtype=FEATURE_DTYPE)
+    for i, table in enumerate(tables):
+        output[i, :table.shape[0], :table.shape[1]] = table
+    counts = np.array([x.shape[0] for x in tables], dtype=np.int32)
+    return output, counts
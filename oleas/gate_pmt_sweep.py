@@ -1,26 +1,31 @@
+from contextlib import contextmanager, nullcontext
 import logging
 import time
 
 import numpy as np
 
-from naludaq.communication import ControlRegisters
 from naludaq.daq import DebugDaq
-from naludaq.controllers import (
-    get_board_controller,
-)
-from naludaq.tools.waiter import EventWaiter
 
+from oleas.backend import get_board_controller, get_board_lock
+import oleas.features as features
 import oleas.helpers as helpers
+import oleas.roi as roi
+import oleas.settling as settling
+from oleas.event_block import EventBlock, narrowest_dtype
+from oleas.events import NotifyingDeque, read_burst, wait_for_events
 from oleas.exceptions import DataCaptureError, SensorError
 from oleas.mcp4725 import Mcp4725
 from oleas.mcp4728 import Mcp4728
 from oleas.nd_sweep import NdSweep
-from oleas.telemetry import read_sensors
+from oleas.stats import RunningStats, StatsCollector
+from oleas.telemetry import TelemetrySampler
+from oleas.timing import SpanTimer
 
 
 logger = logging.getLogger(__name__)
 EVENT_TIMEOUT = 0.5 # seconds
-EVENT_POLLING_INTERVAL = 0.001 # seconds
+EVENT_POLLING_INTERVAL = 0.001 # seconds, only used if the daq buffer cannot notify
+DAC_RESOLUTION = 1 / 4095 # normalized value of one 12-bit DAC code
 
 
 class GateDelayPmtDacSweep(NdSweep):
@@ -34,18 +39,92 @@ class GateDelayPmtDacSweep(NdSweep):
         ):
         super().__init__([delay, dac])
         self._board = board
+        self._board_lock = get_board_lock(board)
+        self._session: helpers.ReadoutSession = None
         self._daq: DebugDaq = None
+        self._board_controller = None
         self._attempts = 5
         self._num_captures = num_captures
 
         self._pmt_settle_time: float = 0
+        self._adaptive_settling: dict = None
         self._read_window = None
+        self._roi = None
+        self._compact_events = False
+        self._burst = False
+        self._trigger_interval: float = 0
+        self._running_stats: dict = None
+        self._feature_extraction: dict = None
+        self._timer = SpanTimer(enabled=False)
+        self._telemetry: TelemetrySampler = None
+        self._window_start: float = None
 
         # configuration for the MCP4728
         self._dac_channel = 0
         self._dac_vref = 0
         self._dac_gain = 1
 
+        # extra information recorded for each point, e.g. the settling time
+        self._point_info: dict[tuple, dict] = {}
+        self._point_stats: dict[tuple, dict] = {}
+        self._point_features: dict[tuple, np.ndarray] = {}
+        self._point_timing: dict[tuple, dict] = {}
+        self._point_telemetry: dict[tuple, dict] = {}
+        self._pending_info: dict = {}
+
+    @property
+    def point_info(self) -> dict[tuple, dict]:
+        """Information recorded at each point of the last sweep, by point index
+        (or by point coordinates for ``run_adaptive()``).
+
+        Contains ``'settle_time'``, the time in seconds spent waiting for the PMT
+        to settle before capturing at the point.
+        """
+        return self._point_info
+
+    @property
+    def point_stats(self) -> dict[tuple, dict]:
+        """Statistics of the events captured at each point of the last sweep, keyed
+        like ``point_info``. Only recorded if enabled with ``set_running_stats()``.
+        See ``RunningStats.to_dict()``.
+        """
+        return self._point_stats
+
+    @property
+    def point_features(self) -> dict[tuple, np.ndarray]:
+        """Pulse features of the events captured at each point of the last sweep, keyed
+        like ``point_info``. Only recorded if enabled with ``set_feature_extraction()``.
+        Each entry is an array of ``oleas.features.FEATURE_DTYPE`` shaped like ``(capture, channel)``.
+        """
+        return self._point_features
+
+    @property
+    def point_timing(self) -> dict[tuple, dict]:
+        """Time spent in each phase at each point of the last sweep, keyed like ``point_info``.
+        Only recorded if enabled with ``set_timing()``. See ``SpanTimer.take()``.
+
+        The phases are ``'set_delay'``, ``'set_dac'``, ``'settle'``, ``'trigger'``, ``'wait'``,
+        ``'roi'``, ``'stats'`` and ``'features'``. The number of capture retries is counted
+        under ``'retries'``. Setting the axis values is attributed to the point being moved to.
+        """
+        return self._point_timing
+
+    @property
+    def point_telemetry(self) -> dict[tuple, dict]:
+        """Board telemetry overlapping each point of the last sweep, keyed like ``point_info``.
+        Only recorded if a sampler is given with ``set_telemetry()``. See ``TelemetrySampler.window()``.
+
+        The window of a point starts when the previous point finished, so it covers moving to
+        the point and settling as well as capturing.
+        """
+        return self._point_telemetry
+
+    def timing_summary(self) -> dict:
+        """Totals of the timing of the last sweep. See ``SpanTimer.summary()``
+        and ``oleas.timing.format_summary()``.
+        """
+        return self._timer.summary()
+
     def configure_dac(self, channel: int, vref: int, gain: int):
         """Set the MCP4728 DAC configuration to use.
 
@@ -66,18 +145,194 @@ class GateDelayPmtDacSweep(NdSweep):
         """
         self._pmt_settle_time = t
 
+    def set_adaptive_settling(
+            self,
+            tolerance: float,
+            max_time: float,
+            channel: int = 0,
+            statistic: str = 'baseline',
+            consecutive: int = 2,
+        ):
+        """Detect when the PMT has settled instead of waiting a fixed time.
+
+        After each DAC change, single probe events are captured until the statistic
+        of ``consecutive`` successive probes changes by no more than ``tolerance``,
+        or until ``max_time`` has elapsed. See ``oleas.settling``.
+
+        Args:
+            tolerance (float): maximum change of the statistic between probes, in ADC counts.
+            max_time (float): maximum time to wait in seconds.
+            channel (int): board channel to probe.
+            statistic (str): ``'baseline'`` or ``'amplitude'``.
+            consecutive (int): number of consecutive stable probes required.
+        """
+        if statistic not in settling.STATISTICS:
+            raise ValueError(f'Unknown statistic: {statistic}')
+        self._adaptive_settling = {
+            'tolerance': tolerance,
+            'max_time': max_time,
+            'channel': channel,
+            'statistic': statistic,
+            'consecutive': consecutive,
+        }
+
+    def set_burst_mode(self, enabled: bool, trigger_interval: float = 0):
+        """Set whether to capture events in bursts.
+
+        In burst mode, all triggers for a point are issued back-to-back and the events
+        are drained from the buffer in bulk afterwards. Retries only trigger the missing
+        events. Otherwise each event is triggered and read before the next trigger.
+
+        Args:
+            enabled (bool): True to enable burst mode
+            trigger_interval (float): time to wait between triggers in seconds
+        """
+        self._burst = enabled
+        self._trigger_interval = trigger_interval
+
+    def set_running_stats(self, enabled: bool, summary_only: bool = False, pedestals: dict = None):
+        """Set whether to compute the mean, variance, minimum and maximum of the
+        events at each point as they are captured.
+
+        Args:
+            enabled (bool): True to compute the statistics
+            summary_only (bool): if True, the events are dropped as soon as they are folded in.
+                The result of each point is then ``{'stats': ...}`` instead of its events
+                (see ``_run_for_point()``). Memory use and output size then no longer depend
+                on the number of captures, unless feature extraction is enabled too, which
+                needs the events of the point.
+            pedestals (dict): if given, the statistics are computed over pedestals corrected events.
+        """
+        if enabled:
+            self._running_stats = {'summary_only': summary_only, 'pedestals': pedestals}
+        else:
+            self._running_stats = None
+
+    def set_feature_extraction(
+            self,
+            enabled: bool,
+            features_only: bool = False,
+            gate: tuple = None,
+            pedestals: dict = None,
+        ):
+        """Set whether to extract the pulse features of the events at each point as
+        they are captured. See ``oleas.features``.
+
+        Args:
+            enabled (bool): True to extract the features
+            features_only (bool): if True, the events are dropped once the features are
+                extracted. The result of each point is then ``{'features': ...}`` instead
+                of its events (see ``_run_for_point()``).
+            gate (tuple): ``(start, stop)`` sample range to integrate over. Defaults to all samples.
+            pedestals (dict): if given, the features are extracted from pedestals corrected events.
+        """
+        if enabled:
+            self._feature_extraction = {'features_only': features_only, 'gate': gate, 'pedestals': pedestals}
+        else:
+            self._feature_extraction = None
+
+    def set_roi(self, roi, samples_per_window: int = None):
+        """Crop the events captured at each point to a region of interest, before they
+        are stored or corrected. See ``oleas.roi``.
+
+        Args:
+            roi (tuple | dict | callable): ``(start, stop)`` sample range for all channels, a dict
+                of sample ranges by channel, or a function taking the gate delay of the point
+                and returning either of those (e.g. using ``oleas.roi.roi_from_gate()``).
+                None to disable cropping.
+            samples_per_window (int): number of samples per window. Defaults to the board's.
+        """
+        if roi is None:
+            self._roi = None
+            return
+        if samples_per_window is None:
+            samples_per_window = self._board.params['samples']
+        self._roi = {'roi': roi, 'samples_per_window': samples_per_window}
+
+    def set_compact_events(self, enabled: bool):
+        """Set whether to store the events of each point in an ``EventBlock`` instead of
+        a list of event dicts. Each event is copied into the block as it is read out.
+        Iterating over a block gives back event dicts.
+
+        Args:
+            enabled (bool): True to use compact event storage
+        """
+        self._compact_events = enabled
+
+    def set_timing(self, enabled: bool):
+        """Set whether to time the phases of each point. See ``point_timing``.
+
+        Args:
+            enabled (bool): True to record the timing
+        """
+        self._timer = SpanTimer(enabled)
+
+    def set_telemetry(self, sampler: TelemetrySampler):
+        """Annotate each point with the telemetry sampled while it ran. See ``point_telemetry``.
+
+        The sampler is not started or stopped by the sweep. Since sensors are only read
+        while the readout is paused, the readout is paused while moving to each point
+        (including the PMT settling time, unless adaptive settling is enabled).
+
+        Args:
+            sampler (TelemetrySampler): sampler for the board, or None to disable
+        """
+        self._telemetry = sampler
+
     def set_read_window(self, read_window: dict):
         """Set readwindow. Needs to be a dict containing 'windows', 'lookback', and
         'write_after_trig'.
         """
         self._read_window = read_window
 
-    def run(self) -> list:
+    def run(self, checkpoint=None, resume: bool = False) -> list:
         """Run the gate delay/PMT dac sweep"""
         logger.info('Running sweep')
-        with helpers.readout(self._board, self._read_window) as daq:
+        return super().run(checkpoint, resume)
+
+    def run_adaptive(self, metric, threshold: float, max_points: int, min_step: list = None) -> dict:
+        """Run a coarse-to-fine gate delay/PMT dac sweep. See ``NdSweep.run_adaptive()``."""
+        logger.info('Running adaptive sweep')
+        return super().run_adaptive(metric, threshold, max_points, min_step)
+
+    @contextmanager
+    def _sweep_context(self):
+        self._point_info = {}
+        self._point_stats = {}
+        self._point_features = {}
+        self._point_timing = {}
+        self._point_telemetry = {}
+        self._timer.reset()
+        self._window_start = time.time()
+        with helpers.ReadoutSession(self._board, self._read_window) as session:
+            daq = session.daq
+            self._session = session
             self._daq = daq
-            return super().run()
+            self._board_controller = get_board_controller(self._board)
+            try:
+                yield
+            finally:
+                if isinstance(daq.output_buffer, NotifyingDeque):
+                    logger.debug('Event wake-up latency: %s', daq.output_buffer.latency_stats)
+                self._session = None
+                self._daq = None
+                self._board_controller = None
+
+    def _move_to(self, index: tuple, previous: 'tuple | None'):
+        with self._telemetry_pause():
+            super()._move_to(index, previous)
+
+    def _move_to_point(self, point: tuple):
+        with self._telemetry_pause():
+            super()._move_to_point(point)
+
+    def _telemetry_pause(self):
+        """Pause the readout while moving to the next point if telemetry is enabled,
+        so the sensors can be read in the meantime.
+        """
+        if self._telemetry is None:
+            return nullcontext()
+        return self._session.paused()
 
     def _set_axis_value(self, axis: int, value: int, index: int):
         super()._set_axis_value(axis, value, index)
@@ -87,31 +342,129 @@ class GateDelayPmtDacSweep(NdSweep):
         elif axis == 1:
             self._set_dac(value)
 
-    def _run_for_point(self) -> list[dict]:
+    def _axis_resolution(self, axis: int) -> float:
+        # the delay register holds an integer, the DAC has 12 bits
+        return 1 if axis == 0 else DAC_RESOLUTION
+
+    def _run_for_point(self) -> 'list[dict] | EventBlock | dict':
         """Capture events at the current (delay, dac) coordinate
 
         Returns:
-            list[dict]: list of events
+            list[dict] | EventBlock | dict: list of events, or an ``EventBlock`` if compact
+                events are enabled. If the events are dropped in summary-only or
+                features-only mode, a dict holding the ``'stats'`` and/or ``'features'`` of the
+                events instead.
         """
         logger.info('Capturing for next point %s', self.current_point)
-        bc = get_board_controller(self._board)
+        info = {'settle_time': 0.0}
+        info.update(self._pending_info)
+        self._pending_info = {}
+        output, stats = self._capture_events()
+        key = self._point_key()
+        self._point_info[key] = info
+        summary = {}
+        keep_events = True
+        if stats is not None:
+            summary['stats'] = self._point_stats[key] = stats.to_dict()
+            keep_events &= not self._running_stats['summary_only']
+        if self._feature_extraction is not None:
+            config = self._feature_extraction
+            with self._timer.span('features'):
+                summary['features'] = self._point_features[key] = features.extract_event_features(
+                    output, gate=config['gate'], pedestals=config['pedestals'],
+                )
+            keep_events &= not config['features_only']
+        if self._timer.enabled:
+            self._point_timing[key] = self._timer.take()
+        if self._telemetry is not None:
+            now = time.time()
+            self._point_telemetry[key] = self._telemetry.window(self._window_start, now)
+            self._window_start = now
+        return output if keep_events else summary
+
+    def _point_annotations(self, key: tuple) -> dict:
+        return {name: table[key] for name, table in self._annotation_tables().items() if key in table}
+
+    def _restore_annotations(self, key: tuple, annotations: 'dict | None'):
+        tables = self._annotation_tables()
+        for name, value in (annotations or {}).items():
+            tables[name][key] = value
+
+    def _annotation_tables(self) -> dict[str, dict]:
+        """The per-point information which is journaled with the results"""
+        return {
+            'info': self._point_info,
+            'stats': self._point_stats,
+            'features': self._point_features,
+            'timing': self._point_timing,
+            'telemetry': self._point_telemetry,
+        }
+
+    def _trigger(self):
+        """Issue a single trigger, holding the board lock"""
+        with self._board_lock:
+            self._board_controller.toggle_trigger()
+
+    def _capture_events(self) -> 'tuple[list[dict] | EventBlock | None, RunningStats | None]':
+        """Trigger and read out ``num_captures`` events.
+
+        Each event is cropped to the region of interest, folded into the running
+        statistics and added to the output as soon as it is taken from the buffer.
+
+        Returns:
+            tuple: the events, and their ``RunningStats`` if enabled. The events are
+                None if they are only folded into the statistics (summary-only mode
+                without feature extraction).
+
+        Raises:
+            DataCaptureError: if the maximum number of attempts was reached.
+        """
         buffer = self._daq.output_buffer
         num_captures = self._num_captures
         attempts = self._attempts
-        output = []
+        output = self._new_output()
+        sink = output
+        stats = None
+        if self._running_stats is not None:
+            # the features are extracted from the kept events, so they can only be dropped without them
+            if self._running_stats['summary_only'] and self._feature_extraction is None:
+                output = None
+            sink = StatsCollector(self._running_stats['pedestals'], events=output, timer=self._timer)
+            stats = sink.stats
+
+        if self._burst:
+            buffer.clear()
+            read_burst(
+                buffer,
+                num_captures,
+                trigger=self._trigger,
+                attempts=attempts,
+                timeout=EVENT_TIMEOUT,
+                trigger_interval=self._trigger_interval,
+                timer=self._timer,
+                output=_PreparedEvents(self._prepare_event, sink),
+            )
+            if len(sink) < num_captures:
+                logger.error('Maximum number of attempts reached. Aborting.')
+                raise DataCaptureError('Maximum number of attempts reached')
+            return output, stats
 
         # Read out events
+        timer = self._timer
         for _ in range(num_captures):
-            bc.toggle_trigger()
+            with timer.span('trigger'):
+                self._trigger()
 
             for _ in range(attempts):
                 try:
-                    waiter = EventWaiter(buffer, amount=1, timeout=EVENT_TIMEOUT, interval=EVENT_POLLING_INTERVAL)
-                    waiter.start(blocking=True)
-                    output.append(buffer.popleft())
+                    with timer.span('wait'):
+                        wait_for_events(buffer, amount=1, timeout=EVENT_TIMEOUT, interval=EVENT_POLLING_INTERVAL)
+                    sink.append(self._prepare_event(buffer.popleft()))
                 except (TimeoutError, IndexError):
                     logger.info('Failed to get event, trying again...')
-                    bc.toggle_trigger()
+                    timer.count('retries')
+                    with timer.span('trigger'):
+                        self._trigger()
                     continue
                 else:
                     break
@@ -119,22 +472,90 @@ class GateDelayPmtDacSweep(NdSweep):
                 logger.error('Maximum number of attempts reached. Aborting.')
                 raise DataCaptureError('Maximum number of attempts reached')
 
-        return output
+        return output, stats
+
+    def _new_output(self) -> 'list[dict] | EventBlock':
+        """Create the container for the events of a point"""
+        if not self._compact_events:
+            return []
+        dtype = narrowest_dtype(self._board.params.get('resolution', 16))
+        return EventBlock(self._num_captures, dtype)
+
+    def _prepare_event(self, event: dict) -> dict:
+        """Crop an event captured at the current point to the region of interest"""
+        if self._roi is None:
+            return event
+        point_roi = self._roi['roi']
+        if callable(point_roi):
+            point_roi = point_roi(self.current_point[0])
+        with self._timer.span('roi'):
+            return roi.crop_event(event, point_roi, self._roi['samples_per_window'])
 
     def _set_delay(self, value):
         logger.info('Setting delay to %s', value)
-        self._write_control_register('oleas_delay_a', int(value))
+        with self._timer.span('set_delay'):
+            self._write_control_register('oleas_delay_a', int(value))
 
     def _set_dac(self, value):
         logger.info('Setting dac to %s', value)
         # Mcp4725(self._board).set_normalized_value(value)
-        Mcp4728(self._board).set_normalized_value(
-            channel=self._dac_channel,
-            value=value,
-            vref=self._dac_vref,
-            gain=self._dac_gain,
+        with self._timer.span('set_dac'), self._board_lock:
+            changed = Mcp4728(self._board).set_normalized_value(
+                channel=self._dac_channel,
+                value=value,
+                vref=self._dac_vref,
+                gain=self._dac_gain,
+            )
+        # no need to wait for the PMT if the output didn't change
+        if not changed:
+            return
+        with self._timer.span('settle'):
+            if self._adaptive_settling is None:
+                time.sleep(self._pmt_settle_time)
+                self._pending_info['settle_time'] = self._pmt_settle_time
+            else:
+                self._pending_info['settle_time'] = self._settle_adaptive()
+
+    def _settle_adaptive(self) -> float:
+        """Capture probe events until the PMT has settled.
+
+        Returns:
+            float: the time spent settling in seconds
+        """
+        config = self._adaptive_settling
+        buffer = self._daq.output_buffer
+        # the probes need the readout, which may be paused while moving to the point
+        self._session.resume()
+
+        def probe():
+            events = read_burst(buffer, 1, trigger=self._trigger, attempts=1, timeout=EVENT_TIMEOUT)
+            if len(events) == 0:
+                raise TimeoutError('No probe event')
+            return settling.event_statistic(events[0], config['channel'], config['statistic'])
+
+        buffer.clear()
+        settle_time = settling.wait_for_settle(
+            probe,
+            tolerance=config['tolerance'],
+            max_time=config['max_time'],
+            consecutive=config['consecutive'],
         )
-        time.sleep(self._pmt_settle_time)
+        buffer.clear()
+        return settle_time
 
     def _write_control_register(self, name, value):
-        ControlRegisters(self._board).write(name, value)
+        helpers.write_control_register(self._board, name, value)
+
+
+class _PreparedEvents:
+    """Appends each event to another container after preparing it, e.g. cropping it"""
+
+    def __init__(self, prepare, output):
+        self._prepare = prepare
+        self._output = output
+
+    def __len__(self) -> int:
+        return len(self._output)
+
+    def append(self, event: dict):
+        self._output.append(self._prepare(event))
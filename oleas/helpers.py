@@ -1,17 +1,40 @@
-from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, ExitStack
 import logging
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
 import pickle
 import gzip
+import signal
+import threading
 
-from naludaq.board import Board, startup_board
-from naludaq.communication import ControlRegisters
+import numpy as np
+
+from naludaq.board import Board
 from naludaq.daq import DebugDaq
-from naludaq.controllers import (
+from naludaq.tools.pedestals.pedestals_correcter import PedestalsCorrecter
+
+from oleas.backend import (
     get_board_controller,
-    get_readout_controller,
+    get_board_lock,
+    get_control_registers,
+    get_daq,
     get_gainstage_controller,
+    get_readout_controller,
+    set_readout_active,
+    startup as _startup,
 )
-from naludaq.tools.pedestals.pedestals_correcter import PedestalsCorrecter
+from oleas.columnar import (
+    events_to_array,
+    load_columnar,
+    load_output,
+    save_columnar,
+    save_output_columnar,
+)
+from oleas.events import notify_on_append
+from oleas.pedestals_cache import load_cached_pedestals
+from oleas.shadow import get_shadow_cache, invalidate_shadow_cache
+from oleas.simulation import SimulatedBoard
 
 
 logger = logging.getLogger(__name__)
@@ -27,6 +50,23 @@ def save_pickle(path, obj):
         raise
 
 
+def save_output(path, output: dict, format: str = 'pickle'):
+    """Save a sweep or capture output dict.
+
+    Args:
+        path (Path | str): output file
+        output (dict): the output dict
+        format (str): 'pickle' for a pickle of the output dict, or 'columnar' for a
+            memory-mappable columnar file (see ``oleas.columnar``).
+    """
+    if format == 'pickle':
+        save_pickle(path, output)
+    elif format == 'columnar':
+        save_output_columnar(path, output)
+    else:
+        raise ValueError(f'Unknown output format: {format}')
+
+
 def is_valid_output_file(file) -> bool:
     """Check if file is good for writing"""
     valid = True
@@ -69,6 +109,9 @@ def get_board(serial: str, model: str='aodsoc_aods', baud=None, config: str=None
 def get_board_from_args(args, startup: bool=False) -> Board:
     """Get board from command line arguments
 
+    If ``args.simulate`` is set, a ``SimulatedBoard`` is returned instead of
+    connecting to a real board (see ``oleas.simulation``).
+
     Args:
         startup (bool): whether to start up the board
 
@@ -81,23 +124,47 @@ def get_board_from_args(args, startup: bool=False) -> Board:
     config = args.config
     logger.debug('Board arguments: model=%s, baud=%s, serial=%s, config=%s', model, baud, serial, config)
 
-    try:
+    if getattr(args, 'simulate', False):
+        logger.info('Using a simulated board')
+        board = SimulatedBoard(model)
+    else:
         board = get_board(serial, model, baud, config)
-    except Exception as e:
-        raise e
 
     if startup:
-        startup_board(board)
+        _startup(board)
+        invalidate_shadow_cache(board)
 
     return board
 
 
+def write_control_register(board, name: str, value: int) -> bool:
+    """Write a control register, skipping the write if the register already
+    has the value (see ``oleas.shadow``).
+
+    Args:
+        board (Board): board object
+        name (str): register name
+        value (int): value to write
+
+    Returns:
+        bool: True if the register was written, False if the write was skipped.
+    """
+    with get_board_lock(board):
+        return get_shadow_cache(board).write(
+            ('control', name),
+            value,
+            lambda: get_control_registers(board).write(name, value),
+        )
+
+
 @contextmanager
 def readout(board, read_window: dict) -> DebugDaq:
     """Start a readout/capture for the board.
 
     This function is a context manager. When used in a `with` block,
     it yields a daq object and cleans up properly when the context exits.
+    The output buffer of the daq is a ``NotifyingDeque``, so ``wait_for_events``
+    wakes up as soon as an event arrives.
 
     Example:
     ```
@@ -110,94 +177,455 @@ def readout(board, read_window: dict) -> DebugDaq:
         board (Board): board object
         read_window (tuple): read window as (windows, lookback, write after trigger)
     """
-    rc = get_readout_controller(board)
-    rc.set_read_window(**read_window)
+    lock = get_board_lock(board)
+    with lock:
+        rc = get_readout_controller(board)
+        rc.set_read_window(**read_window)
 
-    logger.info('Starting readout')
+        logger.info('Starting readout')
 
-    daq = DebugDaq(board)
-    bc = get_board_controller(board)
-    daq.start_capture()
-    bc.start_readout('ext')
+        daq = get_daq(board)
+        notify_on_append(daq)
+        bc = get_board_controller(board)
+        daq.start_capture()
+        bc.start_readout('ext')
+        set_readout_active(board, True)
     try:
         yield daq
     except:
         raise
     finally:
         logger.info('Stopping readout')
-        bc = get_board_controller(board)
-        bc.stop_readout()
-        daq.stop_capture()
+        with lock:
+            bc = get_board_controller(board)
+            bc.stop_readout()
+            daq.stop_capture()
+            set_readout_active(board, False)
+
+
+class ReadoutSession:
+    """A readout which stays open across many capture points.
 
+    Built on ``readout()``, but the readout can be paused while the board is
+    reconfigured (registers, DAC) and resumed afterwards without tearing down
+    the daq. Any events left in the buffer are flushed when resuming, so events
+    from the previous point are never mixed with the next one.
+
+    Example:
+    ```
+    with ReadoutSession(board, read_window) as session:
+        for delay in delays:
+            with session.paused():
+                ControlRegisters(board).write('oleas_delay_a', delay)
+            get_board_controller(board).toggle_trigger()
+            ...
+    ```
+    """
 
-def load_pedestals(path) -> dict:
+    def __init__(self, board, read_window: dict):
+        """Constructor.
+
+        Args:
+            board (Board): board object
+            read_window (dict): read window, see ``readout()``
+        """
+        self._board = board
+        self._read_window = read_window
+        self._stack = None
+        self._daq: DebugDaq = None
+        self._running = False
+
+    @property
+    def daq(self) -> DebugDaq:
+        return self._daq
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def __enter__(self) -> 'ReadoutSession':
+        self._stack = ExitStack()
+        self._daq = self._stack.enter_context(readout(self._board, self._read_window))
+        self._running = True
+        return self
+
+    def __exit__(self, *exc):
+        self._running = False
+        self._stack.close()
+        self._daq = None
+
+    def pause(self):
+        """Stop the board readout while leaving the daq running."""
+        if self._running:
+            logger.debug('Pausing readout')
+            with get_board_lock(self._board):
+                get_board_controller(self._board).stop_readout()
+                set_readout_active(self._board, False)
+            self._running = False
+
+    def resume(self):
+        """Flush any leftover events and restart the board readout."""
+        if not self._running:
+            logger.debug('Resuming readout')
+            self.flush()
+            with get_board_lock(self._board):
+                get_board_controller(self._board).start_readout('ext')
+                set_readout_active(self._board, True)
+            self._running = True
+
+    @contextmanager
+    def paused(self):
+        """Context manager which pauses the readout for the duration of the block."""
+        self.pause()
+        try:
+            yield
+        finally:
+            self.resume()
+
+    def flush(self) -> int:
+        """Discard any events in the output buffer.
+
+        Returns:
+            int: number of events discarded
+        """
+        buffer = self._daq.output_buffer
+        count = len(buffer)
+        buffer.clear()
+        if count:
+            logger.debug('Flushed %s leftover events', count)
+        return count
+
+
+def load_pedestals(path, cache: bool = True, cache_dir=None) -> dict:
     """Load pedestals from disk.
 
     Args:
         path (Path | str): path to pedestals file
+        cache (bool): if True, the file is converted to a memory-mapped cache the first
+            time it is loaded, and loaded from the cache afterwards. See ``oleas.pedestals_cache``.
+        cache_dir (Path | str): cache directory. Defaults to ``~/.cache/oleas/pedestals``.
 
     Returns:
-        dict: pedestals dict
+        dict: pedestals dict. A read-only mapping if loaded from the cache.
     """
+    if cache:
+        return load_cached_pedestals(path, cache_dir)
     with gzip.GzipFile(path, 'rb') as f:
         return pickle.load(f)
 
 
-def correct_pedestals(data: list[list[list[dict]]], params: dict, pedestals: dict) -> list[list[list[dict]]]:
+def correct_pedestals(data: list[list[list[dict]]], params: dict, pedestals: dict, workers: 'int | CorrectionPool' = None) -> list[list[list[dict]]]:
     """Apply pedestals correction to the sweep data.
 
     Args:
         data (list[list[list[dict]]]): parsed sweep data
         params (dict): board params
         pedestals (dict): pedestals to use
+        workers (int | CorrectionPool): if given, the ``[delay][dac]`` blocks are corrected
+            in a pool of this many processes, or in the given pool. See ``correct_event_blocks_parallel``.
 
     Returns:
         list[list[list[dict]]]: the pedestals corrected sweep data. Returns [] if there was an error.
     """
-    correct = PedestalsCorrecter(params, pedestals).run
     try:
-        corrected_data = [
-            [
+        if workers:
+            blocks = correct_event_blocks_parallel([dac for delay in data for dac in delay], pedestals, workers)
+            blocks = iter(blocks)
+            corrected_data = [[next(blocks) for _ in delay] for delay in data]
+        else:
+            correct = PedestalsCorrecter(params, pedestals).run
+            corrected_data = [
                 [
-                    correct(event, correct_in_place=False)
-                    for event in dac
-                ] for dac in delay
-            ] for delay in data
-        ]
+                    [
+                        correct(event, correct_in_place=False)
+                        for event in dac
+                    ] for dac in delay
+                ] for delay in data
+            ]
     except Exception as e:
         logger.error('Failed to correct pedestals: %s', e)
         corrected_data = []
     return corrected_data
 
 
-def correct_pedestals_for_capture(data: list[list[dict]], params: dict, pedestals: dict) -> list[list[dict]]:
+def correct_pedestals_for_capture(data: list[list[dict]], params: dict, pedestals: dict, workers: 'int | CorrectionPool' = None) -> list[list[dict]]:
     """Apply pedestals correction to the capture data.
 
     Args:
         data (list[list[dict]]): parsed capture data
         params (dict): board params
         pedestals (dict): pedestals to use
+        workers (int | CorrectionPool): if given, the steps are corrected in a pool of this many
+            processes, or in the given pool. See ``correct_event_blocks_parallel``.
 
     Returns:
         list[list[dict]]: the pedestals corrected capture data. Returns [] if there was an error.
     """
-    correct = PedestalsCorrecter(params, pedestals).run
     try:
-        corrected_data = [
-            [
-                correct(event, correct_in_place=False)
-                for event in step
-            ] for step in data
-        ]
+        if workers:
+            corrected_data = correct_event_blocks_parallel(data, pedestals, workers)
+        else:
+            correct = PedestalsCorrecter(params, pedestals).run
+            corrected_data = [
+                [
+                    correct(event, correct_in_place=False)
+                    for event in step
+                ] for step in data
+            ]
     except Exception as e:
         logger.error('Failed to correct pedestals: %s', e)
         corrected_data = []
     return corrected_data
 
 
+def correct_event_blocks_parallel(blocks: list[list[dict]], pedestals: dict, workers: 'int | CorrectionPool') -> list[list[dict]]:
+    """Apply pedestals correction to blocks of events using a process pool.
+
+    The events are stacked into arrays which are shared with the worker processes
+    through shared memory, so the data is not pickled for each worker. Each worker
+    corrects a contiguous range of blocks. The output does not depend on the number
+    of workers or the order in which the shards complete.
+
+    Args:
+        blocks (list[list[dict]]): lists of events, e.g. the events for each sweep point
+        pedestals (dict): pedestals to use
+        workers (int | CorrectionPool): number of worker processes, or a pool to reuse
+
+    Returns:
+        list[list[dict]]: copies of the events with the corrected data, in the same layout as ``blocks``.
+    """
+    samples, _ = events_to_array(blocks)
+    window_labels, _ = events_to_array(blocks, key='window_labels')
+    corrected = correct_pedestals_parallel(samples, window_labels, pedestals, workers)
+    return [
+        [
+            {
+                **event,
+                'data': [corrected[i, j, k, :len(chan)] for k, chan in enumerate(event['data'])],
+            }
+            for j, event in enumerate(block)
+        ]
+        for i, block in enumerate(blocks)
+    ]
+
+
+def correct_pedestals_parallel(samples: np.ndarray, window_labels: np.ndarray, pedestals: dict, workers: 'int | CorrectionPool') -> np.ndarray:
+    """Same as ``correct_pedestals_array``, but shards the first axis across a process pool.
+
+    The inputs, pedestals and output are placed in shared memory.
+
+    Args:
+        samples (np.ndarray): event samples shaped like ``(block, ..., channel, sample)``
+        window_labels (np.ndarray): window labels shaped like ``(block, ..., channel, window)``
+        pedestals (dict): pedestals to use
+        workers (int | CorrectionPool): number of worker processes, or a pool to reuse.
+            When a pool is given, its pedestals are used instead of ``pedestals``.
+
+    Returns:
+        np.ndarray: the pedestals corrected samples, with the same shape as ``samples``.
+    """
+    if isinstance(workers, CorrectionPool):
+        return workers.correct(samples, window_labels)
+    with CorrectionPool(pedestals, workers) as pool:
+        return pool.correct(samples, window_labels)
+
+
+class CorrectionPool:
+    """Process pool and shared memory for ``correct_pedestals_parallel``, kept open across calls.
+
+    Starting the worker processes and placing the pedestals in shared memory is
+    done once, so repeated corrections (e.g. every capture iteration) only pay for
+    copying the events. The shared memory of the events is reused while it is large enough.
+
+    The workers are spawned (not forked) as soon as the pool is created, so create it
+    before starting any other threads. They ignore ``Control``+``C``, so a correction in
+    progress when the user stops the capture still completes.
+
+    Example:
+    ```
+    with CorrectionPool(board.pedestals, workers=4) as pool:
+        for data in iterations:
+            corrected_data, _ = correct_pedestals_batch(data, board.pedestals, workers=pool)
+    ```
+    """
+
+    def __init__(self, pedestals: dict, workers: int):
+        """Constructor.
+
+        Args:
+            pedestals (dict): pedestals to use
+            workers (int): number of worker processes
+        """
+        self._workers = workers
+        self._pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_ignore_sigint,
+        )
+        # the workers are otherwise started on the first correction, from a worker thread
+        for future in [self._pool.submit(_start_worker) for _ in range(workers)]:
+            future.result()
+        self._lock = threading.Lock()
+        self._shared: dict[str, SharedMemory] = {}
+        self._specs: dict[str, tuple] = {}
+        self._share('pedestals', np.asarray(pedestals['data']))
+
+    def __enter__(self) -> 'CorrectionPool':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def correct(self, samples: np.ndarray, window_labels: np.ndarray) -> np.ndarray:
+        """Correct a stack of events, see ``correct_pedestals_parallel``"""
+        num_blocks = samples.shape[0] if samples.ndim > 0 else 0
+        if num_blocks == 0 or samples.size == 0:
+            return correct_pedestals_array(samples, window_labels, {'data': self._view('pedestals')})
+
+        with self._lock:
+            self._share('samples', samples)
+            self._share('window_labels', window_labels)
+            self._share('output', np.empty(samples.shape, dtype=np.float64), copy=False)
+            shard_size = max(1, num_blocks // (self._workers * 4))
+            shards = [(start, min(start + shard_size, num_blocks)) for start in range(0, num_blocks, shard_size)]
+            for future in [self._pool.submit(_correct_pedestals_shard, self._specs, start, stop) for start, stop in shards]:
+                future.result()
+            return self._view('output').copy()
+
+    def close(self):
+        """Stop the worker processes and free the shared memory"""
+        self._pool.shutdown()
+        for shm in self._shared.values():
+            shm.close()
+            shm.unlink()
+        self._shared.clear()
+        self._specs.clear()
+
+    def _share(self, name: str, array: np.ndarray, copy: bool = True):
+        """Place an array in shared memory, reusing the block for ``name`` if it is large enough"""
+        shm = self._shared.get(name)
+        if shm is None or shm.size < array.nbytes:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+            self._shared[name] = shm
+        self._specs[name] = (shm.name, array.shape, array.dtype.str)
+        if copy:
+            self._view(name)[...] = array
+
+    def _view(self, name: str) -> np.ndarray:
+        _, shape, dtype = self._specs[name]
+        return np.ndarray(shape, dtype, buffer=self._shared[name].buf)
+
+
+def _ignore_sigint():
+    """Initializer of the ``CorrectionPool`` workers, which are stopped by the main process"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _start_worker():
+    """No-op task used to start the ``CorrectionPool`` workers"""
+
+
+def _correct_pedestals_shard(specs: dict, start: int, stop: int):
+    """Worker for ``correct_pedestals_parallel``. Corrects blocks ``start`` to ``stop``."""
+    handles = {name: SharedMemory(name=shm_name) for name, (shm_name, _, _) in specs.items()}
+    try:
+        arrays = {
+            name: np.ndarray(shape, dtype, buffer=handles[name].buf)
+            for name, (_, shape, dtype) in specs.items()
+        }
+        arrays['output'][start:stop] = correct_pedestals_array(
+            arrays['samples'][start:stop],
+            arrays['window_labels'][start:stop],
+            {'data': arrays['pedestals']},
+        )
+        del arrays
+    finally:
+        for shm in handles.values():
+            shm.close()
+
+
+def correct_pedestals_array(samples: np.ndarray, window_labels: np.ndarray, pedestals: dict) -> np.ndarray:
+    """Apply pedestals correction to a stack of events in a single operation.
+
+    The pedestals for every event, channel and sample are gathered by window label
+    and subtracted at once, instead of correcting each event separately.
+
+    Args:
+        samples (np.ndarray): event samples shaped like ``(..., channel, sample)``,
+            as returned by ``events_to_array(data)``.
+        window_labels (np.ndarray): window labels shaped like ``(..., channel, window)``,
+            as returned by ``events_to_array(data, key='window_labels')``.
+        pedestals (dict): pedestals to use. ``pedestals['data']`` is indexed
+            by ``[channel][window][sample]``.
+
+    Returns:
+        np.ndarray: the pedestals corrected samples, with the same shape as ``samples``.
+    """
+    pedestals_data = np.asarray(pedestals['data'])
+    num_channels, num_samples = samples.shape[-2:]
+    channels = np.arange(num_channels)[:, np.newaxis]
+    event_pedestals = pedestals_data[channels, window_labels.astype(np.intp, copy=False)]
+    event_pedestals = event_pedestals.reshape(window_labels.shape[:-1] + (-1,))[..., :num_samples]
+    return np.subtract(samples, event_pedestals, dtype=np.float64)
+
+
+def correct_pedestals_batch(data: list, pedestals: dict, workers: 'int | CorrectionPool' = None) -> tuple[np.ndarray, np.ndarray]:
+    """Apply pedestals correction to sweep or capture data, returning arrays.
+
+    This gives the same values as ``correct_pedestals``/``correct_pedestals_for_capture``
+    but corrects all events in one vectorized operation.
+
+    Args:
+        data (list): parsed sweep (``list[list[list[dict]]]``) or capture (``list[list[dict]]``) data
+        pedestals (dict): pedestals to use
+        workers (int | CorrectionPool): if given, the outermost axis is corrected in a pool
+            of this many processes, or in the given pool. See ``correct_pedestals_parallel``.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: the corrected samples shaped like
+            ``(*outer, capture, channel, sample)`` and the number of captures at each point.
+            Missing captures are zero-filled before correction. Returns empty arrays
+            if there was an error.
+    """
+    try:
+        samples, counts = events_to_array(data)
+        window_labels, _ = events_to_array(data, key='window_labels')
+        if workers:
+            corrected_data = correct_pedestals_parallel(samples, window_labels, pedestals, workers)
+        else:
+            corrected_data = correct_pedestals_array(samples, window_labels, pedestals)
+    except Exception as e:
+        logger.error('Failed to correct pedestals: %s', e)
+        corrected_data, counts = np.empty(0), np.empty(0, dtype=np.int32)
+    return corrected_data, counts
+
+
+def integrated_charge(events: list[dict], channel: int) -> float:
+    """Compute the average integrated charge of the events on a channel.
+
+    The charge of an event is the sum of its samples above the median of the samples,
+    which serves as the baseline.
+
+    Args:
+        events (list[dict]): the events
+        channel (int): the channel
+
+    Returns:
+        float: the average charge in ADC counts x samples, or 0 if there are no events.
+    """
+    if len(events) == 0:
+        return 0.0
+    data = np.array([event['data'][channel] for event in events], dtype=np.float64)
+    baseline = np.median(data, axis=-1, keepdims=True)
+    return float(np.mean(np.sum(np.clip(data - baseline, 0, None), axis=-1)))
+
+
 def select_external_i2c_bus(board):
     """Set I2C communication to use the external bus."""
-    ControlRegisters(board).write('i2c_bus_sel', 1)
+    write_control_register(board, 'i2c_bus_sel', 1)
 
 
 def set_default_gain_stages(board):
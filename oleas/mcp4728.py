@@ -1,17 +1,26 @@
-from naludaq.devices.i2c_device import I2CDevice
+import oleas.backend as backend
+from oleas.shadow import get_shadow_cache
 
 
 DEFAULT_ADDRESS = 0xC8 >> 1
+MULTI_WRITE_COMMAND = 0b01000000
+SEQUENTIAL_WRITE_COMMAND = 0b01010000
 SINGLE_WRITE_COMMAND = 0b01011000
 
 
 class Mcp4728:
-    """Controller for the MCP4728"""
+    """Controller for the MCP4728
+
+    Writes are skipped for channels which already have the requested value
+    (see ``oleas.shadow``). Each setter returns whether any channel changed.
+    """
 
     def __init__(self, board, address: int = DEFAULT_ADDRESS):
-        self._device = I2CDevice(board, address)
+        self._device = backend.get_i2c_device(board, address)
+        self._address = address
+        self._cache = get_shadow_cache(board)
 
-    def set_normalized_value(self, channel: int, value: float, vref: int=0, gain: int=1):
+    def set_normalized_value(self, channel: int, value: float, vref: int=0, gain: int=1) -> bool:
         """Set normalized value (0.0 - 1.0)
 
         Args:
@@ -20,11 +29,10 @@ class Mcp4728:
             vref (int): 0 (VDD) or 1 (internal 2.048 V)
             gain (int): 1 (output 0.0 to 2.048 V) or 2 (output 0.0 to 4.096 V).
         """
-        if not 0.0 <= value <= 1.0:
-            raise ValueError('Value must be 0.0 to 1.0')
-        self.set_value(channel, round(value * 4095.0), vref, gain)
+        _validate_normalized(value)
+        return self.set_value(channel, round(value * 4095.0), vref, gain)
 
-    def set_value(self, channel: int, value: int, vref=0, gain=1):
+    def set_value(self, channel: int, value: int, vref=0, gain=1) -> bool:
         """Set 12-bit value (0 - 4095)
 
         Args:
@@ -33,18 +41,120 @@ class Mcp4728:
             vref (int): 0 (VDD) or 1 (internal 2.048 V)
             gain (int): 1 (output 0.0 to 2.048 V) or 2 (output 0.0 to 4.096 V).
         """
-        if not 0 <= value <= 4095:
-            raise ValueError('Value must be 0 to 4095')
-        if channel not in range(4):
-            raise ValueError('Channel must be 0-4')
-        if vref not in [0, 1]:
-            raise ValueError('VREF must be 0 or 1')
-        if gain not in [1, 2]:
-            raise ValueError('Gain must be 1 or 2')
+        _validate(channel, value, vref, gain)
 
         buf = bytearray(3)
         buf[0] = SINGLE_WRITE_COMMAND | (channel << 1)
-        buf[1] = (vref << 7) | (gain << 4) | ((value >> 8) & 0xF)
-        buf[2] = value & 0xFF
+        buf[1:3] = _encode_value(value, vref, gain)
+
+        return self._cache.write(
+            self._cache_key(channel),
+            (value, vref, gain),
+            lambda: self._device.send_write_command(buf, check_ack=False),
+        )
+
+    def set_normalized_values(self, values: dict[int, float], vref: int=0, gain: int=1) -> bool:
+        """Set normalized values (0.0 - 1.0) for several channels in one transaction.
+
+        See ``set_values``.
+
+        Args:
+            values (dict[int, float]): normalized value for each channel number (0-4)
+            vref (int): 0 (VDD) or 1 (internal 2.048 V)
+            gain (int): 1 (output 0.0 to 2.048 V) or 2 (output 0.0 to 4.096 V).
+        """
+        for value in values.values():
+            _validate_normalized(value)
+        return self.set_values({channel: round(value * 4095.0) for channel, value in values.items()}, vref, gain)
 
+    def set_values(self, values: dict[int, int], vref: int=0, gain: int=1) -> bool:
+        """Set 12-bit values (0 - 4095) for several channels in one transaction
+        using the multi-write command.
+
+        The channel outputs are updated as each channel is received. Unlike
+        ``set_value``, the values are not written to the EEPROM.
+
+        Args:
+            values (dict[int, int]): 12-bit value for each channel number (0-4)
+            vref (int): 0 (VDD) or 1 (internal 2.048 V)
+            gain (int): 1 (output 0.0 to 2.048 V) or 2 (output 0.0 to 4.096 V).
+        """
+        for channel, value in values.items():
+            _validate(channel, value, vref, gain)
+        changed = {
+            channel: value for channel, value in values.items()
+            if self._cache.get(self._cache_key(channel)) != (value, vref, gain)
+        }
+        if len(changed) == 0:
+            return False
+
+        buf = bytearray()
+        for channel, value in changed.items():
+            buf.append(MULTI_WRITE_COMMAND | (channel << 1))
+            buf += _encode_value(value, vref, gain)
+
+        for channel in changed:
+            self._cache.invalidate(self._cache_key(channel))
         self._device.send_write_command(buf, check_ack=False)
+        for channel, value in changed.items():
+            self._cache.set(self._cache_key(channel), (value, vref, gain))
+        return True
+
+    def set_values_sequential(self, values: list[int], start_channel: int=0, vref: int=0, gain: int=1) -> bool:
+        """Set 12-bit values (0 - 4095) for consecutive channels in one transaction
+        using the sequential write command.
+
+        The values are also written to the EEPROM.
+
+        Args:
+            values (list[int]): 12-bit values for channels ``start_channel`` and up
+            start_channel (int): the first channel number (0-4)
+            vref (int): 0 (VDD) or 1 (internal 2.048 V)
+            gain (int): 1 (output 0.0 to 2.048 V) or 2 (output 0.0 to 4.096 V).
+        """
+        if start_channel + len(values) > 4:
+            raise ValueError('Too many values for the channels following the start channel')
+        for i, value in enumerate(values):
+            _validate(start_channel + i, value, vref, gain)
+
+        channels = range(start_channel, start_channel + len(values))
+        if all(self._cache.get(self._cache_key(c)) == (v, vref, gain) for c, v in zip(channels, values)):
+            return False
+
+        buf = bytearray([SEQUENTIAL_WRITE_COMMAND | (start_channel << 1)])
+        for value in values:
+            buf += _encode_value(value, vref, gain)
+
+        for channel in channels:
+            self._cache.invalidate(self._cache_key(channel))
+        self._device.send_write_command(buf, check_ack=False)
+        for channel, value in zip(channels, values):
+            self._cache.set(self._cache_key(channel), (value, vref, gain))
+        return True
+
+    def _cache_key(self, channel: int) -> tuple:
+        return ('mcp4728', self._address, channel)
+
+
+def _validate_normalized(value: float):
+    if not 0.0 <= value <= 1.0:
+        raise ValueError('Value must be 0.0 to 1.0')
+
+
+def _validate(channel: int, value: int, vref: int, gain: int):
+    if not 0 <= value <= 4095:
+        raise ValueError('Value must be 0 to 4095')
+    if channel not in range(4):
+        raise ValueError('Channel must be 0-4')
+    if vref not in [0, 1]:
+        raise ValueError('VREF must be 0 or 1')
+    if gain not in [1, 2]:
+        raise ValueError('Gain must be 1 or 2')
+
+
+def _encode_value(value: int, vref: int, gain: int) -> bytearray:
+    """Encode the two data bytes for a channel"""
+    buf = bytearray(2)
+    buf[0] = (vref << 7) | (gain << 4) | ((value >> 8) & 0xF)
+    buf[1] = value & 0xFF
+    return buf
@@ -0,0 +1,168 @@
+"""Running a script on several boards at once.
+
+Each board is driven by its own process running ``scripts/sweep.py`` or
+``scripts/capture.py``, so every board has its own connection and daq, and a
+board which fails (or crashes its process) does not affect the others. The
+outputs of the boards can then be merged with ``merge_outputs()``, which adds
+a leading board axis.
+"""
+import logging
+from pathlib import Path
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+# entries which are expected to be the same for every board
+SHARED_KEYS = ('dac', 'delay')
+
+
+
+class BoardRun:
+    """A script running on one board, in its own process"""
+
+    def __init__(self, serial: str, args: list, log_file: Path):
+        """Constructor.
+
+        Args:
+            serial (str): serial number of the board
+            args (list): command line of the process
+            log_file (Path): file the output of the process is written to
+        """
+        self.serial = serial
+        self.args = args
+        self.log_file = log_file
+        self.process: subprocess.Popen = None
+        self.returncode: int = None
+        self.duration: float = None
+        self._start_time: float = None
+
+    @property
+    def ok(self) -> bool:
+        """True if the process finished successfully"""
+        return self.returncode == 0
+
+    def start(self):
+        """Start the process. Sets ``returncode`` to -1 if it cannot be started."""
+        logger.info('Starting board %s: %s', self.serial, ' '.join(self.args))
+        self._start_time = time.perf_counter()
+        try:
+            with open(self.log_file, 'w') as log:
+                self.process = subprocess.Popen(self.args, stdout=log, stderr=subprocess.STDOUT)
+        except OSError as e:
+            logger.error('Failed to start board %s: %s', self.serial, e)
+            self.returncode = -1
+
+    def poll(self) -> bool:
+        """Check whether the process has finished, returns True if it has"""
+        if self.returncode is not None:
+            return True
+        returncode = self.process.poll()
+        if returncode is None:
+            return False
+        self.returncode = returncode
+        self.duration = time.perf_counter() - self._start_time
+        if self.ok:
+            logger.info('Board %s finished in %.1f s', self.serial, self.duration)
+        else:
+            logger.error('Board %s failed with exit code %s, see %s', self.serial, returncode, self.log_file)
+        return True
+
+
+def run_boards(script: Path, board_args: dict[str, list], log_dir: Path, poll_interval: float = 0.5) -> dict[str, BoardRun]:
+    """Run a script for each board concurrently, each in its own process.
+
+    The output of each process is written to ``<log_dir>/<serial>.log``. If interrupted
+    with ``Control``+``C``, the processes are still waited for so they can finish saving.
+
+    Args:
+        script (Path): path to the script
+        board_args (dict[str, list]): command line arguments of the script for each board, by serial number
+        log_dir (Path): directory to write the logs to
+        poll_interval (float): time between checks for finished processes in seconds
+
+    Returns:
+        dict[str, BoardRun]: the run of each board, by serial number
+    """
+    log_dir = Path(log_dir)
+    log_dir.mkdir(parents=True, exist_ok=True)
+    runs = {}
+    for serial, args in board_args.items():
+        run = BoardRun(serial, [sys.executable, str(script), *args], log_dir / f'{serial}.log')
+        run.start()
+        runs[serial] = run
+
+    # the processes receive Control+C from the terminal too, so keep waiting until they stop
+    while True:
+        try:
+            _wait_for_runs(runs, poll_interval)
+            break
+        except KeyboardInterrupt:
+            logger.info('Interrupted, waiting for the boards to stop')
+    return runs
+
+
+def merge_outputs(outputs: dict[str, dict]) -> dict:
+    """Merge the outputs of several boards into one, with a leading board axis.
+
+    Entries under ``SHARED_KEYS`` which are the same for every board are kept as-is.
+    Arrays of the same shape for every board are stacked, with zeros for boards
+    without an output. Any other entry becomes a list with one item per board,
+    which is None for boards without an output.
+
+    Args:
+        outputs (dict[str, dict]): output of each board by serial number, or None
+            if the board failed.
+
+    Returns:
+        dict: the merged output. ``'boards'`` holds the serial numbers in the order of
+            the board axis, and ``'failed_boards'`` the serial numbers of the boards
+            without an output.
+    """
+    serials = list(outputs)
+    available = [output for output in outputs.values() if output is not None]
+    merged = {
+        'boards': serials,
+        'failed_boards': [serial for serial, output in outputs.items() if output is None],
+    }
+    keys = []
+    for output in available:
+        keys.extend(key for key in output if key not in keys)
+
+    for key in keys:
+        values = [None if output is None else output.get(key) for output in outputs.values()]
+        present = [value for value in values if value is not None]
+        if key in SHARED_KEYS and _all_equal(present):
+            merged[key] = present[0]
+        elif _same_shape_arrays(present):
+            template = np.zeros_like(present[0])
+            merged[key] = np.stack([template if value is None else value for value in values])
+        else:
+            merged[key] = values
+    return merged
+
+
+def _wait_for_runs(runs: dict[str, BoardRun], poll_interval: float):
+    pending = list(runs.values())
+    while pending:
+        pending = [run for run in pending if not run.poll()]
+        if pending:
+            time.sleep(poll_interval)
+
+
+def _all_equal(values: list) -> bool:
+    if len(values) == 0:
+        return False
+    try:
+        return all(np.array_equal(values[0], value) for value in values[1:])
+    except (TypeError, ValueError):
+        return False
+
+
+def _same_shape_arrays(values: list) -> bool:
+    if len(values) == 0 or not all(isinstance(value, np.ndarray) for value in values):
+        return False
+    return all(value.shape == values[0].shape and value.dtype == values[0].dtype for value in values)
@@ -1,7 +1,12 @@
 import abc
+from contextlib import nullcontext
+import heapq
+import itertools
+from typing import Iterator
 
 import numpy as np
 
+from oleas.checkpoint import SweepJournal
 
 
 class NdSweep(abc.ABC):
@@ -11,17 +16,29 @@ class NdSweep(abc.ABC):
     at a point.
     """
 
-    def __init__(self, axis_values: list[np.ndarray]):
+    def __init__(self, axis_values: list[np.ndarray], axis_costs: list[float] = None, serpentine: bool = False):
         """Constructor.
 
         Args:
             axis_values (list[np.ndarray]): a list of values to use for each axis.
                 The order of the axes matters: the first value corresponds to the
                 outermost "for loop" while the last value is the innermost "for loop".
+            axis_costs (list[float]): optional cost of changing the value of each axis.
+                When given, the axes are traversed in the order which minimizes the
+                total cost. See ``set_traversal()``.
+            serpentine (bool): whether to reverse the direction of the inner axes
+                on alternating passes.
         """
         self._axis_values = axis_values
         self._current_index = None
         self._current_point = None
+        self._previous_point = None
+        self._key_by_point = False
+        self._axis_costs = None
+        self._serpentine = False
+        self._traversal_order = None
+        self._mask: np.ndarray = None
+        self.set_traversal(axis_costs, serpentine)
 
     @property
     def current_index(self) -> tuple:
@@ -35,38 +52,420 @@ class NdSweep(abc.ABC):
     def num_axes(self) -> int:
         return len(self._axis_values)
 
-    def run(self) -> list:
+    @property
+    def shape(self) -> tuple:
+        return tuple(len(values) for values in self._axis_values)
+
+    @property
+    def traversal_order(self) -> tuple:
+        """The axes ordered from the outermost to the innermost loop."""
+        return self._traversal_order
+
+    def set_traversal(self, axis_costs: list[float] = None, serpentine: bool = False):
+        """Set how the points of the sweep are traversed.
+
+        The results are always indexed according to the axes given to the
+        constructor, regardless of the traversal.
+
+        Args:
+            axis_costs (list[float]): cost of changing the value of each axis,
+                e.g. the settling time in seconds. The axis order with the lowest
+                total cost is used, which generally puts the most expensive axis
+                outermost. If None, the axes are traversed in the given order.
+            serpentine (bool): if True, the inner axes alternate direction on each
+                pass (boustrophedon ordering) so that consecutive points only differ
+                along a single axis.
+        """
+        if axis_costs is not None and len(axis_costs) != self.num_axes:
+            raise ValueError('Must provide one cost per axis')
+        self._axis_costs = axis_costs
+        self._serpentine = serpentine
+        self._update_traversal_order()
+
+    def select_points(self, points: list[tuple] = None, mask: np.ndarray = None):
+        """Only run a subset of the points of the grid.
+
+        The traversal order is re-optimized for the selected points.
+        Call with no arguments to select the whole grid again.
+
+        Args:
+            points (list[tuple]): coordinates of the points to run. Each coordinate
+                must be one of the values of its axis.
+            mask (np.ndarray): boolean array with the shape of the grid, True for
+                the points to run.
+
+        Raises:
+            ValueError: if both ``points`` and ``mask`` are given, the mask has the wrong
+                shape, or a point is not on the grid.
+        """
+        if points is not None and mask is not None:
+            raise ValueError('Cannot select both points and a mask')
+        if points is not None:
+            mask = np.zeros(self.shape, dtype=bool)
+            for point in points:
+                mask[self._index_of_point(point)] = True
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            if mask.shape != self.shape:
+                raise ValueError(f'Mask must have shape {self.shape}, not {mask.shape}')
+        self._mask = mask
+        self._update_traversal_order()
+
+    @property
+    def num_points(self) -> int:
+        """Number of points which will be run"""
+        if self._mask is None:
+            return int(np.prod(self.shape))
+        return int(np.count_nonzero(self._mask))
+
+    def run(self, checkpoint=None, resume: bool = False) -> list:
         """Run the sweep.
 
+        Args:
+            checkpoint (Path | str): optional path to a journal which each completed
+                point is appended to. See ``iter_points()``.
+            resume (bool): if True, skip the points already completed in ``checkpoint``.
+
         Returns:
             list: a list of a list of an etc. containing the values generated at
                 each point. The output is ordered according to the axes given.
         """
-        self._reset_current_point()
-        output = self._recursive_run(axis=0)
+        output = self.to_nested({})
+        for index, _, result in self.iter_points(checkpoint, resume):
+            self._set_nested(output, index, result)
         return output
 
-    def _recursive_run(self, axis: int) -> 'list | object':
-        """Recursively run the sweep along each axis, starting with the given axis.
+    def iter_points(self, checkpoint=None, resume: bool = False) -> Iterator[tuple]:
+        """Run the sweep, yielding the result of each point as soon as it is available.
 
-        The axis numbering starts at zero and increases from there.
+        Args:
+            checkpoint (Path | str): optional path to a journal which each completed
+                point is appended to, so that an interrupted sweep can be resumed.
+            resume (bool): if True, the points already completed in ``checkpoint`` are
+                yielded from the journal instead of being run again. The journal is
+                kept after the sweep completes.
+
+        Yields:
+            tuple: ``(index, point, result)`` for each point, where ``index`` and
+                ``point`` are tuples ordered according to the axes given.
+        """
+        journal = None
+        completed = {}
+        if checkpoint is not None:
+            journal = SweepJournal(checkpoint, self.shape, self._axis_values)
+            completed = journal.start(resume)
+
+        self._reset_current_point()
+        previous = None
+        with self._sweep_context():
+            for index in self._iter_indices():
+                if index in completed:
+                    point, result, annotations = completed[index]
+                    self._restore_annotations(index, annotations)
+                    yield index, point, result
+                    continue
+                self._move_to(index, previous)
+                previous = index
+                result = self._run_for_point()
+                if journal is not None:
+                    journal.append(
+                        self.current_index,
+                        self.current_point,
+                        result,
+                        self._point_annotations(self.current_index),
+                    )
+                yield self.current_index, self.current_point, result
+
+    def run_sparse(self, checkpoint=None, resume: bool = False) -> dict:
+        """Run the sweep, returning only the results of the selected points.
+
+        Useful with ``select_points()``. Takes the same arguments as ``run()``.
+
+        Returns:
+            dict: results by point coordinates, in the order they were run.
+        """
+        return {
+            tuple(_to_scalar(x) for x in point): result
+            for _, point, result in self.iter_points(checkpoint, resume)
+        }
+
+    def run_adaptive(self, metric, threshold: float, max_points: int, min_step: list = None) -> dict:
+        """Run a coarse-to-fine sweep, refining only where the response changes quickly.
+
+        The axis values given to the constructor form the coarse grid, which is
+        run first. The grid cells are then refined in order of decreasing priority.
+        The variation of a cell is the range of ``metric`` over its corners, and its
+        priority is the variation weighted by the fraction of the grid the cell covers,
+        so that a single sharp edge cannot take the whole budget. A cell is refined
+        by running the midpoints of its edges, faces, etc. and splitting it into halves
+        along each axis. Refinement stops when no cell varies by more than ``threshold``
+        or when refining would exceed ``max_points``.
 
         Args:
-            axis (int): starting axis. If this is beyond the last axis,
-                the user operation is run.
+            metric (callable): maps the result of a point to a float, e.g. the
+                integrated charge of the captured events.
+            threshold (float): cells whose metric varies by no more than this are not refined.
+            max_points (int): maximum total number of points to run, including the coarse grid.
+            min_step (list): smallest allowed spacing along each axis. Defaults to
+                the resolution of each axis, see ``_axis_resolution()``.
 
         Returns:
-            list | object: list of list (etc) of values, or single value if
-            ``axis`` is the beyond the last axis
+            dict: results by point coordinates, in the order they were run.
         """
-        if axis >= self.num_axes:
-            return self._run_for_point()
+        integer_axes = [np.issubdtype(np.asarray(values).dtype, np.integer) for values in self._axis_values]
+        if min_step is None:
+            min_step = [self._axis_resolution(axis) for axis in range(self.num_axes)]
+        if len(min_step) != self.num_axes:
+            raise ValueError('Must provide one minimum step per axis')
+        spans = [
+            (float(np.max(values)) - float(np.min(values))) or 1.0
+            for values in self._axis_values
+        ]
+
+        results = {}
+        metrics = {}
+        order = self.traversal_order
+        self._reset_current_point()
+        self._previous_point = None
+
+        def run_points(points):
+            for point in points:
+                self._move_to_point(point)
+                results[point] = result = self._run_for_point()
+                metrics[point] = metric(result)
+
+        def variation(cell):
+            values = [metrics[corner] for corner in itertools.product(*cell)]
+            return max(values) - min(values)
+
+        def push(cell):
+            cell_variation = variation(cell)
+            size = np.prod([(hi - lo) / span for (lo, hi), span in zip(cell, spans)])
+            heapq.heappush(heap, (-cell_variation * size, next(counter), cell_variation, cell))
+
+        def midpoint(axis, lo, hi):
+            mid = (lo + hi) / 2
+            if integer_axes[axis]:
+                mid = int(mid)
+            # the new points would be closer than the resolution of the axis
+            if (hi - lo) / 2 < min_step[axis] or mid in (lo, hi):
+                return None
+            return mid
+
+        self._key_by_point = True
+        try:
+            with self._sweep_context():
+                coarse = [
+                    tuple(_to_scalar(self._axis_values[axis][i]) for axis, i in enumerate(index))
+                    for index in self._iter_indices()
+                ]
+                run_points(coarse[:max_points])
+                if len(coarse) > max_points:
+                    return results
+
+                # cells are given by the (low, high) coordinates along each axis
+                heap = []
+                counter = itertools.count()
+                axis_edges = [
+                    [_to_scalar(v) for v in values]
+                    for values in self._axis_values
+                ]
+                for cell in itertools.product(*(list(zip(edges[:-1], edges[1:])) for edges in axis_edges)):
+                    push(cell)
+
+                while heap:
+                    _, _, cell_variation, cell = heapq.heappop(heap)
+                    if cell_variation <= threshold:
+                        continue
+                    splits = [
+                        (lo, midpoint(axis, lo, hi), hi)
+                        for axis, (lo, hi) in enumerate(cell)
+                    ]
+                    if all(mid is None for _, mid, _ in splits):
+                        continue
+                    coordinates = [[x for x in split if x is not None] for split in splits]
+                    new_points = [p for p in itertools.product(*coordinates) if p not in results]
+                    if len(results) + len(new_points) > max_points:
+                        break
+                    # group the points so the outermost (most expensive) axes change the least
+                    new_points.sort(key=lambda p: tuple(p[axis] for axis in order))
+                    run_points(new_points)
+                    for child in itertools.product(*(list(zip(c[:-1], c[1:])) for c in coordinates)):
+                        push(child)
+        finally:
+            self._key_by_point = False
+        return results
+
+    def to_nested(self, values: dict, fill=None) -> list:
+        """Arrange per-point values into the nested list layout returned by ``run()``.
+
+        Args:
+            values (dict): mapping of point index tuples to values.
+            fill: value to use for points missing from ``values``.
+
+        Returns:
+            list: a list of a list of an etc. ordered according to the axes given.
+        """
+        def build(prefix: tuple) -> list:
+            axis = len(prefix)
+            if axis == self.num_axes - 1:
+                return [values.get(prefix + (i,), fill) for i in range(self.shape[axis])]
+            return [build(prefix + (i,)) for i in range(self.shape[axis])]
+        if self.num_axes == 0:
+            return []
+        return build(())
+
+    def _sweep_context(self):
+        """Override to return a context manager which is held open for the
+        duration of the sweep.
+        """
+        return nullcontext()
+
+    def _point_annotations(self, key: tuple) -> object:
+        """Override to return extra information recorded for a point, e.g. its
+        timing. It is journaled with the result of the point and given back to
+        ``_restore_annotations()`` when the sweep is resumed.
+
+        Args:
+            key (tuple): key of the point, see ``_point_key()``
+        """
+        return None
+
+    def _restore_annotations(self, key: tuple, annotations: object):
+        """Override to restore the information returned by ``_point_annotations()``
+        for a point loaded from the journal.
+        """
+
+    def _iter_indices(self, order: tuple = None) -> Iterator[tuple]:
+        """Generate the index of each selected point in traversal order.
+
+        Args:
+            order (tuple): axis order to traverse in. Defaults to ``traversal_order``.
+
+        Yields:
+            tuple: point index ordered according to the axes given.
+        """
+        order = order or self.traversal_order
+        shape = self.shape
+        for count in itertools.product(*(range(shape[axis]) for axis in order)):
+            position = list(count)
+            if self._serpentine:
+                # Count the passes made so far along each axis to find its direction.
+                # The passes are counted in traversal order, before any axis is flipped.
+                passes = 0
+                for k, axis in enumerate(order):
+                    if passes % 2 == 1:
+                        position[k] = shape[axis] - 1 - count[k]
+                    passes = passes * shape[axis] + count[k]
+            index = [0] * self.num_axes
+            for k, axis in enumerate(order):
+                index[axis] = position[k]
+            index = tuple(index)
+            if self._mask is None or self._mask[index]:
+                yield index
+
+    def _update_traversal_order(self):
+        if self._axis_costs is None:
+            self._traversal_order = tuple(range(self.num_axes))
         else:
-            result = []
-            for i, value in enumerate(self._axis_values[axis]):
-                self._set_axis_value(axis, value, i)
-                result.append(self._recursive_run(axis + 1))
-            return result
+            self._traversal_order = min(
+                itertools.permutations(range(self.num_axes)),
+                key=self._traversal_cost,
+            )
+
+    def _traversal_cost(self, order: tuple) -> float:
+        """Compute the total cost of changing axis values when traversing
+        the axes in the given order (outermost first).
+        """
+        if self._mask is not None:
+            # count the changes along the actual path through the selected points
+            total = 0
+            previous = None
+            for index in self._iter_indices(order):
+                if previous is not None:
+                    total += sum(cost for i, j, cost in zip(index, previous, self._axis_costs) if i != j)
+                previous = index
+            return total
+
+        # each axis is traversed once per pass of the axes outside it. With serpentine
+        # ordering it then continues from where it stopped, otherwise it resets.
+        shape = self.shape
+        total = 0
+        passes = 1
+        for axis in order:
+            length = shape[axis]
+            changes = passes * (length - 1)
+            if not self._serpentine and length > 1:
+                changes += passes - 1
+            total += self._axis_costs[axis] * changes
+            passes *= length
+        return total
+
+    def _move_to(self, index: tuple, previous: 'tuple | None'):
+        """Update the axis values needed to move from the ``previous`` point
+        to the point at ``index``.
+
+        Only the axes whose index changed are set, from the outermost
+        axis to the innermost.
+        """
+        for axis in self.traversal_order:
+            i = index[axis]
+            if previous is None or previous[axis] != i:
+                self._set_axis_value(axis, self._axis_values[axis][i], i)
+
+    def _axis_resolution(self, axis: int) -> float:
+        """Override to give the smallest meaningful change of an axis value,
+        e.g. one DAC code. Used as the default ``min_step`` of ``run_adaptive()``.
+
+        Defaults to 1 for integer axes and 0 (no limit) for other axes.
+        """
+        is_int = np.issubdtype(np.asarray(self._axis_values[axis]).dtype, np.integer)
+        return 1 if is_int else 0
+
+    def _index_of_point(self, point: tuple) -> tuple:
+        """Find the index of a point given by its coordinates"""
+        if len(point) != self.num_axes:
+            raise ValueError(f'Point {point} must have {self.num_axes} coordinates')
+        index = []
+        for axis, value in enumerate(point):
+            i = self._index_of_value(axis, value)
+            if i is None:
+                raise ValueError(f'Point {point} is not on the grid')
+            index.append(i)
+        return tuple(index)
+
+    def _index_of_value(self, axis: int, value) -> 'int | None':
+        """Find the index of a value along an axis, or None if it is not one of
+        the axis values. Float values are compared with a tolerance, since they may
+        have been computed differently from the axis values (e.g. ``0.1 + 0.2``).
+        """
+        matches = np.flatnonzero(np.isclose(np.asarray(self._axis_values[axis]), value, rtol=1e-9, atol=1e-12))
+        return int(matches[0]) if len(matches) > 0 else None
+
+    def _point_key(self) -> tuple:
+        """Key identifying the current point. This is the point index, except
+        during ``run_adaptive()`` where it is the point coordinates.
+        """
+        return self.current_point if self._key_by_point else self.current_index
+
+    def _move_to_point(self, point: tuple):
+        """Move to a point given by its coordinates, which need not lie on the grid.
+
+        Only the axes whose value changed are set. The index of an axis is None
+        if its value is not one of the axis values.
+        """
+        previous = self._previous_point
+        for axis in self.traversal_order:
+            value = point[axis]
+            if previous is None or previous[axis] != value:
+                self._set_axis_value(axis, value, self._index_of_value(axis, value))
+        self._previous_point = point
+
+    @staticmethod
+    def _set_nested(output: list, index: tuple, value):
+        for i in index[:-1]:
+            output = output[i]
+        output[index[-1]] = value
 
     def _set_axis_value(self, axis: int, value: int, index: int):
         """Override to update something when the value along an axis changes.
@@ -91,3 +490,8 @@ class NdSweep(abc.ABC):
         num_axes = self.num_axes
         self._current_point = [0] * num_axes
         self._current_index = [0] * num_axes
+
+
+def _to_scalar(value):
+    """Convert numpy scalars to the equivalent Python scalar"""
+    return value.item() if isinstance(value, np.generic) else value
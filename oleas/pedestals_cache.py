@@ -0,0 +1,154 @@
+"""Cache of pedestals files as memory-mapped arrays.
+
+Pedestals files are gzip-compressed pickles, which take seconds to decompress and
+unpickle for large boards. The first time a pedestals file is loaded it is converted
+to an uncompressed ``.npy`` file holding ``pedestals['data']``, plus a pickle with the
+remaining (small) entries. Later loads memory-map the ``.npy`` file, so only the pages
+which are actually used are read.
+
+A cache entry is valid while the size and modification time of the source file are
+unchanged. If only the modification time changed, the SHA-256 hash of the file is
+compared instead, and the entry is kept if the contents are the same.
+"""
+from collections.abc import Mapping
+import gzip
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import pickle
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_CACHE_DIR = Path.home() / '.cache' / 'oleas' / 'pedestals'
+_HASH_CHUNK_SIZE = 1 << 20
+
+
+
+class CachedPedestals(Mapping):
+    """Read-only pedestals dict backed by a cache entry.
+
+    ``'data'`` is a read-only memory-mapped array. The other entries are
+    unpickled the first time one of them is accessed.
+    """
+
+    def __init__(self, entry: Path, keys: list):
+        self._entry = entry
+        self._keys = list(keys)
+        self._data: np.ndarray = None
+        self._extra: dict = None
+
+    def __getitem__(self, key):
+        if key == 'data' and 'data' in self._keys:
+            if self._data is None:
+                self._data = np.load(self._entry.with_suffix('.npy'), mmap_mode='r')
+            return self._data
+        if key not in self._keys:
+            raise KeyError(key)
+        if self._extra is None:
+            with open(self._entry.with_suffix('.pkl'), 'rb') as f:
+                self._extra = pickle.load(f)
+        return self._extra[key]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __reduce__(self):
+        return CachedPedestals, (self._entry, self._keys)
+
+
+def load_cached_pedestals(path, cache_dir=None) -> Mapping:
+    """Load a pedestals file through the cache, converting it if needed.
+
+    Falls back to loading the file directly if the cache cannot be written
+    or ``pedestals['data']`` cannot be converted to an array.
+
+    Args:
+        path (Path | str): path to the gzip-compressed pedestals file
+        cache_dir (Path | str): cache directory. Defaults to ``DEFAULT_CACHE_DIR``.
+
+    Returns:
+        Mapping: the pedestals
+    """
+    path = Path(path).resolve()
+    cache_dir = Path(cache_dir or DEFAULT_CACHE_DIR)
+    entry = cache_dir / hashlib.sha256(str(path).encode()).hexdigest()[:16]
+    stat = path.stat()
+
+    meta = _read_meta(entry)
+    if meta is not None and meta['source'] == str(path) and meta['size'] == stat.st_size:
+        if meta['mtime'] == stat.st_mtime_ns:
+            return CachedPedestals(entry, meta['keys'])
+        if meta['sha256'] == _file_hash(path):
+            logger.debug('Pedestals file was touched but not changed: %s', path)
+            meta['mtime'] = stat.st_mtime_ns
+            _write_meta(entry, meta)
+            return CachedPedestals(entry, meta['keys'])
+
+    logger.info('Converting pedestals file to cache: %s', path)
+    with gzip.GzipFile(path, 'rb') as f:
+        pedestals = pickle.load(f)
+    try:
+        keys = _write_entry(entry, pedestals)
+    except (OSError, ValueError) as e:
+        logger.warning('Failed to cache pedestals file: %s', e)
+        return pedestals
+    _write_meta(entry, {
+        'source': str(path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'sha256': _file_hash(path),
+        'keys': keys,
+    })
+    return CachedPedestals(entry, keys)
+
+
+def _write_entry(entry: Path, pedestals: dict) -> list:
+    """Write the arrays of a cache entry, returns the keys of the pedestals"""
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    entry.with_suffix('.json').unlink(missing_ok=True)
+    extra = {key: value for key, value in pedestals.items() if key != 'data'}
+    if 'data' in pedestals:
+        data = np.asarray(pedestals['data'])
+        if data.dtype == object:
+            raise ValueError('pedestals data is not a regular array')
+        _atomic_write(entry.with_suffix('.npy'), lambda f: np.save(f, data))
+    _atomic_write(entry.with_suffix('.pkl'), lambda f: pickle.dump(extra, f, protocol=pickle.HIGHEST_PROTOCOL))
+    return list(pedestals.keys())
+
+
+def _read_meta(entry: Path) -> dict:
+    try:
+        with open(entry.with_suffix('.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(entry: Path, meta: dict):
+    # the metadata is written last, so an entry is never used before it is complete
+    try:
+        _atomic_write(entry.with_suffix('.json'), lambda f: f.write(json.dumps(meta).encode()))
+    except OSError as e:
+        logger.warning('Failed to write pedestals cache metadata: %s', e)
+
+
+def _atomic_write(path: Path, write_fn):
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        write_fn(f)
+    os.replace(tmp_path, path)
+
+
+def _file_hash(path: Path) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
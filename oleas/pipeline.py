@@ -0,0 +1,97 @@
+import logging
+import queue
+import threading
+
+
+logger = logging.getLogger(__name__)
+_STOP = object()
+
+
+
+class Pipeline:
+    """A chain of processing stages, each running on its own worker thread.
+
+    Stages are connected by bounded queues. When a stage falls behind, its
+    queue fills up and ``put()`` blocks, which applies backpressure to the
+    producer instead of letting the backlog grow without bound.
+
+    Example:
+    ```
+    with Pipeline([correct, save], maxsize=2) as pipeline:
+        while True:
+            pipeline.put(acquire())
+    ```
+    """
+
+    def __init__(self, stages: list, maxsize: int = 2, name: str = 'pipeline'):
+        """Constructor.
+
+        Args:
+            stages (list[callable]): functions run in order on each item. Each function
+                receives the return value of the previous one. The return value of the
+                last stage is discarded.
+            maxsize (int): maximum number of items waiting in front of each stage.
+            name (str): name used for the worker threads.
+        """
+        self._stages = stages
+        self._queues = [queue.Queue(maxsize=maxsize) for _ in stages]
+        self._threads = [
+            threading.Thread(
+                target=self._run_stage,
+                args=(i,),
+                name=f'{name}-{getattr(stage, "__name__", i)}',
+                daemon=True,
+            )
+            for i, stage in enumerate(stages)
+        ]
+        self._closed = False
+
+    def __enter__(self) -> 'Pipeline':
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, item):
+        """Submit an item to the first stage. Blocks while the first queue is full."""
+        if self._closed:
+            raise RuntimeError('Pipeline is closed')
+        self._queues[0].put(item)
+
+    def close(self, timeout: float = None):
+        """Finish processing the submitted items and stop the worker threads.
+
+        Args:
+            timeout (float): maximum time in seconds to wait for each stage to finish.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queues[0].put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+            if thread.is_alive():
+                logger.warning('Pipeline stage %s did not finish in time', thread.name)
+
+    def _run_stage(self, index: int):
+        stage = self._stages[index]
+        inbox = self._queues[index]
+        outbox = self._queues[index + 1] if index + 1 < len(self._queues) else None
+        while True:
+            item = inbox.get()
+            if item is _STOP:
+                if outbox is not None:
+                    outbox.put(_STOP)
+                break
+            try:
+                result = stage(item)
+            except Exception as e:
+                logger.error('Pipeline stage %s failed: %s', stage, e)
+                continue
+            if outbox is not None:
+                outbox.put(result)
@@ -0,0 +1,77 @@
+"""Region-of-interest cropping of events.
+
+Events are cropped right after they are read out, so that pedestals correction
+and storage only handle the samples around the gated pulse instead of the whole
+read window.
+
+Cropping is aligned to whole windows: each channel keeps the windows which overlap
+its region of interest, along with their window labels. This keeps the cropped
+events valid for pedestals correction. The index of the first kept sample of each
+channel is stored in the event under ``'sample_offset'``.
+"""
+import numpy as np
+
+
+
+def roi_from_gate(
+        delay: float,
+        length: float,
+        samples_per_tick: float = 1.0,
+        offset: int = 0,
+        margin: int = 0,
+    ) -> tuple[int, int]:
+    """Get the region of interest covering a gate.
+
+    Args:
+        delay (float): the gate delay, in gate clock ticks
+        length (float): the gate length, in gate clock ticks
+        samples_per_tick (float): number of samples per gate clock tick
+        offset (int): sample at which a gate with zero delay starts
+        margin (int): number of extra samples to keep on either side of the gate
+
+    Returns:
+        tuple[int, int]: the ``(start, stop)`` sample range
+    """
+    start = offset + int(np.floor(delay * samples_per_tick)) - margin
+    stop = offset + int(np.ceil((delay + length) * samples_per_tick)) + margin
+    return max(start, 0), max(stop, 0)
+
+
+def crop_event(event: dict, roi: 'tuple | dict', samples_per_window: int) -> dict:
+    """Crop an event to a region of interest.
+
+    Args:
+        event (dict): the event
+        roi (tuple | dict): ``(start, stop)`` sample range applied to all channels, or
+            a dict of sample ranges by channel. Channels missing from the dict are not cropped.
+        samples_per_window (int): number of samples in each window
+
+    Returns:
+        dict: a copy of the event with the cropped ``'data'`` and ``'window_labels'``
+    """
+    data = []
+    window_labels = []
+    sample_offset = []
+    for channel, (samples, labels) in enumerate(zip(event['data'], event['window_labels'])):
+        channel_roi = roi.get(channel) if isinstance(roi, dict) else roi
+        if channel_roi is None:
+            data.append(samples)
+            window_labels.append(labels)
+            sample_offset.append(0)
+            continue
+        first_window = channel_roi[0] // samples_per_window
+        stop_window = -(-channel_roi[1] // samples_per_window)
+        data.append(np.asarray(samples)[first_window * samples_per_window:stop_window * samples_per_window])
+        window_labels.append(np.asarray(labels)[first_window:stop_window])
+        sample_offset.append(first_window * samples_per_window)
+    return {
+        **event,
+        'data': data,
+        'window_labels': window_labels,
+        'sample_offset': sample_offset,
+    }
+
+
+def crop_events(events: list[dict], roi: 'tuple | dict', samples_per_window: int) -> list[dict]:
+    """Crop a list of events to a region of interest. See ``crop_event()``."""
+    return [crop_event(event, roi, samples_per_window) for event in events]
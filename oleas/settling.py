@@ -0,0 +1,72 @@
+"""Adaptive detection of PMT settling.
+
+Instead of waiting a fixed worst-case time after every DAC change, cheap probe
+captures are taken and a statistic of each one is compared with the previous
+probe. The PMT is considered settled once the statistic stops changing.
+"""
+import logging
+import time
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+STATISTICS = ('baseline', 'amplitude')
+
+
+
+def event_statistic(event: dict, channel: int, statistic: str = 'baseline') -> float:
+    """Compute a cheap statistic of an event to detect settling with.
+
+    Args:
+        event (dict): the event
+        channel (int): channel to compute the statistic for
+        statistic (str): ``'baseline'`` for the mean of the samples, or
+            ``'amplitude'`` for the peak height above the median.
+
+    Returns:
+        float: the statistic
+    """
+    data = np.asarray(event['data'][channel], dtype=np.float64)
+    if statistic == 'baseline':
+        return float(np.mean(data))
+    elif statistic == 'amplitude':
+        return float(np.max(data) - np.median(data))
+    raise ValueError(f'Unknown statistic: {statistic}. Must be one of {STATISTICS}')
+
+
+def wait_for_settle(probe, tolerance: float, max_time: float, consecutive: int = 2) -> float:
+    """Take probe measurements until they stop changing.
+
+    Args:
+        probe (callable): takes a measurement and returns a float. May raise
+            ``TimeoutError`` if no measurement could be taken.
+        tolerance (float): maximum difference between consecutive measurements
+            for them to count as stable.
+        max_time (float): maximum time to wait in seconds.
+        consecutive (int): number of consecutive stable differences required.
+
+    Returns:
+        float: the time spent settling in seconds.
+    """
+    start = time.perf_counter()
+    previous = None
+    stable = 0
+    while time.perf_counter() - start < max_time:
+        try:
+            value = probe()
+        except TimeoutError:
+            previous = None
+            stable = 0
+            continue
+        if previous is not None and abs(value - previous) <= tolerance:
+            stable += 1
+            if stable >= consecutive:
+                elapsed = time.perf_counter() - start
+                logger.debug('Settled after %.3f s', elapsed)
+                return elapsed
+        else:
+            stable = 0
+        previous = value
+    logger.info('Did not settle within %s s', max_time)
+    return time.perf_counter() - start
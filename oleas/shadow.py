@@ -0,0 +1,69 @@
+"""Write-through shadow cache of values written to the board.
+
+Each board has a cache of the last value written to its DAC channels and control
+registers. Writes of a value which is already on the board are skipped. The cache
+must be invalidated whenever the board state is lost, e.g. when it is restarted.
+"""
+import logging
+import weakref
+
+
+logger = logging.getLogger(__name__)
+_caches = weakref.WeakKeyDictionary()
+
+
+
+class ShadowCache:
+    """Cache of the last value written to each destination on a board"""
+
+    def __init__(self):
+        self._values = {}
+
+    def write(self, key, value, write_fn) -> bool:
+        """Write a value through the cache.
+
+        Args:
+            key: identifies the destination, e.g. ``('control', 'oleas_delay_a')``
+            value: the value to write. Must support ``==``.
+            write_fn (callable): performs the actual write. Only called if the
+                value differs from the cached value.
+
+        Returns:
+            bool: True if the value was written, False if the write was skipped.
+        """
+        if key in self._values and self._values[key] == value:
+            return False
+        # drop the entry first, in case the write fails partway through
+        self._values.pop(key, None)
+        write_fn()
+        self._values[key] = value
+        return True
+
+    def set(self, key, value):
+        """Record a value which was written without going through ``write()``."""
+        self._values[key] = value
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def invalidate(self, key=None):
+        """Forget the cached value for a key, or for all keys if ``key`` is None."""
+        if key is None:
+            self._values.clear()
+        else:
+            self._values.pop(key, None)
+
+
+def get_shadow_cache(board) -> ShadowCache:
+    """Get the shadow cache for the board, creating it if necessary"""
+    cache = _caches.get(board)
+    if cache is None:
+        cache = ShadowCache()
+        _caches[board] = cache
+    return cache
+
+
+def invalidate_shadow_cache(board):
+    """Forget all values cached for the board. Call this after restarting the board."""
+    logger.debug('Invalidating shadow cache')
+    get_shadow_cache(board).invalidate()
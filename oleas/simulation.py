@@ -0,0 +1,376 @@
+"""In-process simulated board for hardware-free runs and benchmarks.
+
+``SimulatedBoard`` stands in for a naludaq ``Board``, along with the controllers,
+control registers, I2C devices and daq which oleas uses (see ``oleas.backend``).
+It has configurable register/I2C latencies, a delay between a trigger and the
+arrival of its event, a probability of dropping events, and synthetic PMT pulses:
+
+- the samples of every channel are a fixed pedestal pattern plus noise
+  (``generate_pedestals()`` returns the matching pedestals)
+- channels 0-2 and 4-6 carry a pulse whose amplitude grows with the MCP4728
+  output of DAC channel 0 and 1 respectively, with the gain stages multiplying
+  it by 8 for every following channel
+- the pulse amplitude depends on the gate delay (``'oleas_delay_a'``) through a
+  Gaussian return profile
+
+Events are produced by ``toggle_trigger()``, and also every ``external_trigger_interval``
+seconds while the OLEAS trigger is enabled (``set_oleas_enabled(en_trig=1)``).
+"""
+from collections import deque
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import numpy as np
+
+import oleas.mcp4725 as mcp4725
+import oleas.mcp4728 as mcp4728
+
+
+logger = logging.getLogger(__name__)
+_COMMAND_MASK = 0b11111000
+
+
+
+class SimulatedBoard:
+    """A simulated board. Use it in place of a ``Board`` with the functions in ``oleas.backend``."""
+
+    def __init__(
+            self,
+            model: str = 'aodsoc_aods',
+            channels: int = 8,
+            windows: int = 512,
+            samples: int = 64,
+            register_latency: float = 0,
+            i2c_latency: float = 0,
+            trigger_delay: float = 0.001,
+            external_trigger_interval: float = 0.01,
+            drop_probability: float = 0,
+            noise: float = 2.0,
+            max_amplitude: float = 400.0,
+            pulse_sample: int = 128,
+            pulse_width: float = 4.0,
+            delay_center: float = 500.0,
+            delay_width: float = 300.0,
+            seed: int = None,
+        ):
+        """Constructor.
+
+        Args:
+            model (str): board model name, only reported in ``params``
+            channels (int): number of channels
+            windows (int): number of windows in the sample memory
+            samples (int): number of samples per window
+            register_latency (float): time in seconds taken by each control register write
+            i2c_latency (float): time in seconds taken by each I2C transaction
+            trigger_delay (float): time in seconds between a trigger and the arrival of its event
+            external_trigger_interval (float): time in seconds between triggers while the
+                OLEAS trigger is enabled
+            drop_probability (float): probability (0-1) that an event is lost
+            noise (float): standard deviation of the sample noise in ADC counts
+            max_amplitude (float): pulse amplitude on the first channel of a chip at full DAC
+                output and the peak of the gate delay profile
+            pulse_sample (int): sample index of the pulse peak within the read window
+            pulse_width (float): standard deviation of the pulse shape in samples
+            delay_center (float): gate delay at which the return is strongest
+            delay_width (float): standard deviation of the return profile in gate delay units
+            seed (int): seed for the random number generator
+        """
+        self.model = model
+        self.params = {
+            'model': model,
+            'channels': channels,
+            'windows': windows,
+            'samples': samples,
+            'resolution': 12,
+            'possible_bauds': {2000000: None},
+        }
+        self.pedestals = None
+        self.register_latency = register_latency
+        self.i2c_latency = i2c_latency
+        self.trigger_delay = trigger_delay
+        self.external_trigger_interval = external_trigger_interval
+        self.drop_probability = drop_probability
+        self.noise = noise
+        self.max_amplitude = max_amplitude
+        self.pulse_sample = pulse_sample
+        self.pulse_width = pulse_width
+        self.delay_center = delay_center
+        self.delay_width = delay_width
+
+        self.registers: dict[str, int] = {}
+        self.dac_values: dict[int, int] = {} # MCP4728 12-bit value by channel
+        self.read_window = {'windows': 8, 'lookback': 8, 'write_after_trig': 8}
+        self.readout_running = False
+        self.num_triggers = 0
+        self.num_dropped = 0
+        self.num_register_writes = 0
+        self.num_i2c_writes = 0
+
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+        self._pedestal_pattern = self._rng.normal(500, 20, (channels, windows, samples))
+        self._daq: 'SimulatedDaq' = None
+        self._next_window = 0
+        self._event_num = 0
+
+    def generate_pedestals(self) -> dict:
+        """Get the pedestals matching the simulated pedestal pattern"""
+        return {'data': self._pedestal_pattern.copy()}
+
+    def startup(self):
+        """Reset the board state"""
+        self.registers.clear()
+        self.dac_values.clear()
+        self.readout_running = False
+
+    def write_register(self, name: str, value: int):
+        """Write a control register"""
+        time.sleep(self.register_latency)
+        self.registers[name] = int(value)
+        self.num_register_writes += 1
+
+    def read_register(self, name: str) -> int:
+        time.sleep(self.register_latency)
+        return self.registers.get(name, 0)
+
+    def i2c_write(self, address: int, data: bytes):
+        """Perform an I2C write transaction, decoding MCP4728 commands"""
+        time.sleep(self.i2c_latency)
+        self.num_i2c_writes += 1
+        data = bytes(data)
+        if address == mcp4728.DEFAULT_ADDRESS:
+            self._decode_mcp4728(data)
+        elif address == mcp4725.DEFAULT_ADDRESS:
+            self.registers['mcp4725'] = ((data[0] & 0xF) << 8) | data[1]
+
+    def read_sensors(self) -> dict:
+        """Read the simulated sensors, which report the normalized (0.0 - 1.0) DAC outputs"""
+        time.sleep(self.i2c_latency)
+        sensors = {f'mcp4728_ch{channel}': self.dac_output(channel) for channel in range(4)}
+        sensors['mcp4725'] = self.registers.get('mcp4725', 0) / 4095.0
+        return sensors
+
+    @property
+    def external_trigger_enabled(self) -> bool:
+        return bool(self.registers.get('oleas_en_trig', 0)) and self.external_trigger_interval > 0
+
+    def trigger(self):
+        """Issue a trigger. The event arrives at the daq after ``trigger_delay`` unless it is dropped."""
+        daq = self._daq
+        event = self._triggered_event()
+        if event is not None:
+            daq.schedule(event, time.perf_counter() + self.trigger_delay)
+
+    def dac_output(self, channel: int) -> float:
+        """Normalized (0.0 - 1.0) output of an MCP4728 channel"""
+        return self.dac_values.get(channel, 0) / 4095.0
+
+    def pulse_amplitude(self, dac_channel: int) -> float:
+        """Amplitude of the pulse on the first board channel driven by a DAC channel"""
+        delay = self.registers.get('oleas_delay_a', 0)
+        profile = np.exp(-0.5 * ((delay - self.delay_center) / self.delay_width) ** 2)
+        return self.max_amplitude * self.dac_output(dac_channel) ** 2 * profile
+
+    def _triggered_event(self) -> dict:
+        """Count a trigger and make its event, or return None if it is not read out"""
+        with self._lock:
+            self.num_triggers += 1
+            daq = self._daq
+            if daq is None or not self.readout_running or not daq.capturing:
+                return None
+            if self._rng.random() < self.drop_probability:
+                self.num_dropped += 1
+                return None
+            return self.make_event()
+
+    def make_event(self) -> dict:
+        """Synthesize an event for the current DAC outputs and gate delay"""
+        num_channels, num_windows, samples = self._pedestal_pattern.shape
+        read_windows = self.read_window['windows']
+        window_labels = (self._next_window + np.arange(read_windows)) % num_windows
+        self._next_window = (self._next_window + read_windows) % num_windows
+
+        data = self._pedestal_pattern[:, window_labels].reshape(num_channels, -1)
+        data = data + self._rng.normal(0, self.noise, data.shape)
+        sample_index = np.arange(data.shape[1])
+        shape = np.exp(-0.5 * ((sample_index - self.pulse_sample) / self.pulse_width) ** 2)
+        for channel in range(num_channels):
+            stage = channel % 4
+            if stage == 3:
+                continue # external input, no PMT signal
+            amplitude = self.pulse_amplitude(channel // 4) * 8 ** stage
+            data[channel] += amplitude * shape
+
+        self._event_num += 1
+        return {
+            'data': [np.clip(np.round(x), 0, 4095).astype(np.int32) for x in data],
+            'window_labels': [window_labels.copy() for _ in range(num_channels)],
+            'event_num': self._event_num,
+            'start_window': int(window_labels[0]),
+            'created_at': time.time(),
+        }
+
+    def _decode_mcp4728(self, data: bytes):
+        command = data[0] & _COMMAND_MASK
+        if command == mcp4728.SEQUENTIAL_WRITE_COMMAND:
+            start_channel = (data[0] >> 1) & 0b11
+            for i in range((len(data) - 1) // 2):
+                self.dac_values[start_channel + i] = _decode_dac_value(data[1 + 2 * i:3 + 2 * i])
+        elif command in (mcp4728.SINGLE_WRITE_COMMAND, mcp4728.MULTI_WRITE_COMMAND):
+            # multi-write commands are repeated for each channel
+            for i in range(0, len(data) - 2, 3):
+                channel = (data[i] >> 1) & 0b11
+                self.dac_values[channel] = _decode_dac_value(data[i + 1:i + 3])
+        else:
+            logger.warning('Unknown MCP4728 command: %s', bin(data[0]))
+
+
+class SimulatedDaq:
+    """Stands in for ``DebugDaq``. Events are appended to ``output_buffer`` from a worker thread."""
+
+    def __init__(self, board: SimulatedBoard):
+        self._board = board
+        self.output_buffer = deque()
+        self.capturing = False
+        self._pending = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread: threading.Thread = None
+
+    def start_capture(self):
+        self.capturing = True
+        self._board._daq = self
+        self._thread = threading.Thread(target=self._deliver, name='simulated-daq', daemon=True)
+        self._thread.start()
+
+    def stop_capture(self):
+        with self._condition:
+            self.capturing = False
+            self._condition.notify_all()
+        self._thread.join()
+        if self._board._daq is self:
+            self._board._daq = None
+
+    def schedule(self, event: dict, due_time: float):
+        """Deliver an event to the output buffer at a ``time.perf_counter()`` time"""
+        with self._condition:
+            heapq.heappush(self._pending, (due_time, next(self._sequence), event))
+            self._condition.notify_all()
+
+    def _deliver(self):
+        board = self._board
+        next_trigger = time.perf_counter()
+        with self._condition:
+            while self.capturing:
+                now = time.perf_counter()
+                if board.external_trigger_enabled and now >= next_trigger:
+                    next_trigger = now + board.external_trigger_interval
+                    event = board._triggered_event()
+                    if event is not None:
+                        heapq.heappush(self._pending, (now + board.trigger_delay, next(self._sequence), event))
+                if self._pending and self._pending[0][0] <= now:
+                    _, _, event = heapq.heappop(self._pending)
+                    # the buffer may be replaced by notify_on_append(), so look it up every time
+                    self.output_buffer.append(event)
+                    continue
+
+                # sleep until the next event is due or the next external trigger. The trigger
+                # can be enabled at any time, so check for it at least every trigger interval
+                wake_times = [self._pending[0][0]] if self._pending else []
+                if board.external_trigger_enabled:
+                    wake_times.append(next_trigger)
+                elif board.external_trigger_interval > 0:
+                    wake_times.append(now + board.external_trigger_interval)
+                self._condition.wait(min(wake_times) - now if wake_times else None)
+            self._pending.clear()
+
+
+class SimulatedBoardController:
+    def __init__(self, board: SimulatedBoard):
+        self._board = board
+
+    def toggle_trigger(self):
+        self._board.trigger()
+
+    def start_readout(self, trig: str = 'ext', *args, **kwargs):
+        self._board.readout_running = True
+
+    def stop_readout(self):
+        self._board.readout_running = False
+
+    def set_oleas_enabled(self, en_trig: int, en_a: int, en_b: int):
+        self._board.write_register('oleas_en_trig', en_trig)
+        self._board.write_register('oleas_en_a', en_a)
+        self._board.write_register('oleas_en_b', en_b)
+
+    def set_oleas_loop(self, length: int):
+        self._board.write_register('oleas_loop', length)
+
+    def set_oleas_a(self, length: int, delay: int, polarity: int):
+        self._board.write_register('oleas_length_a', length)
+        self._board.write_register('oleas_delay_a', delay)
+        self._board.write_register('oleas_polarity_a', polarity)
+
+    def set_oleas_b(self, length: int, delay: int, polarity: int):
+        self._board.write_register('oleas_length_b', length)
+        self._board.write_register('oleas_delay_b', delay)
+        self._board.write_register('oleas_polarity_b', polarity)
+
+
+class SimulatedReadoutController:
+    def __init__(self, board: SimulatedBoard):
+        self._board = board
+
+    def set_read_window(self, windows: int, lookback: int, write_after_trig: int):
+        self._board.read_window = {
+            'windows': windows,
+            'lookback': lookback,
+            'write_after_trig': write_after_trig,
+        }
+
+
+class SimulatedGainstageController:
+    """Accepts the gain stage settings used by oleas without simulating them"""
+
+    def __init__(self, board: SimulatedBoard, chip_number: int):
+        self._board = board
+        self._chip_number = chip_number
+
+    def ch0_external_input(self):
+        pass
+
+    def ch1_8x_ch0(self):
+        pass
+
+    def ch2_8x_ch1(self):
+        pass
+
+    def ch3_external_input(self):
+        pass
+
+
+class SimulatedControlRegisters:
+    def __init__(self, board: SimulatedBoard):
+        self._board = board
+
+    def write(self, name: str, value: int):
+        self._board.write_register(name, value)
+
+    def read(self, name: str) -> int:
+        return self._board.read_register(name)
+
+
+class SimulatedI2CDevice:
+    def __init__(self, board: SimulatedBoard, address: int):
+        self._board = board
+        self._address = address
+
+    def send_write_command(self, data, check_ack: bool = True):
+        self._board.i2c_write(self._address, data)
+
+
+def _decode_dac_value(data: bytes) -> int:
+    return ((data[0] & 0xF) << 8) | data[1]
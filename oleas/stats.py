@@ -0,0 +1,183 @@
+"""Streaming statistics of event samples.
+
+Events are folded into a ``RunningStats`` accumulator as they arrive, using
+Welford's method. The mean, variance, minimum and maximum of every channel and
+sample are then available without keeping the events themselves.
+``StatsCollector`` does the folding as events are taken from the daq buffer.
+"""
+import numpy as np
+
+from oleas.columnar import events_to_array
+from oleas.helpers import correct_pedestals_array
+from oleas.timing import NULL_TIMER, SpanTimer
+
+
+# output keys of the arrays returned by stack_stats()
+STATS_KEYS = ('stats_count', 'stats_mean', 'stats_variance', 'stats_min', 'stats_max')
+
+class RunningStats:
+    """Running mean, variance, minimum and maximum of event samples, per channel and sample."""
+
+    def __init__(self):
+        self._count = 0
+        self._mean: np.ndarray = None
+        self._m2: np.ndarray = None
+        self._min: np.ndarray = None
+        self._max: np.ndarray = None
+
+    @property
+    def count(self) -> int:
+        """Number of events folded in"""
+        return self._count
+
+    @property
+    def mean(self) -> np.ndarray:
+        return self._mean
+
+    @property
+    def variance(self) -> np.ndarray:
+        """Sample variance (``ddof=1``). Zero until two events were folded in."""
+        if self._count < 2:
+            return None if self._m2 is None else np.zeros_like(self._m2)
+        return self._m2 / (self._count - 1)
+
+    @property
+    def std(self) -> np.ndarray:
+        variance = self.variance
+        return None if variance is None else np.sqrt(variance)
+
+    @property
+    def min(self) -> np.ndarray:
+        return self._min
+
+    @property
+    def max(self) -> np.ndarray:
+        return self._max
+
+    def update(self, samples: np.ndarray):
+        """Fold in the samples of a single event.
+
+        Samples missing from this event or from the events folded in before are
+        treated as zeros, as ``events_to_array`` does.
+
+        Args:
+            samples (np.ndarray): samples shaped like ``(channel, sample)``
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        if samples.ndim != 2:
+            raise ValueError(f'Expected samples shaped like (channel, sample), got {samples.shape}')
+        if self._mean is None:
+            self._mean = np.zeros_like(samples)
+            self._m2 = np.zeros_like(samples)
+            self._min = samples.copy()
+            self._max = samples.copy()
+        elif samples.shape != self._mean.shape:
+            shape = np.maximum(samples.shape, self._mean.shape)
+            samples = _zero_fill(samples, shape)
+            if tuple(shape) != self._mean.shape:
+                self._mean, self._m2, self._min, self._max = (
+                    _zero_fill(x, shape) for x in (self._mean, self._m2, self._min, self._max)
+                )
+
+        self._count += 1
+        delta = samples - self._mean
+        self._mean += delta / self._count
+        self._m2 += delta * (samples - self._mean)
+        np.minimum(self._min, samples, out=self._min)
+        np.maximum(self._max, samples, out=self._max)
+
+    def update_event(self, event: dict, pedestals: dict = None):
+        """Fold in a single event.
+
+        Missing channels and samples are zero-filled (see ``events_to_array``).
+
+        Args:
+            event (dict): the event
+            pedestals (dict): if given, the event is pedestals corrected before
+                it is folded in.
+        """
+        samples, _ = events_to_array([event])
+        if pedestals is not None:
+            window_labels, _ = events_to_array([event], key='window_labels')
+            samples = correct_pedestals_array(samples, window_labels, pedestals)
+        self.update(samples[0])
+
+    def update_events(self, events: list[dict], pedestals: dict = None):
+        """Fold in a list of events, one at a time. See ``update_event()``."""
+        for event in events:
+            self.update_event(event, pedestals)
+
+    def to_dict(self) -> dict:
+        """Get the statistics as a dict with ``'count'``, ``'mean'``, ``'variance'``,
+        ``'min'`` and ``'max'`` entries. The arrays are shaped like ``(channel, sample)``.
+        """
+        return {
+            'count': self._count,
+            'mean': self.mean,
+            'variance': self.variance,
+            'min': self.min,
+            'max': self.max,
+        }
+
+
+class StatsCollector:
+    """Stands in for the event list of a point, folding each event into a
+    ``RunningStats`` as soon as it is appended.
+
+    The events are also appended to ``events`` if given, otherwise they are dropped,
+    so memory use does not depend on the number of events.
+    """
+
+    def __init__(self, pedestals: dict = None, events: list = None, timer: SpanTimer = NULL_TIMER):
+        """Constructor.
+
+        Args:
+            pedestals (dict): if given, the events are pedestals corrected before they are folded in
+            events (list | EventBlock): optional container to keep the events in
+            timer (SpanTimer): records the ``'stats'`` span
+        """
+        self.stats = RunningStats()
+        self.events = events
+        self._pedestals = pedestals
+        self._timer = timer
+
+    def __len__(self) -> int:
+        return self.stats.count
+
+    def append(self, event: dict):
+        with self._timer.span('stats'):
+            self.stats.update_event(event, pedestals=self._pedestals)
+        if self.events is not None:
+            self.events.append(event)
+
+
+def _zero_fill(array: np.ndarray, shape: tuple) -> np.ndarray:
+    """Pad an array with zeros at the end of each axis"""
+    return np.pad(array, [(0, n - m) for n, m in zip(shape, array.shape)])
+
+
+def stack_stats(stats: list) -> dict[str, np.ndarray]:
+    """Stack per-point statistics into one array per statistic.
+
+    Points without statistics have a zero count and zero-filled arrays.
+
+    Args:
+        stats (list[dict]): statistics of each point, as returned by ``RunningStats.to_dict()``.
+            Entries may be None for points without statistics.
+
+    Returns:
+        dict[str, np.ndarray]: the arrays under ``STATS_KEYS``. ``'stats_count'`` is shaped like
+            ``(point,)`` and the others like ``(point, channel, sample)``.
+    """
+    stats = [None if x is None or x['mean'] is None else x for x in stats]
+    shapes = [np.shape(x['mean']) for x in stats if x is not None]
+    shape = tuple(np.max(shapes, axis=0)) if shapes else (0, 0)
+    output = {'stats_count': np.array([0 if x is None else x['count'] for x in stats], dtype=np.int32)}
+    for name in ('mean', 'variance', 'min', 'max'):
+        array = np.zeros((len(stats),) + shape, dtype=np.float64)
+        for i, x in enumerate(stats):
+            if x is not None:
+                value = np.asarray(x[name])
+                array[(i,) + tuple(slice(0, n) for n in value.shape)] = value
+        output[f'stats_{name}'] = array
+    return output
@@ -1,4 +1,186 @@
+"""Board sensor telemetry.
 
+``TelemetrySampler`` reads the board sensors on a background thread at a fixed
+rate and keeps the most recent readings in a timestamped ring buffer, so the
+acquisition thread never waits on sensor reads. Each read holds the board lock
+(see ``oleas.backend.get_board_lock()``), which the acquisition also holds while
+it sends commands to the board, so the two never talk to the board at once.
 
-def read_sensors(board) -> dict:
-    return {}
+The daq reads the board on its own thread while the readout runs, without the
+board lock, so sensors are only read while the readout is stopped or paused
+(e.g. in ``ReadoutSession.paused()``). Reads due while it runs are skipped.
+"""
+from collections import deque
+import logging
+import threading
+import time
+
+from oleas.backend import get_board_lock, has_sensors, is_readout_active, read_sensors
+from oleas.exceptions import SensorError
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class TelemetrySampler:
+    """Background thread sampling the board sensors into a ring buffer.
+
+    Example:
+    ```
+    with TelemetrySampler(board, interval=1.0) as sampler:
+        start = time.time()
+        ...  # capture
+        window = sampler.window(start, time.time())
+    ```
+    """
+
+    def __init__(
+            self,
+            board,
+            interval: float = 1.0,
+            capacity: int = 1024,
+            lock_timeout: float = None,
+            read_fn=None,
+        ):
+        """Constructor.
+
+        Args:
+            board (Board): board object
+            interval (float): time between sensor reads in seconds
+            capacity (int): maximum number of samples kept. The oldest samples are dropped first.
+            lock_timeout (float): maximum time to wait for the board lock before skipping a read.
+                Defaults to ``interval``.
+            read_fn (callable): function reading the sensors of a board, returning a dict.
+                Defaults to ``oleas.backend.read_sensors``.
+
+        Raises:
+            SensorError: if no ``read_fn`` is given and there is no sensor backend for the board
+        """
+        if interval <= 0:
+            raise ValueError('Interval must be positive')
+        if read_fn is None:
+            if not has_sensors(board):
+                raise SensorError('No sensor backend for this board, telemetry needs a read_fn')
+            read_fn = read_sensors
+        self._board = board
+        self._interval = interval
+        self._lock_timeout = interval if lock_timeout is None else lock_timeout
+        self._read_fn = read_fn
+        self._board_lock = get_board_lock(board)
+        self._buffer = deque(maxlen=capacity)
+        self._buffer_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread = None
+        self._num_failed = 0
+        self._num_skipped = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def num_failed(self) -> int:
+        """Number of sensor reads which raised a ``SensorError``"""
+        return self._num_failed
+
+    @property
+    def num_skipped(self) -> int:
+        """Number of sensor reads skipped because the board lock was busy or the readout was running"""
+        return self._num_skipped
+
+    def __enter__(self) -> 'TelemetrySampler':
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """Start sampling on a background thread"""
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='telemetry', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """Stop sampling and wait for the thread to finish"""
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def samples(self) -> list[dict]:
+        """Get all samples in the buffer, oldest first.
+
+        Returns:
+            list[dict]: samples holding the ``'time'`` (as ``time.time()``) at which the
+                sensors were read and the ``'sensors'`` readings.
+        """
+        with self._buffer_lock:
+            return list(self._buffer)
+
+    def latest(self) -> dict:
+        """Get the most recent sample, or None if there are none"""
+        with self._buffer_lock:
+            return self._buffer[-1] if self._buffer else None
+
+    def window(self, start: float, stop: float) -> dict:
+        """Get the samples overlapping a time window, e.g. the duration of a sweep point.
+
+        If no sensors were read during the window, the last sample before it is used
+        instead, since it holds the most recent known conditions.
+
+        Args:
+            start (float): start of the window, as ``time.time()``
+            stop (float): end of the window, as ``time.time()``
+
+        Returns:
+            dict: the ``'start'`` and ``'stop'`` of the window and its ``'samples'``.
+        """
+        with self._buffer_lock:
+            samples = [sample for sample in self._buffer if start <= sample['time'] <= stop]
+            if not samples:
+                before = [sample for sample in self._buffer if sample['time'] < start]
+                samples = before[-1:]
+        return {'start': start, 'stop': stop, 'samples': samples}
+
+    def sample(self) -> 'dict | None':
+        """Read the sensors once and add the reading to the buffer.
+
+        Returns:
+            dict: the sample, or None if the read failed or was skipped.
+        """
+        if not self._board_lock.acquire(timeout=self._lock_timeout):
+            self._num_skipped += 1
+            logger.debug('Board is busy, skipping sensor read')
+            return None
+        try:
+            if is_readout_active(self._board):
+                self._num_skipped += 1
+                logger.debug('Readout is running, skipping sensor read')
+                return None
+            sensors = self._read_fn(self._board)
+        except SensorError as e:
+            self._num_failed += 1
+            logger.warning('Failed to read sensors: %s', e)
+            return None
+        finally:
+            self._board_lock.release()
+        sample = {'time': time.time(), 'sensors': sensors}
+        with self._buffer_lock:
+            self._buffer.append(sample)
+        return sample
+
+    def _run(self):
+        next_time = time.monotonic()
+        while not self._stop_event.is_set():
+            self.sample()
+            # keep a fixed rate, without trying to catch up on late reads
+            next_time += self._interval
+            now = time.monotonic()
+            if next_time < now:
+                next_time = now
+            self._stop_event.wait(next_time - now)
@@ -0,0 +1,145 @@
+"""Lightweight timing of the phases of a sweep or capture loop.
+
+A ``SpanTimer`` accumulates the time spent in named spans (e.g. ``'set_dac'``,
+``'wait'``) and counts of named occurrences (e.g. ``'retries'``) until they are
+taken with ``take()``, usually once per point. Everything taken is also added to
+totals for the whole run, see ``summary()`` and ``format_summary()``.
+
+A disabled timer hands out a shared no-op context manager, so instrumented code
+only costs a method call when timing is off.
+"""
+from contextlib import nullcontext
+import time
+
+
+_NULL_SPAN = nullcontext()
+
+
+
+class _Span:
+    """Context manager adding the time spent inside it to a timer"""
+    __slots__ = ('_timer', '_name', '_start')
+
+    def __init__(self, timer: 'SpanTimer', name: str):
+        self._timer = timer
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._timer.add(self._name, time.perf_counter() - self._start)
+        return False
+
+
+class SpanTimer:
+    """Accumulates the time spent in named spans, and counts of named occurrences.
+
+    Example:
+    ```
+    timer = SpanTimer()
+    with timer.span('trigger'):
+        bc.toggle_trigger()
+    timer.count('retries')
+    timer.take()  # {'spans': {'trigger': 0.0012}, 'counts': {'retries': 1}}
+    ```
+
+    Not thread-safe; use one timer per thread.
+    """
+
+    def __init__(self, enabled: bool = True):
+        """Constructor.
+
+        Args:
+            enabled (bool): if False, nothing is recorded and ``take()`` returns empty dicts.
+        """
+        self.enabled = enabled
+        self._spans: dict[str, float] = {}
+        self._counts: dict[str, int] = {}
+        self._totals: dict[str, dict] = {}
+        self._total_counts: dict[str, int] = {}
+        self._num_taken = 0
+
+    def span(self, name: str):
+        """Get a context manager which records the time spent inside it under ``name``"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def add(self, name: str, seconds: float):
+        """Add time to a span"""
+        if not self.enabled:
+            return
+        self._spans[name] = self._spans.get(name, 0.0) + seconds
+        total = self._totals.setdefault(name, {'total': 0.0, 'calls': 0, 'max': 0.0})
+        total['total'] += seconds
+        total['calls'] += 1
+
+    def count(self, name: str, amount: int = 1):
+        """Count occurrences of something, e.g. retries"""
+        if not self.enabled:
+            return
+        self._counts[name] = self._counts.get(name, 0) + amount
+        self._total_counts[name] = self._total_counts.get(name, 0) + amount
+
+    def take(self) -> dict:
+        """Take the spans and counts recorded since the last call.
+
+        Returns:
+            dict: ``{'spans': {name: seconds}, 'counts': {name: count}}``
+        """
+        spans, counts = self._spans, self._counts
+        self._spans, self._counts = {}, {}
+        for name, seconds in spans.items():
+            total = self._totals[name]
+            total['max'] = max(total['max'], seconds)
+        if self.enabled:
+            self._num_taken += 1
+        return {'spans': spans, 'counts': counts}
+
+    def summary(self) -> dict:
+        """Totals over everything recorded since the timer was created or reset.
+
+        Returns:
+            dict: ``{'points': int, 'spans': {name: {...}}, 'counts': {name: count}}``, where each span
+                has its ``'total'`` time in seconds, number of ``'calls'``, the ``'mean'`` time per
+                point and the ``'max'`` time for a single point.
+        """
+        points = self._num_taken
+        spans = {
+            name: {**total, 'mean': total['total'] / points if points else 0.0}
+            for name, total in self._totals.items()
+        }
+        return {'points': points, 'spans': spans, 'counts': dict(self._total_counts)}
+
+    def reset(self):
+        """Clear everything recorded"""
+        self._spans = {}
+        self._counts = {}
+        self._totals = {}
+        self._total_counts = {}
+        self._num_taken = 0
+
+
+# shared disabled timer, for code which is given no timer
+NULL_TIMER = SpanTimer(enabled=False)
+
+
+def format_summary(summary: dict) -> str:
+    """Format a ``SpanTimer.summary()`` as a table, slowest span first"""
+    spans = summary['spans']
+    grand_total = sum(span['total'] for span in spans.values())
+    lines = [
+        f'Timing over {summary["points"]} point(s)',
+        f'{"phase":<16} {"total [s]":>10} {"share":>7} {"calls":>7} {"mean/point [ms]":>16} {"max/point [ms]":>15}',
+    ]
+    for name, span in sorted(spans.items(), key=lambda item: item[1]['total'], reverse=True):
+        share = span['total'] / grand_total if grand_total else 0.0
+        lines.append(
+            f'{name:<16} {span["total"]:10.3f} {share:7.1%} {span["calls"]:7d} '
+            f'{span["mean"] * 1000:16.3f} {span["max"] * 1000:15.3f}'
+        )
+    for name, count in sorted(summary['counts'].items()):
+        lines.append(f'{name:<16} {count:>10d}')
+    return '\n'.join(lines)
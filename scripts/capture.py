@@ -1,7 +1,9 @@
 """Script for reading sensors from board and printing result or saving to file
 """
 import argparse
+from contextlib import nullcontext
 from datetime import datetime
+from functools import partial
 import logging
 from pathlib import Path
 import sys
@@ -10,29 +12,32 @@ import time
 import numpy as np
 
 from oleas.helpers import (
+    CorrectionPool,
     correct_pedestals_for_capture,
-    readout,
+    ReadoutSession,
     get_board_from_args,
     is_valid_output_file,
-    save_pickle,
+    save_output,
     select_external_i2c_bus,
     set_default_gain_stages,
     setup_logger_output,
     get_board_from_args,
     load_pedestals,
     correct_pedestals,
+    correct_pedestals_batch,
+    write_control_register,
 )
+from oleas.backend import get_board_controller, get_board_lock, get_readout_controller
+from oleas.columnar import SUFFIX as COLUMNAR_SUFFIX
+from oleas.events import read_burst, wait_for_events
 from oleas.mcp4725 import Mcp4725
 from oleas.mcp4728 import Mcp4728
-
-from naludaq.communication import ControlRegisters
-from naludaq.daq import DebugDaq
-from naludaq.controllers import (
-    get_board_controller,
-    get_readout_controller,
-    get_gainstage_controller,
-)
-from naludaq.tools.waiter import EventWaiter
+from oleas.pipeline import Pipeline
+from oleas.roi import crop_events, roi_from_gate
+from oleas.settling import event_statistic, wait_for_settle
+from oleas.stats import RunningStats, stack_stats
+from oleas.telemetry import TelemetrySampler
+from oleas.timing import NULL_TIMER, SpanTimer, format_summary
 
 # =====================================================================
 #                             CONFIGURATION
@@ -64,12 +69,49 @@ POLARITY_B = 0
 DELAY_A = 0 # This delay is being varied from DELAY_VALUES
 DELAY_B = 0
 
+# Region of interest: only keep the windows around the gate instead of the whole read window,
+# so that correcting and saving scale with the gate rather than READ_WINDOW.
+# ROI is None to derive it from DELAY_VALUES and GATE_LENGTH_A, a (start, stop) sample range,
+# or a dict of sample ranges by channel.
+CROP_EVENTS = False
+ROI = None
+SAMPLES_PER_GATE_TICK = 1.0 # samples per unit of gate delay/length
+GATE_SAMPLE_OFFSET = 0 # sample at which a gate with zero delay starts
+ROI_MARGIN = 32 # samples kept on either side of the gate
+
 # Time in seconds to let the PMT settle after adjusting the gain
 PMT_SETTLE_TIME = 0.5
 
+# Detect when the PMT has settled using probe captures instead of always waiting
+# PMT_SETTLE_TIME. PMT_SETTLE_TIME is then the maximum time to wait.
+ADAPTIVE_SETTLING = False
+SETTLE_TOLERANCE = 2.0 # ADC counts between consecutive probes
+SETTLE_CHANNEL = 0
+
+# Wait for all captures of a point together and read them out in bulk,
+# rather than waiting for each event separately
+BURST_MODE = False
+
 # number of events per (delay, dac) pair
 NUM_CAPTURES = 3
 
+# Compute the running mean/variance/min/max of the pedestals corrected events for each
+# (delay, dac) pair. With SUMMARY_ONLY, only the statistics are saved instead of the events
+RUNNING_STATS = False
+SUMMARY_ONLY = False
+
+# Time each phase of every (delay, dac) pair (setting the delay/DAC, settling, waiting, ...).
+# The timing is saved under 'timing' and a summary is printed when the script stops.
+RECORD_TIMING = False
+
+# Read the board sensors on a background thread every TELEMETRY_INTERVAL seconds (None to disable).
+# The readings overlapping each (delay, dac) pair are saved under 'telemetry'.
+TELEMETRY_INTERVAL = None
+TELEMETRY_CAPACITY = 4096
+
+# Number of iterations which can wait to be corrected/saved before capturing blocks
+PIPELINE_QUEUE_SIZE = 2
+
 # The window to read as (windows, lookback, write after trig)
 READ_WINDOW = {
     'windows': 40,
@@ -100,16 +142,19 @@ def main():
             print(f'Config file does not exist: {config_path}')
             sys.exit(1)
 
-    logger.debug('Loading pedestals from file: %s', args.pedestals)
-    try:
-        pedestals = load_pedestals(args.pedestals)
-    except:
-        print(f'Invalid pedestals file')
-        sys.exit(1)
+    pedestals = None
+    if args.pedestals is not None:
+        logger.debug('Loading pedestals from file: %s', args.pedestals)
+        try:
+            pedestals = load_pedestals(args.pedestals)
+        except:
+            print(f'Invalid pedestals file')
+            sys.exit(1)
 
     # ==========================================
     board = get_board_from_args(args, startup=True)
-    board.pedestals = pedestals
+    # a simulated board without a pedestals file uses pedestals matching its own
+    board.pedestals = pedestals if pedestals is not None else board.generate_pedestals()
     select_external_i2c_bus(board)
     set_default_gain_stages(board)
 
@@ -122,49 +167,105 @@ def main():
     
     get_readout_controller(board).set_read_window(**READ_WINDOW)
 
+    # the correction processes are started once and reused for every iteration
+    correction_pool = None
+    if args.workers:
+        correction_pool = CorrectionPool(board.pedestals, args.workers)
+    # correcting and saving run on worker threads so they don't delay the next iteration
+    pipeline = Pipeline(
+        [
+            partial(_correct_output, board=board, format=args.format, workers=correction_pool),
+            partial(_save_output, format=args.format),
+        ],
+        maxsize=PIPELINE_QUEUE_SIZE,
+        name='capture',
+    )
+    timer = SpanTimer(RECORD_TIMING)
+    board_lock = get_board_lock(board)
+    telemetry = None
+    if TELEMETRY_INTERVAL is not None:
+        telemetry = TelemetrySampler(board, interval=TELEMETRY_INTERVAL, capacity=TELEMETRY_CAPACITY)
     try:
-        while True:
-            iteration_start_time = time.time()
-            timestamp = datetime.now()
-            iteration_data: list[list[dict]] = []
-            for idx, delay in enumerate(DELAY_VALUES):
-                # set delay/gain
-                ControlRegisters(board).write('oleas_delay_a', int(delay))
-                _set_dac(board, idx)
-
-                # read events
-                data: list[dict] = []
-                try:
-                    with readout(board, READ_WINDOW) as daq:
-                        data = _read_events(board, daq, NUM_CAPTURES)
-                except KeyboardInterrupt:
-                    break
-                except:
-                    print('Error: failed to capture data!')
-                iteration_data.append(data)
-
-            output_file = output_dir / timestamp.strftime("%Y-%m-%dT %H-%M-%S.pkl")
-            output = {
-                'dac': DAC_CHANNEL_VALUES,
-                'delay': DELAY_VALUES,
-                'data': iteration_data,
-                'corrected_data': correct_pedestals_for_capture(iteration_data, board.params, board.pedestals),
-                'time': timestamp,
-            }
-            try:
-                print(f'Saving output to: {output_file}')
-                save_pickle(output_file, output)
-            except:
-                print('Failed to save output file!')
-
-            # wait until it's time for the next iteration
-            leftover_time = args.interval - (time.time() - iteration_start_time)
-            time.sleep(max(leftover_time, 0))
+        with correction_pool or nullcontext(), pipeline, telemetry or nullcontext(), ReadoutSession(board, READ_WINDOW) as session:
+            while True:
+                iteration_start_time = time.time()
+                timestamp = datetime.now()
+                iteration_data: list[list[dict]] = []
+                iteration_stats: list[dict] = []
+                settle_times: list[float] = []
+                iteration_timing: list[dict] = []
+                iteration_telemetry: list[dict] = []
+                interrupted = False
+                for idx, delay in enumerate(DELAY_VALUES):
+                    point_start_time = time.time()
+                    # set delay/gain and settle with the readout paused, leftover events are flushed on resume.
+                    # The telemetry sensors can only be read in the meantime.
+                    with session.paused():
+                        with board_lock:
+                            with timer.span('set_delay'):
+                                write_control_register(board, 'oleas_delay_a', int(delay))
+                            with timer.span('set_dac'):
+                                dac_changed = _set_dac(board, idx)
+                        with timer.span('settle'):
+                            settle_times.append(_settle(session) if dac_changed else 0.0)
+
+                    # read events
+                    data: list[dict] = []
+                    try:
+                        data = _read_events(board, session.daq, NUM_CAPTURES, timer)
+                    except KeyboardInterrupt:
+                        interrupted = True
+                        break
+                    except:
+                        print('Error: failed to capture data!')
+                    if CROP_EVENTS:
+                        with timer.span('roi'):
+                            data = crop_events(data, _event_roi(delay), board.params['samples'])
+                    if RUNNING_STATS or SUMMARY_ONLY:
+                        with timer.span('stats'):
+                            stats = RunningStats()
+                            stats.update_events(data, pedestals=board.pedestals)
+                        iteration_stats.append(stats.to_dict())
+                    if RECORD_TIMING:
+                        iteration_timing.append(timer.take())
+                    if telemetry is not None:
+                        iteration_telemetry.append(telemetry.window(point_start_time, time.time()))
+                    if not SUMMARY_ONLY:
+                        iteration_data.append(data)
+
+                suffix = '.pkl' if args.format == 'pickle' else COLUMNAR_SUFFIX
+                output_file = output_dir / (timestamp.strftime("%Y-%m-%dT %H-%M-%S") + suffix)
+                output = {
+                    'dac': DAC_CHANNEL_VALUES,
+                    'delay': DELAY_VALUES,
+                    'time': timestamp,
+                    'settle_times': settle_times,
+                }
+                if RUNNING_STATS or SUMMARY_ONLY:
+                    output.update(stack_stats(iteration_stats))
+                if RECORD_TIMING:
+                    output['timing'] = iteration_timing
+                if telemetry is not None:
+                    output['telemetry'] = iteration_telemetry
+                if not SUMMARY_ONLY:
+                    output['data'] = iteration_data
+                # blocks if the workers are falling behind
+                pipeline.put((output_file, output))
+                if interrupted:
+                    # stop after saving the points captured so far
+                    raise KeyboardInterrupt
+
+                # wait until it's time for the next iteration
+                leftover_time = args.interval - (time.time() - iteration_start_time)
+                with session.paused():
+                    time.sleep(max(leftover_time, 0))
     except KeyboardInterrupt:
         print('Interrupted')
         pass
     finally:
         bc.set_oleas_enabled(en_trig = 0, en_a = 0, en_b = 0)
+        if RECORD_TIMING:
+            print(format_summary(timer.summary()))
 
 def parse_args(argv):
     """Parse command line arguments"""
@@ -172,45 +273,114 @@ def parse_args(argv):
     parser = argparse.ArgumentParser(description='Run sweep of gated PMT')
     # required
     parser.add_argument('--output', '-o', type=Path, required=True, help='Output directory')
-    parser.add_argument('--serial', '-s', type=str, required=True, help='FTDI serial number of board')
-    parser.add_argument('--pedestals', '-p', type=Path, required=True, help='Path to pedestals file')
+    parser.add_argument('--serial', '-s', type=str, default=None, help='FTDI serial number of board. Required unless --simulate is given')
+    parser.add_argument('--pedestals', '-p', type=Path, default=None, help='Path to pedestals file. Required unless --simulate is given')
     parser.add_argument('--interval', '-i', type=float, required=True, help='Time interval between iterations in seconds')
 
     # optional
     parser.add_argument('--model', '-m', type=str, default=default_model, help=f'Board model. Defaults to "{default_model}"')
     parser.add_argument('--baudrate', '-b', type=int, default=None, help='Baud rate. Defaults to fastest available.')
     parser.add_argument('--config', '-c', type=Path, default=None, help='Configuration file to startup the board')
+    parser.add_argument('--workers', '-w', type=int, default=None, help='Number of processes to correct pedestals with. Defaults to correcting on a worker thread')
+    parser.add_argument('--format', '-f', choices=['pickle', 'columnar'], default='pickle', help='Output file format. Defaults to "pickle"')
+    parser.add_argument('--simulate', action='store_true', help='Use a simulated board instead of connecting to one')
     parser.add_argument('--debug', '-d', action='store_true', help='Show debug messages')
-    return parser.parse_args(argv)
+    args = parser.parse_args(argv)
+    if not args.simulate and (args.serial is None or args.pedestals is None):
+        parser.error('--serial and --pedestals are required unless --simulate is given')
+    return args
+
+
+def _correct_output(item, board, format, workers):
+    output_file, output = item
+    if 'data' not in output:
+        return output_file, output
+    if format == 'columnar':
+        corrected_data, _ = correct_pedestals_batch(output['data'], board.pedestals, workers=workers)
+    else:
+        corrected_data = correct_pedestals_for_capture(output['data'], board.params, board.pedestals, workers=workers)
+    output['corrected_data'] = corrected_data
+    return output_file, output
+
+
+def _save_output(item, format):
+    output_file, output = item
+    try:
+        print(f'Saving output to: {output_file}')
+        save_output(output_file, output, format)
+    except:
+        print('Failed to save output file!')
+
+
+def _event_roi(delay):
+    """Get the region of interest to crop events to at a gate delay"""
+    if ROI is not None:
+        return ROI
+    return roi_from_gate(
+        delay,
+        GATE_LENGTH_A,
+        samples_per_tick=SAMPLES_PER_GATE_TICK,
+        offset=GATE_SAMPLE_OFFSET,
+        margin=ROI_MARGIN,
+    )
 
 
 def _set_dac(board, idx):
-    logger.info('Setting dac to %s', np.array(DAC_CHANNEL_VALUES)[:, idx])
+    values = np.array(DAC_CHANNEL_VALUES)[:, idx]
+    logger.info('Setting dac to %s', values)
     # Mcp4725(self._board).set_normalized_value(value)
-    for dac_channel, dac_value in enumerate(np.array(DAC_CHANNEL_VALUES)[:, idx]):
-        Mcp4728(board).set_normalized_value(
-        channel=dac_channel,
-        value=dac_value,
+    # all channels are written in a single transaction, so they can settle together
+    return Mcp4728(board).set_normalized_values(
+        {dac_channel: dac_value for dac_channel, dac_value in enumerate(values)},
         vref=DAC_VREF,
         gain=DAC_GAIN,
-        )
-        time.sleep(0.1)
-    time.sleep(PMT_SETTLE_TIME)
+    )
+
+
+def _settle(session) -> float:
+    """Wait for the PMT to settle after a DAC change, returns the time taken.
+    Called with the readout paused.
+    """
+    if not ADAPTIVE_SETTLING:
+        time.sleep(PMT_SETTLE_TIME)
+        return PMT_SETTLE_TIME
 
-def _read_events(board, daq, amount):
+    # the probes need the readout
+    session.resume()
+    buffer = session.daq.output_buffer
+
+    def probe():
+        events = read_burst(buffer, 1, attempts=1, timeout=PMT_SETTLE_TIME)
+        if len(events) == 0:
+            raise TimeoutError('No probe event')
+        return event_statistic(events[0], SETTLE_CHANNEL)
+
+    settle_time = wait_for_settle(probe, SETTLE_TOLERANCE, max_time=PMT_SETTLE_TIME)
+    session.flush()
+    return settle_time
+
+
+def _read_events(board, daq, amount, timer: SpanTimer = NULL_TIMER):
     bc = get_board_controller(board)
     buffer = daq.output_buffer
     output = []
 
+    if BURST_MODE:
+        output = read_burst(buffer, amount, attempts=5, timeout=1, timer=timer)
+        if len(output) < amount:
+            logger.error('Maximum number of attempts reached. Aborting.')
+        return output
+
     for _ in range(amount):
 
         for _ in range(5):
             try:
-                waiter = EventWaiter(buffer, amount=1, timeout=1, interval=0.005)
-                waiter.start(blocking=True)
+                with timer.span('wait'):
+                    wait_for_events(buffer, amount=1, timeout=1, interval=0.005)
                 output.append(buffer.popleft())
             except (TimeoutError, IndexError):
                 logger.info('Failed to get event, trying again...')
+                timer.count('retries')
                 continue
             else:
                 break
@@ -0,0 +1,155 @@
+"""Script for running the sweep or capture script on several boards at once
+"""
+import argparse
+import json
+import logging
+from pathlib import Path
+import sys
+
+from oleas.columnar import SUFFIX as COLUMNAR_SUFFIX
+from oleas.helpers import (
+    is_valid_output_file,
+    load_output,
+    save_output,
+    setup_logger_output,
+)
+from oleas.multi_board import merge_outputs, run_boards
+
+# =====================================================================
+#                             CONFIGURATION
+# =====================================================================
+# Time in seconds between checks for boards which have finished
+POLL_INTERVAL = 0.5
+# ==================================================================
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+logger = logging.getLogger(__name__)
+
+
+def main():
+    args, script_args = parse_args(sys.argv[1:])
+    if args.debug:
+        setup_logger_output()
+        script_args.append('--debug')
+
+    serials = args.serial if not args.all else _connected_serials()
+    if len(serials) == 0:
+        print('No boards given')
+        sys.exit(1)
+    if len(set(serials)) != len(serials):
+        print('Serial numbers must be unique')
+        sys.exit(1)
+    pedestals = _pedestals_by_serial(serials, args.pedestals)
+
+    if args.script == 'sweep':
+        if not is_valid_output_file(args.output):
+            print(f'Output file is not valid: {args.output}')
+            sys.exit(1)
+        board_dir = args.output.with_name(args.output.stem + '.boards')
+    else:
+        board_dir = args.output.resolve()
+        if not board_dir.exists():
+            print(f'Output directory does not exist: {board_dir}')
+            sys.exit(1)
+    board_dir.mkdir(parents=True, exist_ok=True)
+
+    # ==========================================
+    suffix = '.pkl' if args.format == 'pickle' else COLUMNAR_SUFFIX
+    board_outputs = {}
+    board_args = {}
+    for serial in serials:
+        if args.script == 'sweep':
+            board_outputs[serial] = board_dir / f'{serial}{suffix}'
+        else:
+            board_outputs[serial] = board_dir / serial
+            board_outputs[serial].mkdir(exist_ok=True)
+        board_args[serial] = [
+            '--serial', serial,
+            '--output', str(board_outputs[serial]),
+            '--format', args.format,
+            *(['--pedestals', str(pedestals[serial])] if pedestals[serial] is not None else []),
+            *(['--simulate'] if args.simulate else []),
+            *script_args,
+        ]
+
+    runs = run_boards(SCRIPTS_DIR / f'{args.script}.py', board_args, board_dir, poll_interval=POLL_INTERVAL)
+    failed = [serial for serial, run in runs.items() if not run.ok]
+    for serial in failed:
+        print(f'Board {serial} failed, see {runs[serial].log_file}')
+
+    # ==========================================
+    if args.script == 'sweep':
+        outputs = {}
+        for serial, path in board_outputs.items():
+            outputs[serial] = load_output(path) if runs[serial].ok and path.exists() else None
+        merged = merge_outputs(outputs)
+        print(f'Saving merged output to: {args.output}')
+        save_output(args.output, merged, args.format)
+    else:
+        index = {
+            'boards': serials,
+            'failed_boards': failed,
+            'directories': {serial: str(path) for serial, path in board_outputs.items()},
+        }
+        with open(board_dir / 'boards.json', 'w') as f:
+            json.dump(index, f, indent=2)
+
+    if len(failed) == len(serials):
+        sys.exit(1)
+
+
+def _connected_serials() -> list[str]:
+    """Get the serial numbers of the connected boards, as shown by scripts/show_boards.py"""
+    from naludaq.tools.ftdi import list_ftdi_devices
+    try:
+        devices = list_ftdi_devices(valid_only=True, bytes_to_str=True)
+    except Exception:
+        print('Cannot list devices. Is FTDI installed?')
+        sys.exit(1)
+    return [device['serial'] for device in devices.values()]
+
+
+def _pedestals_by_serial(serials: list[str], pedestals: list[Path]) -> dict:
+    """Match the pedestals files to the boards.
+
+    ``pedestals`` is either one file per board, in the same order as the serial numbers,
+    or a single directory holding a ``<serial>.pkl`` file for each board.
+    """
+    if pedestals is None:
+        return {serial: None for serial in serials}
+    if len(pedestals) == 1 and pedestals[0].is_dir():
+        return {serial: pedestals[0] / f'{serial}.pkl' for serial in serials}
+    if len(pedestals) != len(serials):
+        print('Give one pedestals file per board, or a directory of pedestals files')
+        sys.exit(1)
+    return dict(zip(serials, pedestals))
+
+
+def parse_args(argv):
+    """Parse command line arguments. Unknown arguments are passed on to the script run for each board."""
+    parser = argparse.ArgumentParser(
+        description='Run the sweep or capture script on several boards at once',
+        epilog='Any other arguments (e.g. --interval, --model, --adaptive) are passed on to the script.',
+    )
+    # required
+    parser.add_argument('script', choices=['sweep', 'capture'], help='Script to run for each board')
+    parser.add_argument('--output', '-o', type=Path, required=True, help='Merged output file for sweeps, or output directory for captures')
+    boards = parser.add_mutually_exclusive_group(required=True)
+    boards.add_argument('--serial', '-s', type=str, nargs='+', help='FTDI serial numbers of the boards. Any unique names with --simulate')
+    boards.add_argument('--all', action='store_true', help='Use all connected boards (see scripts/show_boards.py)')
+    parser.add_argument('--pedestals', '-p', type=Path, nargs='+', default=None, help='Pedestals file of each board, or a directory holding "<serial>.pkl" for each board. Required unless --simulate is given')
+
+    # optional
+    parser.add_argument('--format', '-f', choices=['pickle', 'columnar'], default='pickle', help='Output file format. Defaults to "pickle"')
+    parser.add_argument('--simulate', action='store_true', help='Use simulated boards instead of connecting to them')
+    parser.add_argument('--debug', '-d', action='store_true', help='Show debug messages')
+    args, script_args = parser.parse_known_args(argv)
+    if not args.simulate and args.pedestals is None:
+        parser.error('--pedestals is required unless --simulate is given')
+    if args.simulate and args.all:
+        parser.error('--all cannot be used with --simulate')
+    return args, script_args
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,30 @@
 """Script for reading sensors from board and printing result or saving to file
 """
 import argparse
+from contextlib import nullcontext
 import logging
 from pathlib import Path
 import sys
 
 import numpy as np
 
-from naludaq.communication import ControlRegisters
-from naludaq.controllers import get_gainstage_controller
-
+from oleas.exceptions import DataCaptureError
+from oleas.features import stack_features
 from oleas.gate_pmt_sweep import GateDelayPmtDacSweep
+from oleas.stats import stack_stats
+from oleas.telemetry import TelemetrySampler
+from oleas.timing import format_summary
 from oleas.helpers import (
     get_board_from_args,
     is_valid_output_file,
-    save_pickle,
+    save_output,
     setup_logger_output,
     get_board_from_args,
     load_pedestals,
     correct_pedestals,
+    correct_pedestals_batch,
+    correct_pedestals_for_capture,
+    integrated_charge,
     select_external_i2c_bus,
     set_default_gain_stages,
 )
@@ -32,6 +38,14 @@ DELAY_VALUES = np.arange(0, 1000, 100)
 # array of normalized dac values
 DAC_VALUES = np.linspace(0.0, 1.0, 10)
 
+
+def is_useful_point(delay, dac) -> bool:
+    """Return False for (delay, dac) combinations which do not need to be captured.
+    Skipped points have no events in the output.
+    """
+    return True
+
+
 # number of events per (delay, dac) pair
 NUM_CAPTURES = 3
 
@@ -43,6 +57,62 @@ DAC_GAIN = 1
 # Time in seconds to let the PMT settle after adjusting the gain
 PMT_SETTLE_TIME = 0.5
 
+# Detect when the PMT has settled using probe captures instead of always waiting
+# PMT_SETTLE_TIME. PMT_SETTLE_TIME is then the maximum time to wait.
+ADAPTIVE_SETTLING = False
+SETTLE_TOLERANCE = 2.0 # ADC counts between consecutive probes
+SETTLE_CHANNEL = 0
+
+# Approximate time in seconds needed to change the gate delay. Used together
+# with PMT_SETTLE_TIME to pick the cheapest order to sweep the axes in.
+DELAY_CHANGE_TIME = 0.001
+
+# Compute the running mean/variance/min/max of the pedestals corrected events at each point.
+# With SUMMARY_ONLY, only the statistics are kept instead of the events. Not used for --adaptive sweeps.
+RUNNING_STATS = False
+SUMMARY_ONLY = False
+
+# Extract the baseline, amplitude, peak sample and integral of each event and channel.
+# With FEATURES_ONLY, only the features are kept instead of the events. Not used for --adaptive sweeps.
+EXTRACT_FEATURES = False
+FEATURES_ONLY = False
+FEATURE_GATE = None # (start, stop) sample range to integrate over, or None for all samples
+
+# Region of interest: only keep the windows overlapping this (start, stop) sample range
+# (or a dict of ranges by channel) instead of the whole read window. None to keep all samples.
+ROI = None
+
+# Store the events of each point as compact arrays (oleas.event_block.EventBlock) instead of
+# event dicts. Iterating over a block gives back event dicts.
+COMPACT_EVENTS = False
+
+# Time each phase of every point (setting the delay/DAC, settling, triggering, waiting, ...).
+# The timing of each point is saved under 'timing' and a summary is printed at the end.
+RECORD_TIMING = False
+
+# Read the board sensors on a background thread every TELEMETRY_INTERVAL seconds (None to disable).
+# The readings overlapping each point are saved under 'telemetry'. At most TELEMETRY_CAPACITY
+# readings are kept, so it must cover the duration of a point.
+TELEMETRY_INTERVAL = None
+TELEMETRY_CAPACITY = 4096
+
+# Trigger all captures for a point back-to-back, then read them out together
+BURST_MODE = False
+
+# Reverse the direction of the inner axis on every other pass so that
+# consecutive points only differ along one axis
+SERPENTINE = True
+
+# Coarse-to-fine sweep (--adaptive): the coarse grid is refined wherever the
+# integrated charge changes by more than REFINE_THRESHOLD between neighbouring points
+COARSE_DELAY_VALUES = np.arange(0, 1000, 200)
+COARSE_DAC_VALUES = np.linspace(0.0, 1.0, 5)
+REFINE_THRESHOLD = 1000.0 # ADC counts x samples
+REFINE_CHANNEL = 0
+MAX_POINTS = 100
+# smallest spacing between refined points along the delay and DAC axes (one DAC code)
+MIN_STEP = [1, 1 / 4095]
+
 # The window to read as (windows, lookback, write after trig)
 READ_WINDOW = {
     'windows': 8,
@@ -71,36 +141,172 @@ def main():
             print(f'Config file does not exist: {config_path}')
             sys.exit(1)
 
-    logger.debug('Loading pedestals from file: %s', args.pedestals)
-    try:
-        pedestals = load_pedestals(args.pedestals)
-    except:
-        print(f'Invalid pedestals file')
-        sys.exit(1)
+    pedestals = None
+    if args.pedestals is not None:
+        logger.debug('Loading pedestals from file: %s', args.pedestals)
+        try:
+            pedestals = load_pedestals(args.pedestals)
+        except:
+            print(f'Invalid pedestals file')
+            sys.exit(1)
 
     # ==========================================
     board = get_board_from_args(args, startup=True)
-    board.pedestals = pedestals
+    # a simulated board without a pedestals file uses pedestals matching its own
+    board.pedestals = pedestals if pedestals is not None else board.generate_pedestals()
     select_external_i2c_bus(board)
     set_default_gain_stages(board)
 
     # Set up the sweep controller
-    sweeper = GateDelayPmtDacSweep(board, DELAY_VALUES, DAC_VALUES, NUM_CAPTURES)
+    if args.adaptive:
+        sweeper = GateDelayPmtDacSweep(board, COARSE_DELAY_VALUES, COARSE_DAC_VALUES, NUM_CAPTURES)
+    else:
+        sweeper = GateDelayPmtDacSweep(board, DELAY_VALUES, DAC_VALUES, NUM_CAPTURES)
     sweeper.set_read_window(READ_WINDOW)
     sweeper.configure_dac(DAC_CHANNEL, DAC_VREF, DAC_GAIN)
     sweeper.set_pmt_settling_time(PMT_SETTLE_TIME)
+    if ADAPTIVE_SETTLING:
+        sweeper.set_adaptive_settling(SETTLE_TOLERANCE, max_time=PMT_SETTLE_TIME, channel=SETTLE_CHANNEL)
+    sweeper.set_burst_mode(BURST_MODE)
+    sweeper.set_roi(ROI)
+    sweeper.set_compact_events(COMPACT_EVENTS)
+    summary_only = SUMMARY_ONLY and not args.adaptive
+    sweeper.set_running_stats(RUNNING_STATS or summary_only, summary_only=summary_only, pedestals=board.pedestals)
+    features_only = FEATURES_ONLY and not args.adaptive
+    sweeper.set_feature_extraction(
+        EXTRACT_FEATURES or features_only,
+        features_only=features_only,
+        gate=FEATURE_GATE,
+        pedestals=board.pedestals,
+    )
+    sweeper.set_traversal(axis_costs=[DELAY_CHANGE_TIME, PMT_SETTLE_TIME], serpentine=SERPENTINE)
+    sweeper.set_timing(RECORD_TIMING)
+    telemetry = None
+    if TELEMETRY_INTERVAL is not None:
+        telemetry = TelemetrySampler(board, interval=TELEMETRY_INTERVAL, capacity=TELEMETRY_CAPACITY)
+    sweeper.set_telemetry(telemetry)
 
-    # Run the sweep
-    sweep_data = sweeper.run()
+    with telemetry or nullcontext():
+        if args.adaptive:
+            output = _run_adaptive(sweeper, board, args)
+        else:
+            output = _run_grid(sweeper, board, args)
+    if RECORD_TIMING:
+        print(format_summary(sweeper.timing_summary()))
+    save_output(args.output, output, args.format)
+    if not args.adaptive:
+        # the results are saved, so the journal is no longer needed
+        _checkpoint_path(args).unlink(missing_ok=True)
+
+
+def _run_grid(sweeper: GateDelayPmtDacSweep, board, args) -> dict:
+    """Run the sweep over the grid, skipping points rejected by is_useful_point()"""
+    mask = np.array([[is_useful_point(delay, dac) for dac in DAC_VALUES] for delay in DELAY_VALUES])
+    sweeper.select_points(mask=mask)
+    logger.info('Sweeping %s/%s points', sweeper.num_points, mask.size)
+
+    checkpoint = _checkpoint_path(args)
+    try:
+        sweep_data = sweeper.run(checkpoint=checkpoint, resume=args.resume)
+    except DataCaptureError as e:
+        print(f'Sweep failed: {e}')
+        print(f'Completed points were saved to {checkpoint}. Run again with --resume to continue.')
+        sys.exit(1)
 
-    # ==========================================
     output = {
         'dac': DAC_VALUES,
         'delay': DELAY_VALUES,
+        'point_info': sweeper.to_nested(sweeper.point_info),
+    }
+    if RECORD_TIMING:
+        output['timing'] = sweeper.to_nested(sweeper.point_timing)
+    if TELEMETRY_INTERVAL is not None:
+        output['telemetry'] = sweeper.to_nested(sweeper.point_telemetry)
+    if SUMMARY_ONLY or FEATURES_ONLY:
+        # the events were dropped, the result of each point holds its statistics/features instead
+        if RUNNING_STATS or SUMMARY_ONLY:
+            output.update(_stack_stats(_summary_entries(sweep_data, 'stats')))
+        if EXTRACT_FEATURES or FEATURES_ONLY:
+            output['features'], output['feature_counts'] = _stack_features(_summary_entries(sweep_data, 'features'))
+        return output
+    sweep_data = [[events if events is not None else [] for events in row] for row in sweep_data]
+
+    # ==========================================
+    if args.format == 'columnar':
+        corrected_data, _ = correct_pedestals_batch(sweep_data, board.pedestals, workers=args.workers)
+    else:
+        corrected_data = correct_pedestals(sweep_data, board.params, board.pedestals, workers=args.workers)
+    output['data'] = sweep_data
+    output['corrected_data'] = corrected_data
+    if RUNNING_STATS:
+        output.update(_stack_stats(sweeper.to_nested(sweeper.point_stats)))
+    if EXTRACT_FEATURES:
+        output['features'], output['feature_counts'] = _stack_features(sweeper.to_nested(sweeper.point_features))
+    return output
+
+
+def _checkpoint_path(args) -> Path:
+    return args.checkpoint or args.output.with_suffix('.journal')
+
+
+def _summary_entries(sweep_data: list, key: str) -> list:
+    """Get an entry of the result of each point in summary/features-only mode"""
+    return [[None if summary is None else summary.get(key) for summary in row] for row in sweep_data]
+
+
+def _stack_features(tables: list) -> tuple[np.ndarray, np.ndarray]:
+    """Stack the feature table of each point into an array shaped like (delay, dac, capture, channel)"""
+    features, counts = stack_features([table for row in tables for table in row])
+    shape = (len(DELAY_VALUES), len(DAC_VALUES))
+    return features.reshape(shape + features.shape[1:]), counts.reshape(shape)
+
+
+def _stack_stats(stats: list) -> dict[str, np.ndarray]:
+    """Stack the statistics of each point into arrays shaped like (delay, dac, channel, sample)"""
+    shape = (len(DELAY_VALUES), len(DAC_VALUES))
+    return {
+        key: value.reshape(shape + value.shape[1:])
+        for key, value in stack_stats([point for row in stats for point in row]).items()
+    }
+
+
+def _run_adaptive(sweeper: GateDelayPmtDacSweep, board, args) -> dict:
+    """Run a coarse-to-fine sweep, the output is a list of points"""
+    try:
+        results = sweeper.run_adaptive(
+            metric=lambda events: integrated_charge(events, REFINE_CHANNEL),
+            threshold=REFINE_THRESHOLD,
+            max_points=MAX_POINTS,
+            min_step=MIN_STEP,
+        )
+    except DataCaptureError as e:
+        print(f'Sweep failed: {e}')
+        sys.exit(1)
+
+    points = list(results.keys())
+    sweep_data = list(results.values())
+    if args.format == 'columnar':
+        corrected_data, _ = correct_pedestals_batch(sweep_data, board.pedestals, workers=args.workers)
+    else:
+        corrected_data = correct_pedestals_for_capture(sweep_data, board.params, board.pedestals, workers=args.workers)
+    output = {
+        'delay': [delay for delay, _ in points],
+        'dac': [dac for _, dac in points],
         'data': sweep_data,
-        'corrected_data': correct_pedestals(sweep_data, board.params, board.pedestals),
+        'corrected_data': corrected_data,
+        'point_info': [sweeper.point_info.get(point) for point in points],
     }
-    save_pickle(args.output, output)
+    if RUNNING_STATS:
+        output.update(stack_stats([sweeper.point_stats.get(point) for point in points]))
+    if RECORD_TIMING:
+        output['timing'] = [sweeper.point_timing.get(point) for point in points]
+    if TELEMETRY_INTERVAL is not None:
+        output['telemetry'] = [sweeper.point_telemetry.get(point) for point in points]
+    if EXTRACT_FEATURES:
+        output['features'], output['feature_counts'] = stack_features(
+            [sweeper.point_features.get(point) for point in points]
+        )
+    return output
 
 
 def parse_args(argv):
@@ -108,16 +314,25 @@ def parse_args(argv):
     default_model = 'aodsoc_aods'
     parser = argparse.ArgumentParser(description='Run sweep of gated PMT')
     # required
-    parser.add_argument('--output', '-o', type=Path, required=True, help='Output file (pickle)')
-    parser.add_argument('--serial', '-s', type=str, required=True, help='FTDI serial number of board')
-    parser.add_argument('--pedestals', '-p', type=Path, required=True, help='Path to pedestals file')
+    parser.add_argument('--output', '-o', type=Path, required=True, help='Output file')
+    parser.add_argument('--serial', '-s', type=str, default=None, help='FTDI serial number of board. Required unless --simulate is given')
+    parser.add_argument('--pedestals', '-p', type=Path, default=None, help='Path to pedestals file. Required unless --simulate is given')
 
     # optional
     parser.add_argument('--model', '-m', type=str, default=default_model, help=f'Board model. Defaults to "{default_model}"')
     parser.add_argument('--baudrate', '-b', type=int, default=None, help='Baud rate. Defaults to fastest available.')
     parser.add_argument('--config', '-c', type=Path, default=None, help='Configuration file to startup the board')
+    parser.add_argument('--format', '-f', choices=['pickle', 'columnar'], default='pickle', help='Output file format. Defaults to "pickle"')
+    parser.add_argument('--adaptive', '-a', action='store_true', help='Run a coarse-to-fine sweep instead of the full grid')
+    parser.add_argument('--workers', '-w', type=int, default=None, help='Number of processes to correct pedestals with. Defaults to correcting on the main process')
+    parser.add_argument('--checkpoint', type=Path, default=None, help='Checkpoint journal file. Defaults to the output file with a ".journal" suffix')
+    parser.add_argument('--resume', '-r', action='store_true', help='Resume an interrupted sweep from the checkpoint journal')
+    parser.add_argument('--simulate', action='store_true', help='Use a simulated board instead of connecting to one')
     parser.add_argument('--debug', '-d', action='store_true', help='Show debug messages')
-    return parser.parse_args(argv)
+    args = parser.parse_args(argv)
+    if not args.simulate and (args.serial is None or args.pedestals is None):
+        parser.error('--serial and --pedestals are required unless --simulate is given')
+    return args
 
 
 if __name__ == '__main__':
@@ -1,12 +1,13 @@
 import argparse
 import os
 from pathlib import Path
-import pickle
 import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
 
+from oleas.columnar import load_output
+
 
 def main():
     args = parse_args(sys.argv[1:])
@@ -53,16 +54,15 @@ def main():
 
 
 def plot_file(fig, file: Path):
-    """Plot a single file from the capture script output
+    """Plot a single file from the capture script output (pickle or columnar)
 
     Args:
         fig: matplotlib figure
         file (Path): path to file
     """
-    with open(file, "rb") as f:
-        data = pickle.load(f)
+    data = load_output(file)
 
-    NUM_SETTINGS = len(data["corrected_data"])
+    NUM_SETTINGS = len(data["corrected_data"] if "corrected_data" in data else data["stats_mean"])
     subfigs = fig.subfigures(nrows=NUM_SETTINGS, ncols=1)
     for setting, subfig in enumerate(subfigs):
         delay = data["delay"][setting]
@@ -74,14 +74,13 @@ def plot_file(fig, file: Path):
             colors = plt.rcParams["axes.prop_cycle"].by_key()["color"][
                 channel * 2 : channel * 2 + 2
             ]
-            unaveraged_data = data["corrected_data"][setting]
             ax.plot(
-                average_for_channel(unaveraged_data, channel=channel),
+                average_for_setting(data, setting, channel=channel),
                 label=f"Channel {channel}",
                 color=colors[0],
             )
             ax.plot(
-                average_for_channel(unaveraged_data, channel=channel + 4),
+                average_for_setting(data, setting, channel=channel + 4),
                 label=f"Channel {channel + 4}",
                 color=colors[1],
             )
@@ -98,8 +97,28 @@ def plot_file(fig, file: Path):
     plt.draw()
 
 
-def average_for_channel(data: list[dict], channel: int):
-    """Compute average of captures for a single channel"""
+def average_for_setting(data: dict, setting: int, channel: int):
+    """Get the average of the captures for a single setting and channel.
+
+    Uses the corrected events if the file has them, otherwise the running
+    statistics saved in summary-only mode.
+    """
+    if "corrected_data" not in data:
+        return data["stats_mean"][setting][channel]
+    unaveraged_data = data["corrected_data"][setting]
+    if "counts" in data:
+        unaveraged_data = unaveraged_data[: data["counts"][setting]]
+    return average_for_channel(unaveraged_data, channel=channel)
+
+
+def average_for_channel(data: "list[dict] | np.ndarray", channel: int):
+    """Compute average of captures for a single channel.
+
+    Accepts either a list of events or an array shaped like (capture, channel, sample)
+    from a columnar file.
+    """
+    if isinstance(data, np.ndarray):
+        return np.mean(data[:, channel], axis=0)
     return np.mean(np.array([x["data"][channel] for x in data]), axis=0)
 
 
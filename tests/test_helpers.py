@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('naludaq')
+
+from oleas.helpers import integrated_charge
+
+
+def test_integrated_charge_sums_samples_above_baseline():
+    # median 0, a pulse of 10 + 5 above it and a dip of -8 below it which is not counted
+    samples = [0, 0, 10, 5, 0, -8, 0]
+    events = [{'data': [np.zeros(7), np.array(samples)]}] * 3
+
+    assert integrated_charge(events, 1) == 15.0
+    assert integrated_charge(events, 0) == 0.0
+    assert integrated_charge([], 1) == 0.0
@@ -0,0 +1,115 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from oleas.nd_sweep import NdSweep
+
+
+class _Sweep(NdSweep):
+    def _run_for_point(self):
+        return self.current_index
+
+
+def _path(sweep: NdSweep) -> list[tuple]:
+    return [index for index, _, _ in sweep.iter_points()]
+
+
+def _path_cost(path: list[tuple], costs: list[float]) -> float:
+    return sum(
+        sum(cost for i, j, cost in zip(index, previous, costs) if i != j)
+        for previous, index in zip(path, path[1:])
+    )
+
+
+@pytest.mark.parametrize('shape', [(2, 2, 2), (3, 2, 4), (2, 3, 2, 2)])
+def test_serpentine_steps_along_one_axis(shape):
+    sweep = _Sweep([np.arange(n) for n in shape], serpentine=True)
+    path = _path(sweep)
+
+    assert sorted(path) == list(itertools.product(*(range(n) for n in shape)))
+    for previous, index in zip(path, path[1:]):
+        changed = [axis for axis in range(len(shape)) if index[axis] != previous[axis]]
+        assert len(changed) == 1, f'{previous} -> {index}'
+        assert abs(index[changed[0]] - previous[changed[0]]) == 1
+
+
+@pytest.mark.parametrize('serpentine', [False, True])
+def test_traversal_cost_matches_path(serpentine):
+    costs = [1.0, 10.0, 100.0]
+    sweep = _Sweep([np.arange(2), np.arange(3), np.arange(2)], axis_costs=costs, serpentine=serpentine)
+    for order in itertools.permutations(range(3)):
+        path = list(sweep._iter_indices(order))
+        assert sweep._traversal_cost(order) == pytest.approx(_path_cost(path, costs))
+
+
+class _PointSweep(NdSweep):
+    def __init__(self, axis_values, resolution=0):
+        super().__init__(axis_values)
+        self._resolution = resolution
+
+    def _axis_resolution(self, axis):
+        return self._resolution
+
+    def _run_for_point(self):
+        return self.current_point
+
+
+def _two_edges(point):
+    x, y = point
+    return 100.0 * (x > 0.33) + 10.0 * (y > 0.61)
+
+
+def test_adaptive_stops_at_axis_resolution():
+    sweep = _PointSweep([np.linspace(0, 1, 3), np.linspace(0, 1, 3)], resolution=0.05)
+    results = sweep.run_adaptive(_two_edges, threshold=1.0, max_points=10_000)
+
+    for axis in range(2):
+        values = np.unique([point[axis] for point in results])
+        assert np.min(np.diff(values)) >= 0.05
+
+
+def test_adaptive_refines_every_edge():
+    sweep = _PointSweep([np.linspace(0, 1, 3), np.array([0.0, 1.0])])
+    results = sweep.run_adaptive(lambda point: 100.0 * (point[0] > 0.13) + 10.0 * (point[0] > 0.71), threshold=1.0, max_points=60)
+
+    # the weaker edge is refined too, not only the strongest one
+    xs = np.unique([x for x, _ in results])
+    assert np.min(np.abs(xs - 0.71)) < 0.1
+
+
+def test_select_points_tolerates_float_rounding():
+    sweep = _Sweep([np.linspace(0, 1, 11), np.arange(3)])
+    sweep.select_points(points=[(0.1 + 0.2, 1)])
+
+    assert _path(sweep) == [(3, 1)]
+
+
+class _AnnotatedSweep(_Sweep):
+    def __init__(self, axis_values, fail_at=None):
+        super().__init__(axis_values)
+        self.annotations = {}
+        self._fail_at = fail_at
+
+    def _run_for_point(self):
+        if self.current_index == self._fail_at:
+            raise RuntimeError('Capture failed')
+        self.annotations[self.current_index] = sum(self.current_index)
+        return super()._run_for_point()
+
+    def _point_annotations(self, key):
+        return self.annotations.get(key)
+
+    def _restore_annotations(self, key, annotations):
+        self.annotations[key] = annotations
+
+
+def test_resume_restores_annotations(tmp_path):
+    checkpoint = tmp_path / 'sweep.journal'
+    axis_values = [np.arange(2), np.arange(3)]
+    with pytest.raises(RuntimeError):
+        _AnnotatedSweep(axis_values, fail_at=(1, 1)).run(checkpoint)
+
+    sweep = _AnnotatedSweep(axis_values)
+    sweep.run(checkpoint, resume=True)
+    assert sweep.annotations == {index: sum(index) for index in itertools.product(range(2), range(3))}
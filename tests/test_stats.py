@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('naludaq')
+
+from oleas.stats import RunningStats, StatsCollector
+
+
+def _event(samples) -> dict:
+    samples = np.asarray(samples)
+    return {'data': list(samples), 'window_labels': [np.zeros(1, dtype=int)] * len(samples)}
+
+
+def test_running_stats_match_numpy():
+    rng = np.random.default_rng(0)
+    samples = rng.normal(size=(20, 3, 16))
+    stats = RunningStats()
+    stats.update_events([_event(x) for x in samples])
+
+    assert stats.count == 20
+    np.testing.assert_allclose(stats.mean, samples.mean(axis=0))
+    np.testing.assert_allclose(stats.variance, samples.var(axis=0, ddof=1))
+    np.testing.assert_array_equal(stats.min, samples.min(axis=0))
+    np.testing.assert_array_equal(stats.max, samples.max(axis=0))
+
+
+def test_running_stats_zero_fill_shorter_events():
+    long = np.full((2, 4), 3.0)
+    short = np.full((2, 2), 1.0)
+    stats = RunningStats()
+    stats.update(short)
+    stats.update(long)
+
+    expected = np.stack([np.pad(short, [(0, 0), (0, 2)]), long])
+    np.testing.assert_allclose(stats.mean, expected.mean(axis=0))
+    np.testing.assert_allclose(stats.variance, expected.var(axis=0, ddof=1))
+    np.testing.assert_array_equal(stats.min, expected.min(axis=0))
+
+
+def test_collector_drops_events_without_container():
+    collector = StatsCollector()
+    for value in range(5):
+        collector.append(_event(np.full((2, 4), float(value))))
+
+    assert len(collector) == 5
+    assert collector.events is None
+    np.testing.assert_allclose(collector.stats.mean, 2.0)
@@ -0,0 +1,25 @@
+import pytest
+
+pytest.importorskip('naludaq')
+
+from oleas.exceptions import SensorError
+from oleas.simulation import SimulatedBoard
+from oleas.telemetry import TelemetrySampler
+
+
+def test_sampler_reads_simulated_sensors():
+    sampler = TelemetrySampler(SimulatedBoard(seed=0))
+    sample = sampler.sample()
+
+    assert sample['sensors']['mcp4728_ch0'] == 0.0
+    assert sampler.latest() is sample
+
+
+class _Board:
+    """A board without a sensor backend"""
+
+
+def test_sampler_requires_sensor_backend():
+    with pytest.raises(SensorError):
+        TelemetrySampler(_Board())
+    TelemetrySampler(_Board(), read_fn=lambda board: {'temperature': 40.0})